@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Dispersive direction check
+
+Determines the dispersive direction of the example calibration exposures
+(whose energy increases to the Left) after flipping and transposing them
+into all four orientations. Both the whole series (as used by the
+calibrator, with the example's filters applied) and each consecutive pair
+of raw exposures (as used by determine_dispersive_direction) are checked.
+
+Exits with a nonzero status if the whole series gives the wrong direction
+or a confidence below the calibrator's threshold, or if any pair gives the
+wrong direction (pairs may be undetermined, -1).
+
+Usage:
+  python benchmarks/dispersive_direction.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'lib'))
+
+import numpy as np
+import minixs as mx
+from minixs.exposure import load_stack
+from minixs.filter import LowFilter, NeighborFilter
+from minixs.misc import find_dispersive_direction, determine_dispersive_direction
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'example', 'data')
+
+# auto-detection threshold of the calibrator
+CONFIDENCE_THRESHOLD = 0.6
+
+# (direction, function transforming N x height x width stack from the Left orientation)
+ORIENTATIONS = [
+    (mx.LEFT,  lambda s: s),
+    (mx.RIGHT, lambda s: s[:,:,::-1]),
+    (mx.UP,    lambda s: s.transpose(0,2,1)),
+    (mx.DOWN,  lambda s: s.transpose(0,2,1)[:,::-1,:]),
+    ]
+
+def filtered(stack, energies):
+  filters = [LowFilter(), NeighborFilter()]
+  filters[0].set_val(10)
+  filters[1].set_val(2)
+
+  out = stack.copy()
+  for pixels, energy in zip(out, energies):
+    for f in filters:
+      f.filter(pixels, energy)
+  return out
+
+def main():
+  files = [os.path.join(DATA_DIR, 'calib_%05d.tif' % i) for i in range(1,19)]
+  energies = mx.scanfile.ScanFile(os.path.join(DATA_DIR, 'calib.0001')).data[:,0]
+
+  raw = load_stack(files).astype(float)
+  filt = filtered(raw, energies)
+
+  status = 0
+  for direction, transform in ORIENTATIONS:
+    name = mx.DIRECTION_NAMES[direction]
+
+    t = time.time()
+    found, confidence = find_dispersive_direction(transform(filt), energies)
+    elapsed = time.time() - t
+
+    stack = transform(raw)
+    pairs = [determine_dispersive_direction(stack[i], stack[i+1]) for i in range(len(stack) - 1)]
+    correct = pairs.count(direction)
+    undetermined = pairs.count(-1)
+    wrong = len(pairs) - correct - undetermined
+
+    print("%-5s  series: %-5s (confidence %.2f, %.0f ms)  pairs: %d correct, %d undetermined, %d wrong" %
+          (name, mx.DIRECTION_NAMES[found] if found >= 0 else '-', confidence,
+           1000 * elapsed, correct, undetermined, wrong))
+
+    if found != direction or confidence < CONFIDENCE_THRESHOLD or wrong:
+      print("FAIL: %s" % name)
+      status = 1
+
+  return status
+
+if __name__ == '__main__':
+  sys.exit(main())
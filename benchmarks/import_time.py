@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Import time benchmark
+
+Measures the time taken by a fresh interpreter to import minixs (and,
+optionally, some of its submodules), and checks that importing the package
+alone does not pull in any heavy dependencies.
+
+Exits with a nonzero status if a heavy module is imported eagerly, or if
+the median import time exceeds --max.
+
+Usage:
+  python benchmarks/import_time.py [-n REPEAT] [-m MAX_SECONDS] [module ...]
+"""
+
+import os
+import sys
+import subprocess
+from optparse import OptionParser
+
+LIB = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'lib')
+
+# modules that `import minixs` must not import
+HEAVY_MODULES = ['numpy', 'scipy', 'PIL', 'matplotlib', 'wx']
+
+TIMING_CODE = """
+import time
+t = time.time()
+import %s
+print(time.time() - t)
+"""
+
+MODULES_CODE = """
+import sys
+import minixs
+print(' '.join(sorted(sys.modules)))
+"""
+
+def run(code):
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join([LIB, env.get('PYTHONPATH', '')])
+  p = subprocess.Popen([sys.executable, '-c', code], env=env, stdout=subprocess.PIPE)
+  out, _ = p.communicate()
+  if p.returncode != 0:
+    raise Exception("Benchmark subprocess failed")
+  return out.decode().strip()
+
+def time_import(module, repeat):
+  times = sorted(float(run(TIMING_CODE % module)) for i in range(repeat))
+  return times[0], times[len(times) // 2]
+
+def eager_heavy_modules():
+  loaded = run(MODULES_CODE).split()
+  return [m for m in HEAVY_MODULES if m in loaded]
+
+def main():
+  parser = OptionParser(usage="Usage: %prog [options] [module ...]")
+  parser.add_option("-n", "--repeat", dest="repeat", type=int, default=10,
+                    help="number of fresh interpreters to time each import in")
+  parser.add_option("-m", "--max", dest="max", type=float, default=None,
+                    help="fail if median import time of minixs exceeds this (seconds)")
+  (options, args) = parser.parse_args()
+
+  status = 0
+
+  heavy = eager_heavy_modules()
+  if heavy:
+    print("FAIL: 'import minixs' imports %s" % ', '.join(heavy))
+    status = 1
+
+  for module in ['minixs'] + args:
+    best, median = time_import(module, options.repeat)
+    print("%-24s best %7.1f ms  median %7.1f ms" % (module, 1000 * best, 1000 * median))
+
+    if module == 'minixs' and options.max is not None and median > options.max:
+      print("FAIL: median import time exceeds %.1f ms" % (1000 * options.max))
+      status = 1
+
+  return status
+
+if __name__ == '__main__':
+  sys.exit(main())
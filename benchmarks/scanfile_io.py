@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+Scan file IO benchmark
+
+Compares ScanFile.save and ScanFile.load with the original implementations
+(writing each value separately, and reading data with np.loadtxt) on a large
+synthetic scan, such as those produced by merging many scans.
+
+Exits with a nonzero status if the saved files or loaded data differ, or
+if scans containing comment lines after the data has started (e.g. pause
+or end of scan annotations) aren't loaded as np.loadtxt loads them.
+
+Usage:
+  python benchmarks/scanfile_io.py [-r ROWS] [-c COLUMNS] [-n REPEAT]
+"""
+
+import os
+import sys
+import time
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'lib'))
+
+import numpy as np
+from minixs.scanfile import ScanFile, SCAN_COLUMN_WIDTH, format_rows
+
+def make_scan(rows, columns):
+  s = ScanFile()
+  names = ['Mono Energy *', 'I0'] + ['Column %d' % i for i in range(2, columns)]
+  s.headers = [
+      '# 1-D Scan File created by LabVIEW Control Panel  2/18/2012  5:21:44 PM; Scan time 1 hrs 2 min 42 sec. \r\n',
+      '#' + ''.join('%*s' % (SCAN_COLUMN_WIDTH, n) for n in names) + '\r\n',
+      ]
+  s.columns = names
+  # scales are bounded so that every value fits the fixed width column format
+  s.data = np.random.RandomState(0).rand(rows, columns) * 10.0**(np.arange(columns) % 8)
+  s.data[:,0] = np.linspace(7000, 7200, rows)
+  return s
+
+def legacy_save(scan, filename, fmt='%%%d.8f' % SCAN_COLUMN_WIDTH):
+  with open(filename, 'wb') as f:
+    for line in scan.headers:
+      f.write(line)
+    for row in scan.data:
+      for val in row:
+        f.write(fmt % val)
+        f.write(' ')
+      f.write('\r\n')
+
+def legacy_load(filename):
+  headers = []
+  with open(filename) as f:
+    for line in f:
+      if line[0] != '#':
+        break
+      headers.append(line)
+  data = np.loadtxt(filename, ndmin=2)
+  return headers, data
+
+def check_comments(scan, filename):
+  """
+  Check that comment lines within and after the data are skipped
+
+  Returns:
+    list of failure messages
+  """
+  lines = ''.join(format_rows(scan.data[:20])).splitlines(True)
+  cases = [
+      ('comment within data', lines[:5] + ['# scan paused\r\n'] + lines[5:]),
+      ('trailing comment', lines + ['# scan ended\r\n']),
+      ('trailing comment without newline', lines + ['# scan ended']),
+      ]
+
+  failures = []
+  for name, data_lines in cases:
+    with open(filename, 'wb') as f:
+      f.write(''.join(scan.headers + data_lines))
+
+    headers, expected = legacy_load(filename)
+    try:
+      loaded = ScanFile(filename)
+    except ValueError as e:
+      failures.append("%s: %s" % (name, e))
+      continue
+    if headers != loaded.headers or not np.array_equal(expected, loaded.data):
+      failures.append("%s: loaded scans differ" % name)
+
+  return failures
+
+def best_time(func, repeat):
+  times = []
+  for i in range(repeat):
+    t = time.time()
+    func()
+    times.append(time.time() - t)
+  return min(times)
+
+def main():
+  parser = OptionParser(usage="Usage: %prog [options]")
+  parser.add_option("-r", "--rows", dest="rows", type=int, default=20000,
+                    help="number of rows in scan")
+  parser.add_option("-c", "--columns", dest="columns", type=int, default=30,
+                    help="number of columns in scan")
+  parser.add_option("-n", "--repeat", dest="repeat", type=int, default=3,
+                    help="number of times to time each operation (best is reported)")
+  (options, args) = parser.parse_args()
+
+  scan = make_scan(options.rows, options.columns)
+  tmpdir = tempfile.mkdtemp()
+  legacy_file = os.path.join(tmpdir, 'legacy.0001')
+  new_file = os.path.join(tmpdir, 'new.0001')
+  comment_file = os.path.join(tmpdir, 'comment.0001')
+
+  status = 0
+  try:
+    t_legacy_save = best_time(lambda: legacy_save(scan, legacy_file), options.repeat)
+    t_save = best_time(lambda: scan.save(new_file), options.repeat)
+
+    with open(legacy_file, 'rb') as f1, open(new_file, 'rb') as f2:
+      if f1.read() != f2.read():
+        print("FAIL: saved files differ")
+        status = 1
+
+    t_legacy_load = best_time(lambda: legacy_load(legacy_file), options.repeat)
+    t_load = best_time(lambda: ScanFile(new_file), options.repeat)
+
+    headers, data = legacy_load(legacy_file)
+    loaded = ScanFile(new_file)
+    if headers != loaded.headers or not np.array_equal(data, loaded.data):
+      print("FAIL: loaded scans differ")
+      status = 1
+
+    for failure in check_comments(scan, comment_file):
+      print("FAIL: %s" % failure)
+      status = 1
+
+    print("%d rows x %d columns (%.1f MB)" % (options.rows, options.columns,
+                                             os.path.getsize(new_file) / 1e6))
+    print("save  legacy %8.1f ms  new %8.1f ms  (%.1fx)" % (1000 * t_legacy_save, 1000 * t_save, t_legacy_save / t_save))
+    print("load  legacy %8.1f ms  new %8.1f ms  (%.1fx)" % (1000 * t_legacy_load, 1000 * t_load, t_legacy_load / t_load))
+  finally:
+    for f in (legacy_file, new_file, comment_file):
+      if os.path.exists(f):
+        os.remove(f)
+    os.rmdir(tmpdir)
+
+  return status
+
+if __name__ == '__main__':
+  sys.exit(main())
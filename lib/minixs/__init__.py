@@ -1,29 +1,76 @@
 """
 Miniature X-ray Spectrometer (miniXS) Tools
+
+Submodules are imported on first access (e.g. `mx.calibrate`), so that
+scripts only pay for the modules they actually use.
 """
-import calibrate, \
-       emission, \
-       exposure, \
-       filter, \
-       killzone, \
-       misc, \
-       rixs, \
-       scanfile, \
-       spectrometer
+import sys
+from importlib import import_module
+from types import ModuleType
 
 from constants import *
 
 __all__ = [
+  'badpixels',
   'calibrate',
+  'catalog',
+  'correction',
   'emission',
   'exposure',
   'filetype',
   'filter',
   'killzone',
+  'merge',
   'misc',
+  'raytrace',
   'rixs',
   'scanfile',
+  'server',
   'spectrometer',
+  'watch',
+  ]
+
+# other submodules available as attributes
+SUBMODULES = __all__ + [
+  'dataset',
+  'gauss',
+  'geom',
+  'parser',
+  'progress',
   ]
 
-load = filetype.load
+# attributes provided by submodules: name => (submodule, attribute)
+LAZY_ATTRIBUTES = {
+  'load': ('filetype', 'load'),
+  }
+
+class LazyPackage(ModuleType):
+  """
+  Package that imports its submodules on first attribute access
+  """
+  def __getattr__(self, name):
+    if name in LAZY_ATTRIBUTES:
+      module, attr = LAZY_ATTRIBUTES[name]
+      value = getattr(import_module('%s.%s' % (self.__name__, module)), attr)
+    elif name in SUBMODULES:
+      value = import_module('%s.%s' % (self.__name__, name))
+    else:
+      raise AttributeError("'%s' module has no attribute '%s'" % (self.__name__, name))
+
+    # only resolve once
+    setattr(self, name, value)
+    return value
+
+  def __dir__(self):
+    return sorted(set(self.__dict__.keys() + SUBMODULES + LAZY_ATTRIBUTES.keys()))
+
+def _install():
+  module = sys.modules[__name__]
+  lazy = LazyPackage(__name__)
+  lazy.__dict__.update(module.__dict__)
+
+  # keep original module alive, since the functions above use its globals
+  lazy._module = module
+  sys.modules[__name__] = lazy
+
+_install()
@@ -0,0 +1,257 @@
+"""
+Automatic bad pixel detection
+
+Cosmic rays show up as isolated spikes in a single exposure, while hot pixels
+are too bright in every exposure. Both can be found by comparing a series of
+repeated (or neighboring incident energy) exposures against each other and by
+comparing each pixel to its neighbors.
+
+Functions:
+  detect_bad_pixels - find hot pixels and cosmic ray hits in a stack of exposures
+  spatial_outliers - find pixels that stand out from their neighbors
+  neighbor_rank - order statistic of the 8 neighbors of each pixel
+  bad_pixel_filter - build a BadPixelFilter from a list of pixels
+  killzone_list - build a KillzoneList from the results of detect_bad_pixels
+
+Example:
+  >>> import minixs as mx
+  >>> files = ['scan_%05d.tif' % i for i in range(1,201)]
+  >>> hot, cosmics = mx.badpixels.detect_bad_pixels(files)
+  >>> kz = mx.badpixels.killzone_list(files, hot, cosmics)
+  >>> kz.save('scan.killzones')
+"""
+
+import os
+import numpy as np
+
+from exposure import Exposure
+from filter import BadPixelFilter
+from killzone import KillzoneList
+
+# consistency constant relating the median absolute deviation to sigma
+MAD_TO_SIGMA = 1.4826
+
+def neighbor_rank(pixels, rank=6):
+  """
+  Calculate an order statistic of the 8 neighbors of each pixel
+
+  Parameters
+  ----------
+    pixels: array of pixels (or N x rows x cols stack of pixel arrays)
+    rank: which neighbor value to return, counting from the dimmest (0)
+          to the brightest (7)
+
+  Edges are handled by repeating the outermost rows and columns.
+  """
+  p = np.asarray(pixels)
+  pad = [(0,0)] * (p.ndim - 2) + [(1,1), (1,1)]
+  padded = np.pad(p, pad, mode='edge')
+  h, w = p.shape[-2:]
+
+  nbors = np.array([
+      padded[...,1+i:1+i+h,1+j:1+j+w]
+      for i in (-1,0,1)
+      for j in (-1,0,1)
+      if i != 0 or j != 0
+      ])
+  return np.partition(nbors, rank, axis=0)[rank]
+
+def _noise(level, mad=None, min_sigma=1.0):
+  """
+  Estimate noise from the MAD where available, falling back to counting
+  statistics for low count pixels (where the MAD is typically 0)
+  """
+  sigma = np.sqrt(np.maximum(level, 0))
+  if mad is not None:
+    sigma = np.maximum(sigma, MAD_TO_SIGMA * mad)
+  return np.maximum(sigma, min_sigma)
+
+def spatial_outliers(pixels, threshold=8.0, min_counts=10):
+  """
+  Find pixels that are much brighter than their neighbors
+
+  Parameters
+  ----------
+    pixels: array of pixels (or N x rows x cols stack of pixel arrays)
+    threshold: number of standard deviations above the second brightest
+               neighbor required
+    min_counts: pixels with fewer counts are never flagged
+
+  Returns
+  -------
+    boolean mask of same shape as `pixels`
+
+  Comparing with the second brightest neighbor allows hits covering two
+  adjacent pixels to be found, while pixels on real features (such as thin
+  elastic lines, where each pixel has at least two bright neighbors) are left
+  alone.
+  """
+  level = neighbor_rank(pixels, 6)
+  return np.logical_and(pixels >= min_counts,
+                        pixels - level > threshold * _noise(level))
+
+def _window_starts(n, window):
+  """
+  First frame of the window of neighboring frames used for each frame
+  """
+  return np.clip(np.arange(n) - window // 2, 0, n - window)
+
+def _temporal_outliers(stack, window, threshold, min_counts):
+  """
+  Flag pixels that are outliers compared to the same pixel in neighboring frames
+  """
+  n = len(stack)
+  window = min(window, n)
+
+  # view of all windows of `window` consecutive frames (no copy)
+  nwin = n - window + 1
+  shape = (nwin, window) + stack.shape[1:]
+  strides = (stack.strides[0],) + stack.strides
+  windows = np.lib.stride_tricks.as_strided(stack, shape, strides)
+
+  med = np.median(windows, axis=1)
+  mad = np.median(np.abs(windows - med[:,np.newaxis]), axis=1)
+
+  starts = _window_starts(n, window)
+  med = med[starts]
+  mad = mad[starts]
+
+  return np.logical_and(stack >= min_counts,
+                        stack - med > threshold * _noise(med, mad))
+
+def _load_rows(exposure_files, y1, y2):
+  """
+  Load rows y1:y2 of each exposure in a list into a stack
+  """
+  rows = None
+  for i, f in enumerate(exposure_files):
+    p = Exposure(f).pixels[y1:y2]
+    if rows is None:
+      rows = np.zeros((len(exposure_files),) + p.shape, dtype=p.dtype)
+    rows[i] = p
+  return rows
+
+def detect_bad_pixels(exposure_files, window=7, threshold=8.0,
+    spatial_threshold=8.0, min_counts=10, hot_fraction=0.5,
+    max_memory=256*2**20, progress=None):
+  """
+  Detect hot pixels and cosmic ray hits in a series of exposures
+
+  Parameters
+  ----------
+    exposure_files: list of exposure filenames, ordered so that neighboring
+                    files are repeats or were taken at nearby incident energies
+    window: number of neighboring exposures to compare each exposure with
+            (None to compare with all exposures)
+    threshold: number of standard deviations above the median of the
+               neighboring exposures required for a cosmic ray hit
+    spatial_threshold: number of standard deviations above the neighboring
+                       pixels required for any bad pixel (see spatial_outliers)
+    min_counts: pixels with fewer counts are never flagged
+    hot_fraction: pixels that are spatial outliers in more than this fraction
+                  of exposures are considered hot
+    max_memory: approximate limit (in bytes) on memory used at once
+    progress: ProgressIndicator
+
+  Returns
+  -------
+    (hot_pixels, cosmics)
+
+    hot_pixels: list of (x,y) pixels that are bad in all exposures
+    cosmics: list (one entry per exposure) of lists of (x,y) pixels hit by
+             cosmic rays in that exposure
+
+  A cosmic ray hit is a pixel that is both a temporal outlier (compared to
+  the median and median absolute deviation of the same pixel in the
+  surrounding `window` exposures) and a spatial outlier (compared to its
+  neighbors in the same exposure). Requiring both avoids flagging real
+  features that move between exposures taken at different incident energies.
+
+  The exposures are processed in blocks of rows, sized so that each block
+  fits within `max_memory`. If all exposures do not fit at once, each file is
+  read once per block.
+  """
+  n = len(exposure_files)
+  if n == 0:
+    return [], []
+
+  if window is None or window > n:
+    window = n
+
+  shape = Exposure(exposure_files[0]).pixels.shape
+  h, w = shape
+
+  # the median and absolute deviation calculations each make a float copy
+  # of every window
+  bytes_per_row = 8 * w * n * (2 * window + 4)
+  block = int(max(1, min(h, max_memory // bytes_per_row)))
+
+  hot_mask = np.zeros(shape, dtype=bool)
+  cosmic_mask = np.zeros((n,) + shape, dtype=bool)
+
+  for y1 in range(0, h, block):
+    y2 = min(h, y1 + block)
+    if progress:
+      progress.update("Checking rows %d to %d" % (y1, y2), y1 / float(h))
+
+    # include a row on either side for neighbor comparisons
+    l1 = max(0, y1 - 1)
+    l2 = min(h, y2 + 1)
+    stack = _load_rows(exposure_files, l1, l2).astype(float)
+
+    spatial = spatial_outliers(stack, spatial_threshold, min_counts)
+    temporal = _temporal_outliers(stack, window, threshold, min_counts)
+
+    spatial = spatial[:, y1-l1:y2-l1]
+    temporal = temporal[:, y1-l1:y2-l1]
+
+    hot = spatial.sum(0) > hot_fraction * n
+    hot_mask[y1:y2] = hot
+    cosmic_mask[:,y1:y2] = np.logical_and(np.logical_and(spatial, temporal), ~hot)
+
+  y, x = np.where(hot_mask)
+  hot_pixels = zip(x, y)
+
+  cosmics = []
+  for m in cosmic_mask:
+    y, x = np.where(m)
+    cosmics.append(zip(x, y))
+
+  return hot_pixels, cosmics
+
+def bad_pixel_filter(bad_pixels, mode=BadPixelFilter.MODE_ZERO_OUT):
+  """
+  Create a BadPixelFilter for a list of (x,y) pixels
+
+  Parameters
+  ----------
+    bad_pixels: list of (x,y) pixels (e.g. hot_pixels from detect_bad_pixels)
+    mode: one of BadPixelFilter.MODE_*
+  """
+  fltr = BadPixelFilter()
+  fltr.set_val((mode, [[int(x), int(y)] for x,y in bad_pixels]))
+  return fltr
+
+def killzone_list(exposure_files, hot_pixels, cosmics, radius=0):
+  """
+  Create a KillzoneList from the results of detect_bad_pixels
+
+  Parameters
+  ----------
+    exposure_files: list of exposure filenames passed to detect_bad_pixels
+    hot_pixels: list of (x,y) pixels to kill in every exposure
+    cosmics: list of lists of (x,y) pixels to kill in each exposure
+    radius: number of pixels around each bad pixel to also kill
+
+  Each bad pixel is stored as a square killzone of side 2*radius+1.
+  """
+  kz = KillzoneList()
+  for ef, pixels in zip(exposure_files, cosmics):
+    ef = os.path.abspath(ef)
+    rects = [
+        [[max(0, int(x)-radius), max(0, int(y)-radius)], [int(x)+radius+1, int(y)+radius+1]]
+        for x,y in list(hot_pixels) + list(pixels)
+        ]
+    kz.exposure_files.append(ef)
+    kz.killzones[ef] = {'rects': rects, 'circles': []}
+  return kz
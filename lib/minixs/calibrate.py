@@ -10,19 +10,24 @@ Functions:
   find_combined_maxima - locate peaks in series of exposures
   fit_region - fit a smooth function to peaks located with a rectangular region
   evaluate_fit - evaluate the fit returned by fit_region
+  design_matrix - terms of a fit evaluated at many points
+  region_index - find the region containing each of many points
+  fit_points_filename - name of file storing fit points of a calibration
+  robust_lstsq - least squares fit with outlier rejection
 
   load - load a calibration matrix (deprecated)
 """
 
 import minixs as mx
-from exposure import Exposure
-from emission import EmissionSpectrum, process_spectrum
+from exposure import Exposure, load_stack
+import emission
 from itertools import izip
 from filter import get_filter_by_name
-from gauss import gauss_leastsq
+from gauss import gauss_leastsq_many, gauss_logparabola, gauss_moments
 from parser import Parser, STRING, INT, FLOAT, LIST
 from filetype import determine_filetype_from_header
-from spectrometer import Spectrometer
+from spectrometer import get_spectrometer, lattice_constants
+from misc import energy_width_map, collection_angle_correction
 from progress import ProgressIndicator
 
 import os
@@ -138,7 +143,143 @@ FIT_CUBIC   = 2
 FIT_QUARTIC = 3
 FIT_ELLIPSOID = 4
 
-def fit_region(region, points, dest, fit_type = FIT_QUARTIC, return_fit=False):
+def design_matrix(x, y, fit_type=FIT_QUARTIC):
+  """
+  Evaluate the terms of a fit at many points
+
+  Parameters
+  ----------
+    x, y - coordinates of points
+    fit_type - FIT_QUADRATIC, FIT_CUBIC or FIT_QUARTIC (see fit_region)
+
+  Returns
+  -------
+    N x (number of terms) array, whose product with the fit parameters
+    gives the fit evaluated at the points
+  """
+  x = np.asarray(x, dtype=float)
+  y = np.asarray(y, dtype=float)
+
+  if fit_type == FIT_QUADRATIC:
+    terms = [x**2, y**2, x*y, x, y, np.ones(x.shape)]
+  elif fit_type == FIT_CUBIC:
+    terms = [x**3, y**3, x**2*y, x*y**2, x**2, y**2, x*y, x, y, np.ones(x.shape)]
+  elif fit_type == FIT_QUARTIC:
+    terms = [x**4, y**4, x**2 * y**2,
+             x**2 * y, x * y**2,
+             x**2, y**2, x * y,
+             x, y,
+             np.ones(x.shape)]
+  else:
+    raise Exception("Unsupported fit type: %s" % fit_type)
+
+  return np.vstack(terms).T
+
+def evaluate_fit(fit, x, y, fit_type=FIT_QUARTIC):
+  return np.dot(design_matrix(x, y, fit_type), fit)
+
+def region_index(points, regions):
+  """
+  Find the region containing each of many points
+
+  Parameters
+  ----------
+    points - N x 2 (or more) array of x, y coordinates
+    regions - list of rectangles [(x1,y1), (x2,y2)]
+
+  Returns
+  -------
+    array with the index of the first region containing each point (-1 for
+    points outside of all regions)
+  """
+  points = np.asarray(points, dtype=float)
+  if len(regions) == 0 or len(points) == 0:
+    return -np.ones(len(points), dtype=int)
+
+  bounds = np.array([(x1,y1,x2,y2) for (x1,y1),(x2,y2) in regions], dtype=float)
+  x = points[:,0:1]
+  y = points[:,1:2]
+  inside = ((x >= bounds[:,0]) & (x < bounds[:,2]) &
+            (y >= bounds[:,1]) & (y < bounds[:,3]))
+  return np.where(inside.any(1), inside.argmax(1), -1)
+
+def fit_points_filename(filename):
+  """
+  Name of file storing the fit points of a calibration file
+  """
+  return filename + '.fit.npz'
+
+def robust_lstsq(A, z, nsigma=3.0, max_iter=10):
+  """
+  Linear least squares with iterative sigma clipping
+
+  Parameters
+  ----------
+    A - N x M design matrix
+    z - N values to fit
+    nsigma - points with residuals larger than this many times the rms
+             residual of the remaining points are rejected
+    max_iter - maximum number of rejection passes
+
+  Returns
+  -------
+    (fit, keep)
+
+    fit - M fit parameters
+    keep - N boolean array, False for rejected points
+
+  A is factored (A = QR) only once. Writing the fit as R^-1 g, the
+  parameters g of the remaining points solve (Q_k^T Q_k) g = Q_k^T z_k, and
+  Q_k^T Q_k is the identity less Q_r^T Q_r of the rejected rows. Each pass
+  therefore only downdates this small M x M system with the newly rejected
+  rows, and stays well conditioned since Q is orthonormal.
+
+  If there are no more points than parameters, or A is rank deficient, no
+  points are rejected and the plain least squares solution is returned.
+  Rejection also stops before the remaining points would leave the fit
+  undetermined.
+  """
+  A = np.asarray(A, dtype=float)
+  z = np.asarray(z, dtype=float)
+  n, m = A.shape
+  keep = np.ones(n, dtype=bool)
+
+  # too few points (or degenerate ones) to reject any: fall back to plain least squares
+  if n <= m:
+    return np.linalg.lstsq(A, z)[0], keep
+
+  Q, R = np.linalg.qr(A)
+  diag = np.abs(np.diag(R))
+  if diag.min() <= diag.max() * n * np.finfo(float).eps:
+    return np.linalg.lstsq(A, z)[0], keep
+
+  G = np.eye(m)
+  b = np.dot(Q.T, z)
+
+  g = b.copy()
+  for i in range(max_iter):
+    res = np.dot(Q, g) - z
+    rms = np.sqrt(np.mean(res[keep]**2))
+    reject = keep & (np.abs(res) > nsigma * rms)
+
+    # always leave enough points to determine the fit
+    if not reject.any() or keep.sum() - reject.sum() < m:
+      break
+
+    Qr = Q[reject]
+    G_new = G - np.dot(Qr.T, Qr)
+    b_new = b - np.dot(Qr.T, z[reject])
+    # G's eigenvalues lie in [0,1], and vanish if the remaining points no longer determine the fit
+    if np.linalg.eigvalsh(G_new).min() <= m * np.finfo(float).eps:
+      break
+
+    G, b = G_new, b_new
+    g = np.linalg.solve(G, b)
+    keep &= ~reject
+
+  return np.linalg.solve(R, g), keep
+
+def fit_region(region, points, dest, fit_type = FIT_QUARTIC, return_fit=False, nsigma=None):
   """
   Fit a smooth function to points that lie in region bounded by `region`
 
@@ -147,11 +288,23 @@ def fit_region(region, points, dest, fit_type = FIT_QUARTIC, return_fit=False):
     region - a rectangle defining the boundary of region to fit: [(x1,y1), (x2,y2)]
     points - an N x 3 array of data points
     dest - an array to store fit data in
-    fit_type - type of fit to perform, ether FIT_QUADRATIC or FIT_CUBIC
+    fit_type - type of fit to perform, ether FIT_QUADRATIC, FIT_CUBIC or FIT_QUARTIC
+    return_fit - whether to also return the fit parameters and points used
+    nsigma - if given, points whose residuals exceed this many times the rms
+             residual are iteratively rejected (see robust_lstsq)
 
   Returns
   -------
-    Nothing
+    (lin_res, rms_res, [fit, used])
+
+    lin_res - average linear residual of fit
+    rms_res - root mean square residual of fit
+    fit - fit parameters (see evaluate_fit)
+    used - N boolean array, True for points used in the fit
+
+    The last 2 are only returned if `return_fit` is True. Nothing is
+    returned if there are no points in the region. Residuals are those of
+    the points used in the fit.
 
   The points array should contain three columns giving respectively x,y and z
   values of data points.  The x and y values should be between 0 and the width
@@ -171,22 +324,15 @@ def fit_region(region, points, dest, fit_type = FIT_QUARTIC, return_fit=False):
   ---------
     FIT_QUADRATIC: z = Ax^2 + By^2 + Cxy + Dx + Ey + F
     FIT_CUBIC: z = Ax^3 + By^3 + Cx^2y + Dxy^2 + Ex^2 + Fy^2 + Gxy + Hx + Iy + J
+    FIT_QUARTIC: z = Ax^4 + By^4 + Cx^2y^2 + Dx^2y + Exy^2 + Fx^2 + Gy^2 + Hxy + Ix + Jy + K
   """
 
   # boundary coordinates
   (x1,y1),(x2,y2) = region
 
   # extract points inside this xtal region
-  index = np.where(np.logical_and(
-      np.logical_and(
-        points[:,0] >= x1,
-        points[:,0] < x2),
-      np.logical_and(
-        points[:,1] >= y1,
-        points[:,1] < y2
-        )
-      ))
-  x,y,z = points[index].T
+  used = region_index(points, [region]) == 0
+  x,y,z = points[used].T
 
   # if we have no points in this region, we can't fit anything
   # XXX this should pass the warning up to higher level code instead
@@ -195,137 +341,36 @@ def fit_region(region, points, dest, fit_type = FIT_QUARTIC, return_fit=False):
     print "Warning: No points in region: ", region
     return
 
-  # build points to evaluate fit at
-  xxd, yyd = np.meshgrid(np.arange(x1,x2), np.arange(y1,y2))
-  xxd = np.ravel(xxd)
-  yyd = np.ravel(yyd)
-  xx = xxd.astype('double')
-  yy = yyd.astype('double')
-
-  if fit_type == FIT_QUADRATIC:
-    # fit to quadratic: z = Ax^2 + By^2 + Cxy + Dx + Ey + F
-    A = np.vstack([x**2, y**2, x*y, x, y, np.ones(x.shape)]).T
-    fit, r = np.linalg.lstsq(A,z)[0:2]
-
-    # calculate residues
-    rms_res = np.sqrt(r / len(z))[0]
-    lin_res = sum(z - np.dot(A, fit)) / len(z)
+  if fit_type == FIT_ELLIPSOID:
+    raise Exception("Fit method not yet implemented.")
 
-    # evaluate at all points
-    zz = np.dot(
-           np.vstack([xx**2,yy**2,xx*yy,xx,yy,np.ones(xx.shape)]).T,
-           fit
-         ).T
+  A = design_matrix(x, y, fit_type)
+  if nsigma is None:
+    fit = np.linalg.lstsq(A,z)[0]
+  else:
+    fit, keep = robust_lstsq(A, z, nsigma)
+    used[used] = keep
+    A, z = A[keep], z[keep]
 
-  elif fit_type == FIT_CUBIC:
-    # fit to cubic:
-    #   Ax^3 + By^3 + Cx^2y + Dxy^2 + Ex^2 + Fy^2 + Gxy + Hx + Iy + J = z
-    A = np.vstack([x**3,y**3,x**2*y,x*y**2,x**2, y**2, x*y, x, y, np.ones(x.shape)]).T
-    fit, r = np.linalg.lstsq(A,z)[0:2]
-
-    # calculate residues
-    rms_res = np.sqrt(r / len(z))[0]
-    lin_res = sum(z - np.dot(A, fit)) / len(z)
-
-    # evaluate at all points
-    zz = np.dot(
-           np.vstack([
-             xx**3, yy**3, xx**2*yy, xx*yy**2,
-             xx**2, yy**2, xx*yy,
-             xx, yy,
-             np.ones(xx.shape)
-           ]).T,
-           fit
-         ).T
+  # calculate residues
+  res = z - np.dot(A, fit)
+  rms_res = np.sqrt(np.mean(res**2))
+  lin_res = res.sum() / len(z)
 
-  elif fit_type == FIT_QUARTIC:
-    # fit to quartic:
-    A = np.vstack([
-      x**4,
-      y**4,
-      x**2 * y**2,
-      # intentionally skip all terms with cubes
-      x**2 * y,
-      x * y**2,
-      x**2,
-      y**2,
-      x * y,
-      x,
-      y,
-      np.ones(x.shape)
-      ]).T
-    fit, r = np.linalg.lstsq(A,z)[0:2]
-
-    # calculate residues
-    rms_res = np.sqrt(r / len(z)) #[0]
-    lin_res = sum(z - np.dot(A, fit)) / len(z)
-
-    # evaluate at all points
-    zz = np.dot(
-           np.vstack([
-             xx**4, yy**4, xx**2 * yy**2,
-             xx**2 * yy, xx * yy**2,
-             xx**2, yy**2, xx * yy,
-             xx, yy,
-             np.ones(xx.shape)
-           ]).T,
-           fit
-         ).T
-
-  elif fit_type == FIT_ELLIPSOID:
-    raise Exception("Fit method not yet implemented.")
-    # XXX this doesn't seem to work...
-    # Fit to ellipsoid:
-    # Ax^2 + By^2 + Cz^2 + Dxy + Eyz + Fzx + Gx + Hy + Iz = 1
-    data = np.vstack([
-      x*x,
-      y*y,
-      z*z,
-      x*y,
-      y*z,
-      z*x,
-      x,
-      y,
-      z
-      ]).T
-
-    w = np.ones(x.shape)
-    fit, r = np.linalg.lstsq(data,w)[0:2]
-
-    #rms_res = np.sqrt(r / len(w))[0]
-    lin_res = (w - np.dot(data, fit)).sum() / len(w)
-    rms_res = np.sqrt(((w - np.dot(data, fit))**2).sum() / len(w))
-
-    # now solve for z in terms of x and y to evaluate
-    A,B,C,D,E,F,G,H,I = fit
-    a = C
-    b = E*yy + F*xx + I
-    c = A*xx**2 + B*yy**2 + D*xx*yy + G*xx + H*yy - 1
-    zz = (-b + np.sqrt(b**2 - 4*a*c)) / (2*a)
+  # evaluate at all points
+  xxd, yyd = np.meshgrid(np.arange(x1,x2), np.arange(y1,y2))
+  xxd = np.ravel(xxd)
+  yyd = np.ravel(yyd)
 
   # fill the calibration matrix with values from fit
-  dest[yyd,xxd] = zz
+  dest[yyd,xxd] = evaluate_fit(fit, xxd, yyd, fit_type)
 
   if return_fit:
-    return lin_res, rms_res, fit
+    return lin_res, rms_res, fit, used
   else:
     return lin_res, rms_res
 
-def evaluate_fit(fit, x, y, fit_type=FIT_QUARTIC):
-
-  if fit_type == FIT_QUARTIC:
-    return np.dot(
-           np.vstack([
-             x**4, y**4, x**2 * y**2,
-             x**2 * y, x * y**2,
-             x**2, y**2, x * y,
-             x, y,
-             np.ones(x.shape)
-           ]).T,
-           fit
-         ).T
-
-def calibrate(filtered_exposures, energies, regions, dispersive_direction, fit_type=FIT_QUARTIC, return_diagnostics=False, progress=ProgressIndicator()):
+def calibrate(filtered_exposures, energies, regions, dispersive_direction, fit_type=FIT_QUARTIC, return_diagnostics=False, progress=ProgressIndicator(), nsigma=None):
   """
   Build calibration matrix from parameters in Calibration object
 
@@ -341,18 +386,23 @@ def calibrate(filtered_exposures, energies, regions, dispersive_direction, fit_t
   -------------------
     fit_type: type of fit (see fit_region() for more)
     return_diagnostics: whether to return extra information (residues and points used for fit)
+    nsigma: if given, fit robustly by rejecting maxima whose residuals
+            exceed this many times the rms residual of their region
+            (e.g. from fluorescence or hot pixels, see robust_lstsq)
 
   Returns
   -------
-    calibration_matrix, [lin_res, rms_res, points]
+    calibration_matrix, [lin_res, rms_res, points, fits, rejected]
 
     calibration_matrix: matrix of energies assigned to each pixel
 
     lin_res: average linear deviation of fit
     rms_res: avg root mean square residue of fit
     points: extracted maxima used for fit
+    fits: fit parameters of each region
+    rejected: boolean array flagging the points rejected by the robust fit
 
-    The last 3 of these are only returned if `return_diagnostics` is True.
+    The last 5 of these are only returned if `return_diagnostics` is True.
   """
 
   progress.push_step("Find maxima", 0.5)
@@ -367,20 +417,22 @@ def calibrate(filtered_exposures, energies, regions, dispersive_direction, fit_t
   lin_res = []
   rms_res = []
   fits = []
+  rejected = np.zeros(len(points), dtype=bool)
 
   progress.push_step("Fit smooth surface", 0.5)
   for region in regions:
 
-    ret = fit_region(region, points, calibration_matrix, fit_type, return_fit=True)
+    ret = fit_region(region, points, calibration_matrix, fit_type, return_fit=True, nsigma=nsigma)
     if ret is not None:
-      lr, rr, fit = ret
+      lr, rr, fit, used = ret
       lin_res.append(lr)
       rms_res.append(rr)
       fits.append(fit)
+      rejected |= (region_index(points, [region]) == 0) & ~used
   progress.pop_step()
 
   if return_diagnostics:
-    return (calibration_matrix, (lin_res, rms_res, points, fits))
+    return (calibration_matrix, (lin_res, rms_res, points, fits, rejected))
   else:
     return calibration_matrix
 
@@ -398,6 +450,8 @@ class Calibration(object):
                               (useful for determining spectrometer energy resolution)
     calc_solid_angle_map  - calculate solid angle subtended by each pixel
                               (requires self.spectrometer to be set!)
+    energy_width_map      - emission energy width covered by each pixel
+    collection_angle_map  - angular acceptance of each pixel in the dispersive direction
     calc_residuals        - calculate residuals between fit and detected peaks
 
   Example usage:
@@ -434,9 +488,14 @@ class Calibration(object):
     self.xtals = []
     self.calibration_matrix = np.array([])
     self.spectrometer = None
+    self.fit_type = FIT_QUARTIC
 
     self.filename = None
 
+    # maps derived from the calibration matrix (see _memoize)
+    self._memo = {}
+    self._memo_key = None
+
     self.load_errors = []
 
     if filename:
@@ -481,6 +540,67 @@ class Calibration(object):
 
         np.savetxt(f, self.calibration_matrix, fmt='%.3f')
 
+    if not header_only:
+      self._save_fit_points(filename)
+
+  def _save_fit_points(self, filename):
+    """
+    Save fit points, their regions and the fits next to calibration file
+
+    Any existing fit point file would be out of date, so it is removed if
+    there are no fit points to save.
+    """
+    points_file = fit_points_filename(filename)
+
+    if getattr(self, 'fit_points', None) is None or not getattr(self, 'fits', None):
+      if os.path.exists(points_file):
+        os.remove(points_file)
+      return
+
+    with open(points_file, 'wb') as f:
+      np.savez(f,
+               fit_points=self.fit_points,
+               fit_regions=self.fit_regions,
+               fit_rejected=self.fit_rejected,
+               fits=np.array(self.fits),
+               fit_type=self.fit_type)
+
+  def _load_fit_points(self, filename):
+    """
+    Load fit points saved by _save_fit_points, if they are up to date
+    """
+    points_file = fit_points_filename(filename)
+    if (not os.path.exists(points_file) or
+        os.path.getmtime(points_file) < os.path.getmtime(filename)):
+      return
+
+    try:
+      data = np.load(points_file)
+      self.fit_points = data['fit_points']
+      self.fit_regions = data['fit_regions']
+      if 'fit_rejected' in data.files:
+        self.fit_rejected = data['fit_rejected']
+      else:
+        self.fit_rejected = np.zeros(len(self.fit_points), dtype=bool)
+      self.fits = list(data['fits'])
+      self.fit_type = int(data['fit_type'])
+    except Exception as e:
+      self.load_errors.append("Unable to load fit points: %s" % str(e))
+
+  @classmethod
+  def parser_info(cls):
+    """
+    Parser key types for calibration headers
+    """
+    return {
+      'Spectrometer': STRING,
+      'Dataset': STRING,
+      'Dispersive Direction': STRING,
+      'Energies and Exposures': (LIST, (FLOAT, STRING)),
+      'Filters': (LIST, STRING),
+      'Xtal Boundaries': (LIST, (INT, INT, INT, INT)),
+      }
+
   def load(self, filename=None, header_only=False):
     """
     Load calibration information from saved file
@@ -508,14 +628,7 @@ class Calibration(object):
       self.load_errors.append("Unable to load nonexistant file: '%s'"%filename)
       return False
 
-    parser = Parser({
-      'Spectrometer': STRING,
-      'Dataset': STRING,
-      'Dispersive Direction': STRING,
-      'Energies and Exposures': (LIST, (FLOAT, STRING)),
-      'Filters': (LIST, STRING),
-      'Xtal Boundaries': (LIST, (INT, INT, INT, INT)),
-      })
+    parser = Parser(self.parser_info())
 
     header = []
     with open(filename, 'r') as f:
@@ -550,13 +663,7 @@ class Calibration(object):
     sname = parsed.get('Spectrometer')
     if sname:
       try:
-        if sname == os.path.basename(sname):
-          spect = Spectrometer(sname)
-        else:
-          spect = Spectrometer()
-          spect.load(sname)
-
-        self.spectrometer = spect
+        self.spectrometer = get_spectrometer(sname)
       except Exception as e:
         self.load_errors.append("Error loading spectrometer: %s" % str(e))
 
@@ -591,9 +698,12 @@ class Calibration(object):
         for x1,y1,x2,y2 in parsed.get('Xtal Boundaries', [])
         ]
 
+    if not header_only:
+      self._load_fit_points(filename)
+
     return len(self.load_errors) == 0
 
-  def calibrate(self, fit_type=FIT_QUARTIC, progress=ProgressIndicator()):
+  def calibrate(self, fit_type=FIT_QUARTIC, progress=ProgressIndicator(), nsigma=None):
     """
     Calculate calibration matrix
 
@@ -604,12 +714,23 @@ class Calibration(object):
                       each entry must be of the form [[x1,y1],[x2,y2]]
       self.filters may contain a list of mx.filter.Filter descendents to apply to the exposures
 
+    Parameters:
+      fit_type - type of fit (see fit_region)
+      progress - ProgressIndicator
+      nsigma - if given, spurious maxima are rejected by a robust fit (see calibrate())
+
     Results:
       self.calibration_matrix contains the calibration matrix
       self.lin_res contains average linear residuals of fit (one for each xtal)
       self.rms_res contains rms residuals of fit (one for each xtal)
       self.fit_points contains all detected peak values as array with columns (x,y,energy)
+      self.fit_regions contains the index of the xtal containing each fit point (-1 for none)
+      self.fit_rejected flags the fit points rejected by a robust fit
       self.fits contains a list of fit parameters (one for each xtal)
+
+      The fit points, their regions and the fits are saved alongside the
+      calibration (see fit_points_filename), so that residuals can be
+      calculated after loading it.
     """
     # load exposure files
     progress.push_step("Load Exposures", 0.1)
@@ -635,11 +756,14 @@ class Calibration(object):
                                                      self.dispersive_direction,
                                                      fit_type,
                                                      return_diagnostics=True,
-                                                     progress=progress)
+                                                     progress=progress,
+                                                     nsigma=nsigma)
     progress.pop_step()
 
     # store diagnostic info
-    self.lin_res, self.rms_res, self.fit_points, self.fits = diagnostics
+    self.lin_res, self.rms_res, self.fit_points, self.fits, self.fit_rejected = diagnostics
+    self.fit_regions = region_index(self.fit_points, self.xtals)
+    self.fit_type = fit_type
 
   def xtal_mask(self):
     """
@@ -669,7 +793,7 @@ class Calibration(object):
     """
     return (self.calibration_matrix[np.where(self.calibration_matrix > 0)].min(), self.calibration_matrix.max())
 
-  def diagnose(self, return_spectra=False, filters=None, progress=None):
+  def diagnose(self, return_spectra=False, filters=None, progress=None, refine=True, processes=1):
     """
     Process all calibration exposures and fit to gaussians, returning parameters of fit
 
@@ -691,6 +815,15 @@ class Calibration(object):
     Parameters
     ----------
     return_spectra: whether to return processed calibration spectra
+    filters: list of mx.filter.Filter descendents to apply to exposures
+    progress: optional ProgressIndicator
+    refine: if False, the closed form fits to the logarithm of the spectra
+            (see gauss.gauss_logparabola) are returned without refining
+            them by nonlinear least squares
+    processes: number of worker processes to refine fits with
+
+    All calibration exposures are processed in a single batch, and the
+    nonlinear fits start from the closed form ones.
 
     Returns
     -------
@@ -712,39 +845,50 @@ class Calibration(object):
     emin, emax = self.energy_range()
     emission_energies = np.arange(emin, emax, .2)
 
-    diagnostics = np.zeros((len(self.energies), 4))
+    n = len(self.energies)
+    diagnostics = np.zeros((n, 4))
 
-    if return_spectra:
-      spectra = []
+    if progress:
+      progress.update("Loading calibration exposures", 0)
+    stack = load_stack(self.exposure_files)
 
-    for i in range(len(self.energies)):
-      if progress:
-        msg = "Processing calibration exposure %d / %d" % (i, len(self.energies))
-        prog = i / float(len(self.energies))
-        progress.update(msg, prog)
+    if filters is not None:
+      for pixels, energy in izip(stack, self.energies):
+        for f in filters:
+          f.filter(pixels, energy)
 
-      energy = self.energies[i]
-      exposure = Exposure(self.exposure_files[i])
-      if filters is not None:
-        exposure.apply_filters(energy, filters)
+    if progress:
+      progress.update("Processing calibration exposures", 0.3)
+    s = emission.process_spectra(self.calibration_matrix, stack, emission_energies, 1, self.dispersive_direction, self.xtals)
+    x = emission_energies
+    y = s[:,:,1]
 
-      s = process_spectrum(self.calibration_matrix, exposure, emission_energies, 1, self.dispersive_direction, self.xtals)
-      x = s[:,0]
-      y = s[:,1]
+    if progress:
+      progress.update("Fitting elastic peaks", 0.6)
 
-      fit, ier = gauss_leastsq((x,y), (y.max(), energy, 1.0))
+    # closed form fits, falling back to moments where they fail
+    fits, valid = gauss_logparabola(x, y)
+    A, x0, sigma = gauss_moments(x, y)
+    fits[~valid] = np.vstack([A, x0, sigma]).T[~valid]
 
-      if not (0 < ier < 5):
-        continue
+    if refine:
+      results = gauss_leastsq_many(x, y, fits, processes)
+      ok = np.array([0 < ier < 5 for fit, ier in results], dtype=bool)
+      fits = np.array([fit for fit, ier in results]).reshape((-1, 3))
+    else:
+      ok = valid
 
-      diagnostics[i,0] = energy
-      diagnostics[i,1:] = fit
+    diagnostics[:,0] = self.energies
+    diagnostics[:,1:] = fits
+    diagnostics[~ok,0] = 0
 
-      if return_spectra:
-        xes = EmissionSpectrum()
-        xes.incident_energy = energy
-        xes.exposure_files = [exposure.filename]
-        xes._set_spectrum(s)
+    if return_spectra:
+      spectra = []
+      for i in np.flatnonzero(ok):
+        xes = emission.EmissionSpectrum()
+        xes.incident_energy = self.energies[i]
+        xes.exposure_files = [self.exposure_files[i]]
+        xes._set_spectrum(s[i])
         spectra.append(xes)
 
     diagnostics = diagnostics[np.where(diagnostics[:,0] != 0)]
@@ -759,19 +903,120 @@ class Calibration(object):
       raise Exception("A spectrometer must be set in order to generate a solid angle map")
     bounds = [(x1,y1,x2,y2) for (x1,y1),(x2,y2) in self.xtals]
     return self.spectrometer.solid_angle_map(bounds)
+
+  def _memoize(self, key, func):
+    """
+    Return func(), calculating it only if not already done for the current calibration
+
+    Results are discarded whenever the calibration matrix is replaced (e.g.
+    by `calibrate` or `load`), or the dispersive direction or xtals change.
+    """
+    state = (self.dispersive_direction, repr(self.xtals))
+    if (self._memo_key is None or self._memo_key[0] is not self.calibration_matrix or
+        self._memo_key[1] != state):
+      self._memo = {}
+      self._memo_key = (self.calibration_matrix, state)
+
+    if key not in self._memo:
+      self._memo[key] = func()
+    return self._memo[key]
+
+  def energy_width_map(self):
+    """
+    Calculate the emission energy width (in eV) covered by each pixel
+
+    See misc.energy_width_map. The map is only calculated once for a given
+    calibration, and may be used to weight pixels when processing (e.g. as
+    the `solid_angle` of emission.process_spectrum), so that spectra are
+    normalized per unit energy rather than per pixel.
+    """
+    return self._memoize(('energy_width_map',),
+        lambda: energy_width_map(self.calibration_matrix, self.xtals, self.dispersive_direction)).copy()
+
+  def collection_angle_map(self, d=None):
+    """
+    Calculate the angular acceptance (in radians) of each pixel in the dispersive direction
+
+    Parameters
+    ----------
+      d: lattice spacing of the reflecting planes (in angstroms)
+         (default: determined from the xtal type and cut of self.spectrometer)
+
+    See misc.collection_angle_correction. As with `energy_width_map`, the map
+    is only calculated once for a given calibration and may be used as a
+    per-pixel weighting when processing.
+    """
+    if d is None:
+      if not self.spectrometer or self.spectrometer.xtal_type not in lattice_constants:
+        raise Exception("A spectrometer with a known crystal type must be set in order to determine the lattice spacing")
+      d = lattice_constants[self.spectrometer.xtal_type] / np.linalg.norm(self.spectrometer.xtal_cut)
+
+    return self._memoize(('collection_angle_map', d),
+        lambda: collection_angle_correction(self, d)).copy()
       
   def calc_residuals(self):
-    if not hasattr(self, 'fit_points'):
+    """
+    Calculate residuals between fit and detected peaks
+
+    Returns
+    -------
+      list with one N x 3 array of (x coordinate, residual, energy) for each xtal
+    """
+    x, y, z, res = self._all_residuals()
+    order = np.argsort(self.fit_regions, kind='mergesort')
+    bounds = np.searchsorted(self.fit_regions[order], np.arange(len(self.xtals) + 1))
+
+    pts = np.vstack([x, res, z]).T[order]
+    return [pts[a:b] for a, b in izip(bounds[:-1], bounds[1:])]
+
+  def residual_stats(self, nsigma=2):
+    """
+    Calculate residual statistics of each xtal
+
+    Parameters
+    ----------
+      nsigma: points with residuals more than this many standard deviations
+              from the mean residual of their xtal are flagged as outliers
+
+    Returns
+    -------
+      (residuals, mean, sigma, outliers)
+
+      residuals: residual of each fit point (0 for points outside all xtals)
+      mean, sigma: mean and standard deviation of residuals of each xtal
+      outliers: boolean array flagging outlying fit points
+    """
+    x, y, z, res = self._all_residuals()
+    regions = self.fit_regions
+    inside = regions >= 0
+    num = len(self.xtals)
+
+    count = np.bincount(regions[inside], minlength=num).astype(float)
+    count[count == 0] = 1
+    mean = np.bincount(regions[inside], res[inside], num) / count
+    sigma = np.sqrt(np.clip(np.bincount(regions[inside], res[inside]**2, num) / count - mean**2, 0, None))
+
+    outliers = np.zeros(len(res), dtype=bool)
+    outliers[inside] = np.abs(res[inside] - mean[regions[inside]]) > nsigma * sigma[regions[inside]]
+
+    return res, mean, sigma, outliers
+
+  def _all_residuals(self):
+    """
+    Residuals of all fit points, evaluated with the fit of their xtal
+    """
+    if getattr(self, 'fit_points', None) is None:
       raise Exception("Fit points are not defined. Make sure you rerun the calibration before trying to calculate residuals.")
 
-    all_res = []
-    for i, ((x1,y1),(x2,y2)) in enumerate(self.xtals):
-      pts = np.array([(x,y,z) for x,y,z in self.fit_points if x1<=x<x2 and y1<=y<y2])
-      fit = evaluate_fit(self.fits[i], pts[:,0], pts[:,1])
+    if getattr(self, 'fit_regions', None) is None:
+      self.fit_regions = region_index(self.fit_points, self.xtals)
 
-      res = fit - pts[:,2]
+    x, y, z = self.fit_points.T
+    inside = self.fit_regions >= 0
 
-      # keep track of (xcoord, residual, energy)
-      all_res.append(np.vstack([pts[:,0], res, pts[:,2]]).T)
+    fits = np.array(self.fits)
+    res = np.zeros(len(z))
+    terms = design_matrix(x[inside], y[inside], self.fit_type)
+    res[inside] = (terms * fits[self.fit_regions[inside]]).sum(1) - z[inside]
 
-    return all_res
+    return x, y, z, res
@@ -0,0 +1,331 @@
+"""
+Catalog of processed data files
+
+Only the headers of calibration, XES and RIXS files are read (in parallel),
+and their metadata is stored in a local SQLite database. Refreshing the
+catalog only rereads files whose modification time or size has changed.
+
+Classes:
+  Catalog - SQLite index of file metadata
+
+Functions:
+  read_header - read the header lines of a file
+  read_entry - read the metadata of a file
+
+Example:
+  >>> import minixs as mx
+  >>> cat = mx.catalog.Catalog('archive.sqlite')
+  >>> cat.refresh(['/data/2012-02'], processes=8)
+  >>> cat.find(filetype=mx.filetype.FILE_XES, dataset='Fe2O3*')
+  ['/data/2012-02/fe2o3/fe2o3_7120.xes', ...]
+  >>> cat.entry('/data/2012-02/fe2o3/fe2o3_7120.xes')['incident_energy']
+  7120.0
+"""
+
+import os
+import sqlite3
+from multiprocessing import Pool
+
+from filetype import (determine_filetype_from_header, FILE_UNKNOWN,
+                      FILE_CALIBRATION, FILE_XES, FILE_RIXS)
+from parser import Parser
+from misc import open_compressed
+from calibrate import Calibration
+from emission import EmissionSpectrum, BINARY_MARKER
+from rixs import RIXS
+
+# files with these extensions are exposures, and are never opened
+EXPOSURE_EXTENSIONS = ['.tif', '.tiff', '.raw']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+  path TEXT PRIMARY KEY,
+  mtime REAL,
+  size INTEGER,
+  filetype INTEGER,
+  dataset TEXT,
+  spectrometer TEXT,
+  calibration_file TEXT,
+  incident_energy REAL,
+  I0 REAL
+);
+CREATE TABLE IF NOT EXISTS exposures (
+  path TEXT,
+  exposure TEXT,
+  energy REAL,
+  I0 REAL
+);
+CREATE TABLE IF NOT EXISTS filters (
+  path TEXT,
+  name TEXT,
+  value TEXT
+);
+CREATE INDEX IF NOT EXISTS exposures_path ON exposures (path);
+CREATE INDEX IF NOT EXISTS exposures_exposure ON exposures (exposure);
+CREATE INDEX IF NOT EXISTS filters_path ON filters (path);
+"""
+
+FIELDS = ['dataset', 'spectrometer', 'calibration_file', 'incident_energy', 'I0']
+
+PARSER_INFO = {
+    FILE_CALIBRATION: Calibration.parser_info(),
+    FILE_XES: EmissionSpectrum.parser_info(),
+    FILE_RIXS: RIXS.parser_info(),
+    }
+
+def read_header(path):
+  """
+  Read the header of a miniXS file
+
+  Returns:
+    (filetype, header lines with leading '# ' removed)
+
+    The header is empty for files that aren't calibration, XES or RIXS files.
+  """
+  f = open_compressed(path, 'r')
+  try:
+    # don't read all of a binary file looking for a newline
+    line = f.readline(1024)
+    filetype = determine_filetype_from_header(line)
+    if filetype not in PARSER_INFO:
+      return filetype, []
+
+    header = []
+    for line in f:
+      if line[0] != '#' or line.startswith(BINARY_MARKER):
+        break
+      header.append(line[2:])
+  finally:
+    f.close()
+
+  return filetype, header
+
+def read_entry(path):
+  """
+  Read metadata of a file from its header
+
+  Returns:
+    (path, mtime, size, filetype, fields, exposures, filters)
+
+    fields - dict of FIELDS
+    exposures - list of (exposure file, energy, I0)
+    filters - list of (name, value)
+
+    None is returned if the file no longer exists. Files whose header can't
+    be parsed are returned as FILE_UNKNOWN, with no metadata.
+  """
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+
+  fields = {}
+  exposures = []
+  filters = []
+
+  try:
+    filetype, header = read_header(path)
+  except IOError:
+    filetype, header = FILE_UNKNOWN, []
+
+  if header:
+    try:
+      _parse_header(filetype, header, fields, exposures, filters)
+    except (ValueError, TypeError, IndexError):
+      # a malformed header only affects its own file
+      filetype = FILE_UNKNOWN
+      fields, exposures, filters = {}, [], []
+
+  return (path, st.st_mtime, st.st_size, filetype, fields, exposures, filters)
+
+def _parse_header(filetype, header, fields, exposures, filters):
+  """
+  Helper function for read_entry, filling in fields, exposures and filters
+  """
+  parsed = Parser(PARSER_INFO[filetype]).parse(header)
+
+  fields['dataset'] = parsed.get('Dataset')
+  fields['spectrometer'] = parsed.get('Spectrometer')
+  fields['calibration_file'] = parsed.get('Calibration File')
+
+  if filetype == FILE_CALIBRATION:
+    exposures += [(f, e, None) for e, f in parsed.get('Energies and Exposures', [])]
+  elif filetype == FILE_XES:
+    fields['incident_energy'] = parsed.get('Incident Energy')
+    fields['I0'] = parsed.get('I0')
+    exposures += [(f, None, None) for f in parsed.get('Exposures', [])]
+  elif filetype == FILE_RIXS:
+    exposures += [(f, e, i) for e, i, f in parsed.get('Incident Energies / I0s / Exposures', [])]
+
+  for line in parsed.get('Filters', []):
+    name, _, value = line.partition(':')
+    filters.append((name.strip(), value.strip()))
+
+def _walk(directory):
+  for root, dirs, files in os.walk(directory):
+    dirs[:] = [d for d in dirs if not d.startswith('.')]
+    for name in files:
+      if name.startswith('.') or os.path.splitext(name)[1].lower() in EXPOSURE_EXTENSIONS:
+        continue
+      yield os.path.join(root, name)
+
+class Catalog(object):
+  """
+  SQLite index of calibration, XES and RIXS file metadata
+  """
+  def __init__(self, filename):
+    """
+    Parameters:
+      filename - database file (created if it doesn't exist)
+    """
+    self.filename = filename
+    self.db = sqlite3.connect(filename)
+    # paths are byte strings, which may not be valid unicode
+    self.db.text_factory = str
+    self.db.row_factory = sqlite3.Row
+    self.db.executescript(SCHEMA)
+
+  def close(self):
+    self.db.close()
+
+  def refresh(self, directories, processes=1, progress=None):
+    """
+    Add new and modified files in directories, and remove deleted ones
+
+    Parameters:
+      directories - list of directories to search (recursively)
+      processes - number of worker processes reading headers
+      progress - optional callback called as progress(num_read, num_to_read)
+
+    Returns:
+      (number of files read, number of files removed)
+    """
+    if isinstance(directories, basestring):
+      directories = [directories]
+    directories = [os.path.abspath(d) for d in directories]
+
+    known = dict((row[0], (row[1], row[2])) for row in
+                 self.db.execute("SELECT path, mtime, size FROM files"))
+    db_path = os.path.abspath(self.filename)
+
+    seen = set()
+    to_read = []
+    for d in directories:
+      for path in _walk(d):
+        if path == db_path:
+          continue
+        seen.add(path)
+        try:
+          st = os.stat(path)
+        except OSError:
+          continue
+        if known.get(path) != (st.st_mtime, st.st_size):
+          to_read.append(path)
+
+    removed = [path for path in known if path not in seen and
+               any(path.startswith(d + os.sep) for d in directories)]
+
+    if processes > 1 and len(to_read) > 1:
+      pool = Pool(processes)
+      try:
+        entries = pool.imap_unordered(read_entry, to_read, 64)
+        self._store(entries, removed, len(to_read), progress)
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      self._store((read_entry(path) for path in to_read), removed, len(to_read), progress)
+
+    return len(to_read), len(removed)
+
+  def _store(self, entries, removed, num, progress):
+    with self.db:
+      for path in removed:
+        self._delete(path)
+
+      for i, entry in enumerate(entries):
+        if entry is None:
+          continue
+
+        path, mtime, size, filetype, fields, exposures, filters = entry
+        self._delete(path)
+        self.db.execute("INSERT INTO files (path, mtime, size, filetype, %s) VALUES (?, ?, ?, ?, %s)" %
+                        (', '.join(FIELDS), ', '.join('?' * len(FIELDS))),
+                        [path, mtime, size, filetype] + [fields.get(k) for k in FIELDS])
+        self.db.executemany("INSERT INTO exposures VALUES (?, ?, ?, ?)",
+                            [(path,) + tuple(e) for e in exposures])
+        self.db.executemany("INSERT INTO filters VALUES (?, ?, ?)",
+                            [(path,) + tuple(f) for f in filters])
+        if progress:
+          progress(i + 1, num)
+
+  def _delete(self, path):
+    for table in ('files', 'exposures', 'filters'):
+      self.db.execute("DELETE FROM %s WHERE path = ?" % table, (path,))
+
+  def find(self, filetype=None, dataset=None, calibration_file=None,
+           exposure=None, energy_range=None):
+    """
+    Find cataloged files
+
+    Parameters:
+      filetype - one of the mx.filetype FILE_* constants
+      dataset - glob pattern of dataset name
+      calibration_file - glob pattern of calibration file
+      exposure - glob pattern of an exposure used by the file
+      energy_range - (min, max) incident energy of the file (or of any of
+                     its exposures)
+
+    Returns:
+      sorted list of paths
+    """
+    where = []
+    args = []
+
+    if filetype is None:
+      where.append("filetype != ?")
+      args.append(FILE_UNKNOWN)
+    else:
+      where.append("filetype = ?")
+      args.append(filetype)
+
+    if dataset is not None:
+      where.append("dataset GLOB ?")
+      args.append(dataset)
+
+    if calibration_file is not None:
+      where.append("calibration_file GLOB ?")
+      args.append(calibration_file)
+
+    if exposure is not None:
+      where.append("EXISTS (SELECT 1 FROM exposures e WHERE e.path = files.path AND e.exposure GLOB ?)")
+      args.append(exposure)
+
+    if energy_range is not None:
+      where.append("(incident_energy BETWEEN ? AND ? OR "
+                   "EXISTS (SELECT 1 FROM exposures e WHERE e.path = files.path AND e.energy BETWEEN ? AND ?))")
+      args += list(energy_range) * 2
+
+    query = "SELECT path FROM files WHERE %s ORDER BY path" % ' AND '.join(where)
+    return [row[0] for row in self.db.execute(query, args)]
+
+  def entry(self, path):
+    """
+    Get cataloged metadata of a file
+
+    Returns:
+      dict with keys 'path', 'mtime', 'size', 'filetype', FIELDS,
+      'exposures' (list of (exposure, energy, I0)) and 'filters' (list of (name, value)),
+      or None if the file is not in the catalog
+    """
+    path = os.path.abspath(path)
+    row = self.db.execute("SELECT * FROM files WHERE path = ?", (path,)).fetchone()
+    if row is None:
+      return None
+
+    entry = dict(zip(row.keys(), row))
+    entry['exposures'] = [tuple(r) for r in self.db.execute(
+        "SELECT exposure, energy, I0 FROM exposures WHERE path = ? ORDER BY rowid", (path,))]
+    entry['filters'] = [tuple(r) for r in self.db.execute(
+        "SELECT name, value FROM filters WHERE path = ? ORDER BY rowid", (path,))]
+    return entry
@@ -0,0 +1,265 @@
+"""
+Per-pixel correction maps
+
+Maps (solid angle, flat field, efficiency, dark) are arrays with the same
+shape as the detector. They may be stored either as text (as written by
+np.savetxt) or in numpy's binary .npy format. Binary maps are memory mapped
+when loaded, and all maps are cached by path (and modification time), so
+that repeated loads are essentially free.
+
+Classes:
+  CorrectionMaps - a set of dark, flat field and efficiency maps
+
+Functions:
+  load_map - load (cached) map from file
+  save_map - save map in binary format
+  is_binary_map - check whether map file is in binary format
+  resolve_map_path - find map file
+  normalize_map_path - convert map filename for saving in a header
+"""
+
+import os
+import numpy as np
+from parser import STRING
+
+MAP_DATADIR = os.path.join(os.path.dirname(__file__), 'data')
+
+# first bytes of a file written by np.save
+NPY_MAGIC = '\x93NUMPY'
+
+# path => (mtime, map)
+_map_cache = {}
+
+def resolve_map_path(map_file):
+  """
+  Find the full path to a map file
+
+  The map file must either be a full path, or relative to the minixs data
+  directory.
+  """
+  if os.path.exists(map_file):
+    return os.path.abspath(map_file)
+
+  path = os.path.join(MAP_DATADIR, map_file)
+  if os.path.exists(path):
+    return path
+
+  raise IOError("Map file not found: '%s'. This must either be a full path, or relative to the minixs data directory." % map_file)
+
+def normalize_map_path(map_file):
+  """
+  Make map filename suitable for saving in a header
+
+  Files that exist relative to the current directory are converted to
+  absolute paths. Others are assumed to be relative to the minixs data
+  directory and are left unchanged.
+  """
+  if map_file and os.path.exists(map_file):
+    return os.path.abspath(map_file)
+  return map_file
+
+def load_map(map_file):
+  """
+  Load a per-pixel map
+
+  Parameters:
+    map_file - filename of map (see `resolve_map_path`)
+
+  Returns:
+    read only array
+
+  Binary (.npy format) files are memory mapped. All others are read as
+  text. Maps are cached, and only reloaded if the file has been modified.
+  """
+  path = resolve_map_path(map_file)
+  mtime = os.path.getmtime(path)
+
+  cached = _map_cache.get(path)
+  if cached is not None and cached[0] == mtime:
+    return cached[1]
+
+  if is_binary_map(path):
+    m = np.load(path, mmap_mode='r')
+  else:
+    m = np.loadtxt(path)
+    m.flags.writeable = False
+
+  _map_cache[path] = (mtime, m)
+  return m
+
+def is_binary_map(path):
+  """
+  Determine whether a map file was saved in binary format
+  """
+  with open(path, 'rb') as f:
+    return f.read(len(NPY_MAGIC)) == NPY_MAGIC
+
+def save_map(filename, m):
+  """
+  Save a per-pixel map in binary (.npy) format
+
+  Parameters:
+    filename - filename or file handle opened for writing
+    m - map to save
+  """
+  if hasattr(filename, 'write'):
+    np.save(filename, np.asarray(m, dtype=float))
+  else:
+    # np.save would append '.npy' to names without it
+    with open(filename, 'wb') as f:
+      np.save(f, np.asarray(m, dtype=float))
+
+def clear_cache():
+  """
+  Forget all cached maps
+  """
+  _map_cache.clear()
+
+class CorrectionMaps(object):
+  """
+  Per-pixel intensity corrections
+
+  Each exposure is corrected as
+
+    corrected = (counts - dark) / (flat * efficiency)
+
+  This is precomputed as a gain and offset, so that applying the correction
+  costs a single multiply-add:
+
+    corrected = counts * gain - offset
+
+  Any map that is not set is ignored. The dark map is intended for small
+  offsets. Pixels that end up with negative values, and pixels with no
+  response (a flat field or efficiency of 0), are skipped during processing
+  (see emission.process_spectrum).
+
+  Instance Variables:
+    dark_map_file       - filename of map of counts to subtract
+    flat_map_file       - filename of relative pixel response map
+    efficiency_map_file - filename of detection efficiency map
+  """
+
+  # (header key, attribute name)
+  HEADERS = [
+      ('Dark Map', 'dark_map_file'),
+      ('Flat Field Map', 'flat_map_file'),
+      ('Efficiency Map', 'efficiency_map_file'),
+      ]
+
+  def __init__(self, dark_map_file=None, flat_map_file=None, efficiency_map_file=None):
+    self.dark_map_file = dark_map_file
+    self.flat_map_file = flat_map_file
+    self.efficiency_map_file = efficiency_map_file
+
+    self._coefficients = None
+    self._coefficients_key = None
+
+  def is_empty(self):
+    return not (self.dark_map_file or self.flat_map_file or self.efficiency_map_file)
+
+  def _key(self):
+    """
+    Identify the current maps, including their modification times
+    """
+    key = []
+    for name in (self.dark_map_file, self.flat_map_file, self.efficiency_map_file):
+      if name:
+        path = resolve_map_path(name)
+        key.append((path, os.path.getmtime(path)))
+      else:
+        key.append(None)
+    return tuple(key)
+
+  def coefficients(self):
+    """
+    Calculate gain and offset maps
+
+    Returns:
+      (gain, offset, bad)
+
+      gain and offset may be None if the corresponding maps are not set.
+      bad is a boolean array of pixels with no response (whose gain is
+      NaN), or None if there are none.
+    """
+    key = self._key()
+    if self._coefficients is not None and self._coefficients_key == key:
+      return self._coefficients
+
+    gain = None
+    with np.errstate(divide='ignore', invalid='ignore'):
+      if self.flat_map_file:
+        gain = 1.0 / load_map(self.flat_map_file)
+      if self.efficiency_map_file:
+        eff = load_map(self.efficiency_map_file)
+        if gain is None:
+          gain = 1.0 / eff
+        else:
+          gain /= eff
+
+    # pixels with no response have no meaningful counts
+    bad = None
+    if gain is not None:
+      bad = ~np.isfinite(gain)
+      if bad.any():
+        gain[bad] = np.nan
+      else:
+        bad = None
+
+    offset = None
+    if self.dark_map_file:
+      offset = np.array(load_map(self.dark_map_file), dtype=float)
+      if gain is not None:
+        offset *= gain
+
+    self._coefficients = (gain, offset, bad)
+    self._coefficients_key = key
+    return self._coefficients
+
+  def apply(self, pixels):
+    """
+    Apply correction to an array of pixels
+
+    Returns:
+      corrected array of floats (NaN for pixels with no response)
+    """
+    gain, offset, bad = self.coefficients()
+    corrected = np.array(pixels, dtype=float)
+    if gain is not None:
+      corrected *= gain
+    if offset is not None:
+      corrected -= offset
+    return corrected
+
+  def write_header(self, f):
+    """
+    Write header lines for all maps that are set
+    """
+    for key, attr in self.HEADERS:
+      name = getattr(self, attr)
+      if name:
+        f.write("# %s: %s\n" % (key, name))
+
+  @classmethod
+  def parser_info(cls):
+    """
+    Parser key types for map headers
+    """
+    return dict((key, STRING) for key, attr in cls.HEADERS)
+
+  def read_header(self, parsed):
+    """
+    Set map filenames from parsed header
+
+    Returns:
+      list of errors encountered while loading maps
+    """
+    errors = []
+    for key, attr in self.HEADERS:
+      name = parsed.get(key)
+      setattr(self, attr, name)
+      if name:
+        try:
+          load_map(name)
+        except IOError as e:
+          errors.append(str(e))
+    return errors
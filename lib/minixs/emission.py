@@ -6,7 +6,12 @@ Classes:
 
 Functions:
   load - load EmissionSpectrum (deprecated)
+  load_spectra - load many emission spectra into a single array
+  average_spectra - average emission spectra on a common grid
   process_spectrum - main processing routine
+  process_spectra - process a stack of exposures at once
+  interp_columns - linearly interpolate many rows/columns at once
+  dispersive_slices - extract a crystal region as rows/columns along the dispersive direction
   binned_emission_spectrum - alternative processing routine
 """
 
@@ -17,6 +22,7 @@ import minixs as mx
 import calibrate
 from exposure import Exposure
 from filter import  get_filter_by_name
+from correction import CorrectionMaps, load_map
 from parser import Parser, STRING, FLOAT, LIST
 
 from itertools import izip
@@ -25,7 +31,234 @@ def load(filename):
   """Load EmissionSpectrum from file"""
   return EmissionSpectrum(filename)
 
-def process_spectrum(cal, exposure, energies, I0, direction, xtals, solid_angle=None, skip_columns=[], killzone_mask=None):
+# header line preceding the spectrum of files saved in binary format
+BINARY_MARKER = '# Binary Spectrum: '
+
+def load_spectra(filenames):
+  """
+  Load many emission spectra at once
+
+  Parameters:
+    filenames - list of XES files (text or binary)
+
+  Returns:
+    (spectra, data)
+
+    spectra - list of EmissionSpectrum
+    data - N x points x 5 array of all spectra, or None if they don't all
+           have the same number of points
+
+  When `data` is not None, the spectrum of each EmissionSpectrum is a view
+  into it. Solid angle maps shared by several spectra are only loaded once.
+  """
+  maps = {}
+  spectra = []
+  for filename in filenames:
+    xes = EmissionSpectrum()
+    xes.load(filename, solid_angle_maps=maps)
+    spectra.append(xes)
+
+  shapes = set(xes.spectrum.shape for xes in spectra)
+  if len(shapes) != 1:
+    return spectra, None
+
+  data = np.empty((len(spectra),) + shapes.pop())
+  for d, xes in izip(data, spectra):
+    d[...] = xes.spectrum
+    xes._set_spectrum(d)
+
+  return spectra, data
+
+def _common_value(values, default):
+  values = list(values)
+  if all(v == values[0] for v in values):
+    return values[0]
+  return default
+
+def average_spectra(spectra, emission_energies=None, weight_by_I0=False):
+  """
+  Average emission spectra
+
+  Parameters:
+    spectra - list of EmissionSpectrum (or of filenames)
+    emission_energies - emission energy grid of average (default: grid of
+                        first spectrum)
+    weight_by_I0 - if True, each spectrum is weighted by its I0, so that the
+                   average is the total intensity divided by the total I0.
+                   Otherwise all spectra are weighted equally.
+
+  Returns:
+    EmissionSpectrum
+
+  If all spectra share the requested grid, they are averaged directly.
+  Otherwise they are all linearly interpolated onto the grid at once.
+  Points outside of the range of a spectrum do not contribute to the
+  average there.
+
+  Variances are averaged with the squares of the weights, and raw counts and
+  numbers of pixels (or solid angles) of all spectra are summed. The I0 of
+  the average is the total I0 when weighting by I0, and the mean I0
+  otherwise.
+  """
+  if len(spectra) == 0:
+    raise ValueError("No spectra to average")
+
+  if isinstance(spectra[0], basestring):
+    spectra, data = load_spectra(spectra)
+  else:
+    data = None
+    if len(set(xes.spectrum.shape for xes in spectra)) == 1:
+      data = np.array([xes.spectrum for xes in spectra])
+
+  if emission_energies is None:
+    emission_energies = spectra[0].emission
+  emission_energies = np.asarray(emission_energies, dtype=float)
+
+  I0s = np.array([xes.I0 for xes in spectra], dtype=float)
+  if weight_by_I0:
+    weights = I0s
+  else:
+    weights = np.ones(len(spectra))
+
+  if (data is not None and data.shape[1] == len(emission_energies) and
+      (data[:,:,0] == emission_energies).all()):
+    intensity = data[:,:,1]
+    variance = data[:,:,2]**2
+    raw_counts = data[:,:,3]
+    num_pixels = data[:,:,4]
+    valid = np.ones(intensity.shape, dtype=bool)
+  else:
+    # pad shorter spectra by repeating their last point, so that all can be
+    # interpolated with a single call
+    num_points = max(len(xes.spectrum) for xes in spectra)
+    padded = np.array([np.pad(xes.spectrum, ((0, num_points - len(xes.spectrum)), (0, 0)), 'edge')
+                       for xes in spectra])
+    xp = padded[:,:,0]
+    intensity, valid = interp_columns(emission_energies, xp, padded[:,:,1])
+    variance = interp_columns(emission_energies, xp, padded[:,:,2]**2)[0]
+    raw_counts = interp_columns(emission_energies, xp, padded[:,:,3])[0]
+    num_pixels = interp_columns(emission_energies, xp, padded[:,:,4])[0]
+
+  w = weights[:,np.newaxis] * valid
+  total = w.sum(0)
+  # points no spectrum covers stay 0
+  total[total == 0] = 1
+
+  xes = EmissionSpectrum()
+  xes.dataset_name = _common_value((x.dataset_name for x in spectra), '')
+  xes.calibration_file = _common_value((x.calibration_file for x in spectra), '')
+  incident_energies = [x.incident_energy for x in spectra]
+  xes.incident_energy = _common_value(incident_energies, np.dot(incident_energies, weights) / weights.sum())
+  xes.I0 = I0s.sum() if weight_by_I0 else I0s.mean()
+  if _common_value((x.solid_angle_map_file for x in spectra), None):
+    xes.solid_angle_map_file = spectra[0].solid_angle_map_file
+    xes.solid_angle_map = spectra[0].solid_angle_map
+  xes.exposure_files = [f for x in spectra for f in (x.exposure_files or [])]
+
+  xes._set_spectrum(np.vstack([
+    emission_energies,
+    (w * intensity).sum(0) / total,
+    np.sqrt((w**2 * variance).sum(0)) / total,
+    (valid * raw_counts).sum(0),
+    (valid * num_pixels).sum(0),
+    ]).T)
+
+  return xes
+
+KILLZONE_SKIP_COLUMNS = 0
+KILLZONE_SKIP_PIXELS = 1
+
+def dispersive_slices(arr, xtal, direction):
+  """
+  Extract the region of `arr` covered by `xtal` as a 2D array of columns
+
+  Parameters
+  ----------
+  arr : 2D array with the shape of the camera (e.g. calibration matrix or exposure)
+  xtal : crystal rect [(x1,y1), (x2,y2)]
+  direction : dispersive direction (minixs.DOWN, UP, LEFT or RIGHT)
+
+  Returns
+  -------
+  (index, block)
+
+  index : camera column (for vertical dispersive direction) or row (for
+          horizontal) of each entry in `block`
+  block : N x M array, with one row for each column (row) of the camera region,
+          ordered along the direction of increasing energy
+
+  The returned block is a view into `arr` whenever possible.
+  """
+  (x1,y1), (x2,y2) = xtal
+  region = arr[y1:y2,x1:x2]
+
+  if direction == mx.DOWN:
+    return np.arange(x1,x2), region.T
+  elif direction == mx.UP:
+    return np.arange(x1,x2), region[::-1].T
+  elif direction == mx.RIGHT:
+    return np.arange(y1,y2), region
+  elif direction == mx.LEFT:
+    return np.arange(y1,y2), region[:,::-1]
+  else:
+    raise Exception("Invalid direction.")
+
+def interp_columns(x, xp, fp, xp_mask=None):
+  """
+  Linearly interpolate many data sets onto a common grid at once
+
+  This is equivalent to calling np.interp(x, xp[i], fp[i]) for each row `i`
+  of `xp` and `fp`, but is performed with a single call.
+
+  Parameters
+  ----------
+  x : points to interpolate at (length K)
+  xp : N x M array of increasing x coordinates (one data set per row)
+  fp : N x M array of corresponding y values
+  xp_mask : optional N x M boolean array of points to exclude
+
+  Returns
+  -------
+  (y, valid)
+
+  y : N x K array of interpolated values
+  valid : N x K boolean array, True where x lies within the range of the
+          corresponding data set and neither point bounding it is excluded
+          by `xp_mask`
+
+  Entries of `y` that are not valid are set to 0.
+  """
+  x = np.asarray(x, dtype=float)
+  xp = np.asarray(xp, dtype=float)
+  n, m = xp.shape
+
+  if n == 0 or m == 0 or len(x) == 0:
+    return np.zeros((n, len(x))), np.zeros((n, len(x)), dtype=bool)
+
+  # shift each row into its own disjoint range, so that all rows can be
+  # interpolated by a single call on the flattened arrays
+  lo = min(xp.min(), x.min())
+  span = max(xp.max(), x.max()) - lo + 1
+  offset = span * np.arange(n)[:,np.newaxis]
+
+  flat_xp = (xp - lo + offset).ravel()
+  flat_x = ((x - lo) + offset).ravel()
+
+  y = np.interp(flat_x, flat_xp, np.ravel(fp)).reshape((n, len(x)))
+
+  # points outside of a row's range would be interpolated between
+  # neighboring rows
+  valid = np.logical_and(x >= xp[:,:1], x <= xp[:,-1:])
+
+  # any point bounded by a masked point receives a nonzero weight from it
+  if xp_mask is not None:
+    masked = np.interp(flat_x, flat_xp, np.ravel(xp_mask).astype(float))
+    valid &= masked.reshape((n, len(x))) == 0
+
+  y[~valid] = 0
+  return y, valid
+
+def process_spectrum(cal, exposure, energies, I0, direction, xtals, solid_angle=None, skip_columns=[], killzone_mask=None, killzone_mode=KILLZONE_SKIP_COLUMNS, correction=None, xtal_masks=None):
   """Interpolated emission spectrum
 
   Parameters
@@ -37,82 +270,99 @@ def process_spectrum(cal, exposure, energies, I0, direction, xtals, solid_angle=
   direction: dispersive direction (minixs.HORIZONTAL or minixs.VERTICAL)
   xtals: list of crystal rects [ [(10,5), (200, 120)], [...] ]
   solid_angle: an array giving the solid angle subtended by each pixel
+  skip_columns: columns (for vertical disp. dir.) or rows (for horizontal) to skip entirely
+  killzone_mask: boolean array of pixels to exclude
+  killzone_mode: how to exclude killzoned pixels
+    KILLZONE_SKIP_COLUMNS - skip every row/column containing a killzoned pixel
+    KILLZONE_SKIP_PIXELS  - only drop the killzoned pixels themselves. The
+                            rest of the row/column still contributes at all
+                            energies not bounded by a killzoned pixel.
+  correction: optional CorrectionMaps to apply to exposure pixels (pixels
+              with no response are dropped, as for KILLZONE_SKIP_PIXELS)
+  xtal_masks: boolean array of pixels illuminated by the crystals, or a
+              sequence of such arrays (one per entry in `xtals`), e.g. from
+              Spectrometer.xtal_masks(). Pixels outside of the masks are
+              dropped, as for KILLZONE_SKIP_PIXELS.
 
   If solid_angle is not given, then it is effectively an array of ones
+
+  Each row/column is interpolated onto `energies` and only contributes to
+  `num_pixels` (or the interpolated solid angle) at those energies for which
+  it contributes intensity, so the normalization remains correct when
+  killzoned pixels are dropped.
   """
 
+  energies = np.asarray(energies)
   intensity = np.zeros(energies.shape)
-  mask = np.zeros(energies.shape)
   num_pixels = np.zeros(energies.shape)
 
-  #variance = np.zeros(energies.shape)
-  #y_i = np.zeros(energies.shape)
-  #var_i = np.zeros(energies.shape)
+  if killzone_mask is not None:
+    killzone_mask = np.asarray(killzone_mask, dtype=bool)
 
-  for xtal in xtals:
-    (x1,y1), (x2,y2) = xtal
+  if xtal_masks is not None:
+    xtal_masks = np.asarray(xtal_masks, dtype=bool)
 
-    if direction == mx.DOWN or direction == mx.UP:
-      i1, i2 = x1, x2
-    else:
-      i1, i2 = y1, y2
-
-    for i in range(i1,i2):
-      if i in skip_columns:
-        #sys.stderr.write("skipping %d\n" % i)
-        continue
-
-      # if any part of this row/column has been killzoned, skip it
-      if killzone_mask is not None:
-        if direction == mx.DOWN or direction == mx.UP:
-          if np.any(killzone_mask[y1:y2,i]):
-            continue
-        else:
-          if np.any(killzone_mask[i,x1:x2]):
-            continue
-
-      # select one row/column of calibration matrix and correspond row/column of spectrum exposure
-      # XXX this is untested for UP and RIGHT, but *should* be correct
-      if direction == mx.DOWN:
-        dE = cal[y1:y2,i]
-        dI = exposure.pixels[y1:y2,i]
-        if solid_angle is not None:
-          dS = solid_angle[y1:y2,i]
-      elif direction == mx.UP:
-        dE = cal[y2-1:y1-1:-1,i]
-        dI = exposure.pixels[y2-1:y1-1:-1,i]
-        if solid_angle is not None:
-          dS = solid_angle[y2-1:y1-1:-1,i]
-      elif direction == mx.RIGHT:
-        dE = cal[i, x1:x2]
-        dI = exposure.pixels[i, x1:x2]
-        if solid_angle is not None:
-          dS = solid_angle[i, x1:x2]
-      elif direction == mx.LEFT:
-        dE = cal[i, x2-1:x1-1:-1]
-        dI = exposure.pixels[i, x2-1:x1-1:-1]
-        if solid_angle is not None:
-          dS = solid_angle[i, x2-1:x1-1:-1]
-      else:
-        raise Exception("Invalid direction.")
-
-      # XXX: the following uses a quick method that overestimates statistical error
-      #      to correctly propogate error, use interp_poisson() (which is much slower at the moment)
-      #      this should be made optional so that one can do quick processing at the beamline
-      #      and then get correct errorbars later
-      #      (i should also characterize how incorrect the errors are...)
-      #      example: interp_poisson(energies, y_i, var_i, dE, dI,-1,-1)
-      y_i = np.interp(energies, dE, dI,-1,-1)
-      mask *= 0
-      mask[np.where(y_i >= 0)] = 1
-      intensity += y_i * mask
-      if solid_angle is not None:
-        s_i = np.interp(energies, dE, dS, -1,-1)
-        num_pixels += mask * s_i
-      else:
-        num_pixels += mask
+  gain = offset = bad = None
+  if correction is not None:
+    gain, offset, bad = correction.coefficients()
+
+  for i, xtal in enumerate(xtals):
+    index, dE = dispersive_slices(cal, xtal, direction)
+    dI = dispersive_slices(exposure.pixels, xtal, direction)[1]
+
+    # only correct the pixels that are used
+    if gain is not None:
+      dI = dI * dispersive_slices(gain, xtal, direction)[1]
+    if offset is not None:
+      dI = dI - dispersive_slices(offset, xtal, direction)[1]
 
-      #variance += var_i * mask
+    # select rows/columns that contribute at all
+    use = np.ones(len(index), dtype=bool)
+    if len(skip_columns) > 0:
+      use &= ~np.in1d(index, skip_columns)
+
+    exclude = None
+    if xtal_masks is not None:
+      xtal_mask = xtal_masks if xtal_masks.ndim == 2 else xtal_masks[i]
+      exclude = ~dispersive_slices(xtal_mask, xtal, direction)[1]
+      # rows/columns that don't cross the footprint don't contribute at all
+      use &= ~exclude.all(1)
+
+    # pixels with no response are dropped, like killzoned pixels
+    if bad is not None:
+      dead = dispersive_slices(bad, xtal, direction)[1]
+      dI = np.where(dead, 0, dI)
+      exclude = dead if exclude is None else exclude | dead
+
+    if killzone_mask is not None:
+      kz = dispersive_slices(killzone_mask, xtal, direction)[1]
+      if killzone_mode == KILLZONE_SKIP_PIXELS:
+        exclude = kz if exclude is None else exclude | kz
+      else:
+        # if any part of this row/column has been killzoned, skip it
+        use &= ~kz.any(1)
+
+    pixel_mask = None
+    if exclude is not None:
+      pixel_mask = exclude[use]
+
+    # XXX: the following uses a quick method that overestimates statistical error
+    #      to correctly propogate error, use interp_poisson() (which is much slower at the moment)
+    #      this should be made optional so that one can do quick processing at the beamline
+    #      and then get correct errorbars later
+    #      (i should also characterize how incorrect the errors are...)
+    y, mask = interp_columns(energies, dE[use], dI[use], pixel_mask)
+
+    # negative counts (e.g. pixels flagged by the detector) don't contribute
+    mask &= y >= 0
+    intensity += (y * mask).sum(0)
+
+    if solid_angle is not None:
+      dS = dispersive_slices(solid_angle, xtal, direction)[1]
+      s, _ = interp_columns(energies, dE[use], dS[use], pixel_mask)
+      num_pixels += (s * mask).sum(0)
+    else:
+      num_pixels += mask.sum(0)
 
   # if num_pixels is 0, then intensity will also be 0, so divide by 1 instead of 0 to avoid NaN
   norm = num_pixels.copy()
@@ -121,6 +371,67 @@ def process_spectrum(cal, exposure, energies, I0, direction, xtals, solid_angle=
   # create N x 5 array with columns: energy, normalized intensity, uncertainty, raw counts, number of rows/columns contributing
   return np.vstack([energies, intensity/I0/norm, np.sqrt(intensity)/I0/norm, intensity, num_pixels]).T
 
+def process_spectra(cal, stack, energies, I0s, direction, xtals, solid_angle=None):
+  """Interpolated emission spectra of many exposures at once
+
+  Parameters
+  ----------
+  cal : calibration matrix
+  stack : N x height x width array of exposure pixels (e.g. from exposure.load_stack)
+  energies : list of emission energies for desired spectra
+  I0s : intensity normalization value (one for all exposures, or one for each)
+  direction : dispersive direction
+  xtals : list of crystal rects
+  solid_angle : an array giving the solid angle subtended by each pixel
+
+  Returns
+  -------
+  N x len(energies) x 5 array, with one spectrum per exposure (see process_spectrum)
+
+  Each crystal's rows/columns of all exposures are interpolated with a
+  single call. The result is the same as calling process_spectrum on each
+  exposure, which also supports killzones, corrections and crystal masks.
+  """
+  stack = np.asarray(stack)
+  energies = np.asarray(energies, dtype=float)
+  n, k = len(stack), len(energies)
+
+  intensity = np.zeros((n, k))
+  num_pixels = np.zeros((n, k))
+
+  for xtal in xtals:
+    index, dE = dispersive_slices(cal, xtal, direction)
+    dI = np.array([dispersive_slices(pixels, xtal, direction)[1] for pixels in stack])
+
+    num_rows, m = dE.shape
+    y, mask = interp_columns(energies, np.tile(dE, (n, 1)), dI.reshape((n * num_rows, m)))
+    y = y.reshape((n, num_rows, k))
+    mask = mask.reshape((n, num_rows, k))
+
+    # negative counts (e.g. pixels flagged by the detector) don't contribute
+    mask &= y >= 0
+    intensity += (y * mask).sum(1)
+
+    if solid_angle is not None:
+      dS = dispersive_slices(solid_angle, xtal, direction)[1]
+      s, _ = interp_columns(energies, dE, dS)
+      num_pixels += (s * mask).sum(1)
+    else:
+      num_pixels += mask.sum(1)
+
+  norm = num_pixels.copy()
+  norm[np.where(norm == 0)] = 1
+
+  I0s = np.asarray(I0s, dtype=float).reshape((-1, 1))
+
+  spectra = np.empty((n, k, 5))
+  spectra[:,:,0] = energies
+  spectra[:,:,1] = intensity / I0s / norm
+  spectra[:,:,2] = np.sqrt(intensity) / I0s / norm
+  spectra[:,:,3] = intensity
+  spectra[:,:,4] = num_pixels
+  return spectra
+
 def binned_emission_spectrum(calib, exposure, low_energy, high_energy, energy_step, I0):
   """
   Calculate emission spectrum from exposure and calibration matrix
@@ -225,6 +536,7 @@ class EmissionSpectrum(object):
     filters          - list of mx.filter.Filter descendents to apply to exposures
     solid_angle_map  - map of solid angle subtended by each pixel
     solid_angle_map_file - filename of solid angle map
+    corrections      - CorrectionMaps (dark, flat field and efficiency maps) to apply to exposures
 
     spectrum         - XES spectrum (5 columns: emission energy, intensity, I0, raw counts and number of contributing pixels)
     emission         - 1st column of spectrum (emission energies)
@@ -249,6 +561,7 @@ class EmissionSpectrum(object):
     self.I0 = 1
     self.solid_angle_map_file = None
     self.solid_angle_map = None
+    self.corrections = CorrectionMaps()
     self.exposure_files = []
     self.filters = []
 
@@ -271,18 +584,20 @@ class EmissionSpectrum(object):
     self.raw_counts = self.spectrum[:,3]
     self.num_pixels = self.spectrum[:,4]
  
-  def save(self, filename=None, header_only=False):
+  def save(self, filename=None, header_only=False, binary=False):
     """
     Save emission spectrum
 
     Parameters:
       filename - either filename or file handle opened for writing
       header_only - if True, only header is saved, not spectrum
+      binary - if True, the spectrum is saved as a block of little endian
+               doubles following the (text) header, instead of as text
     """
     if filename is None:
       filename = self.filename
 
-    with mx.misc.to_filehandle(filename, "w") as (f, filename):
+    with mx.misc.to_filehandle(filename, "wb" if binary else "w") as (f, filename):
       if filename:
         self.filename = filename
 
@@ -293,6 +608,7 @@ class EmissionSpectrum(object):
       f.write("# I0: %.2f\n" % self.I0)
       if self.solid_angle_map_file:
         f.write("# Solid Angle Map: %s\n" % self.solid_angle_map_file)
+      self.corrections.write_header(f)
       if self.filters:
         f.write("# Filters:\n")
         for fltr in self.filters:
@@ -310,18 +626,44 @@ class EmissionSpectrum(object):
 
         if self.solid_angle_map is None:
           f.write("# E_emission    Intensity  Uncertainty  Raw_Counts   Num_Pixels\n")
-          np.savetxt(f, self.spectrum, fmt=('%12.2f','%.6e','%.6e','% 11d',' % 11d'))
+          fmt = ('%12.2f','%.6e','%.6e','% 11d',' % 11d')
         else:
           f.write("# E_emission    Intensity  Uncertainty  Raw_Counts   Solid_Angle\n")
-          np.savetxt(f, self.spectrum, fmt=('%12.2f','%.6e','%.6e','% 11d',' %.6e'))
+          fmt = ('%12.2f','%.6e','%.6e','% 11d',' %.6e')
+
+        if binary:
+          f.write("%s%d\n" % (BINARY_MARKER, len(self.spectrum)))
+          f.write(np.asarray(self.spectrum, dtype='<f8').tostring())
+        else:
+          np.savetxt(f, self.spectrum, fmt=fmt)
 
-  def load(self, filename=None, header_only=False):
+  @classmethod
+  def parser_info(cls):
+    """
+    Parser key types for emission spectrum headers
+    """
+    info = {
+      'Dataset': STRING,
+      'Calibration File': STRING,
+      'Incident Energy': FLOAT,
+      'I0': FLOAT,
+      'Solid Angle Map': STRING,
+      'Filters': (LIST, STRING),
+      'Exposures': (LIST, STRING)
+      }
+    info.update(CorrectionMaps.parser_info())
+    return info
+
+  def load(self, filename=None, header_only=False, solid_angle_maps=None):
     """
     Load emission spectrum from file
 
     Paramaters:
-      filename - filename to load
+      filename - filename to load (text or binary format)
       header_only - if True, only header is loaded
+      solid_angle_maps - optional dict of already loaded solid angle maps
+                         (keyed by filename), which is updated with any
+                         newly loaded map
     """
     if filename is None:
       filename = self.filename
@@ -329,35 +671,27 @@ class EmissionSpectrum(object):
       self.filename = filename
 
     headers = []
-    with open(filename, 'r') as f:
-      pos = f.tell()
+    with open(filename, 'rb') as f:
       line = f.readline()
-
-      while line:
-        if line[0] == "#":
-          headers.append(line[2:])
-        elif header_only:
+      while line.startswith('#'):
+        if line.startswith(BINARY_MARKER):
           break
-        else:
-          f.seek(pos)
-          spectrum = np.loadtxt(f)
-          if len(self.spectrum.shape) == 1:
-            spectrum.shape = (1,spectrum.shape[0])
+        headers.append(line[2:])
+        line = f.readline()
 
-          self._set_spectrum(spectrum)
+      if not header_only:
+        if line.startswith(BINARY_MARKER):
+          num_points = int(line[len(BINARY_MARKER):])
+          block = f.read(num_points * 5 * 8)
+          if len(block) != num_points * 5 * 8:
+            raise IOError("Binary spectrum in '%s' is truncated" % filename)
+          spectrum = np.frombuffer(block, dtype='<f8').astype(float).reshape((num_points, 5))
+        else:
+          spectrum = np.array((line + f.read()).split(), dtype=float).reshape((-1, 5))
 
-        pos = f.tell()
-        line = f.readline()
+        self._set_spectrum(spectrum)
 
-    parser = Parser({
-      'Dataset': STRING,
-      'Calibration File': STRING,
-      'Incident Energy': FLOAT,
-      'I0': FLOAT,
-      'Solid Angle Map': STRING,
-      'Filters': (LIST, STRING),
-      'Exposures': (LIST, STRING)
-      })
+    parser = Parser(self.parser_info())
     parsed = parser.parse(headers)
     self.load_errors += parser.errors
 
@@ -368,9 +702,10 @@ class EmissionSpectrum(object):
     solid_angle_map = parsed.get('Solid Angle Map')
     if solid_angle_map:
       try:
-        self._load_solid_angle_map(solid_angle_map)
+        self._load_solid_angle_map(solid_angle_map, solid_angle_maps)
       except IOError as e:
         self.load_errors.append(e.message)
+    self.load_errors += self.corrections.read_header(parsed)
     self.exposure_files = parsed.get('Exposures')
 
     # load filters
@@ -386,21 +721,31 @@ class EmissionSpectrum(object):
 
     return len(self.load_errors) == 0
 
-  def _load_solid_angle_map(self, map_file):
+  def _load_solid_angle_map(self, map_file, maps=None):
+    """
+    Load solid angle map (text or binary .npy format, see correction.load_map)
+
+    If `maps` is given, it is a dict of maps that have already been loaded.
+    """
+    if maps is not None and map_file in maps:
+      self.solid_angle_map_file, self.solid_angle_map = maps[map_file]
+      return
+
+    name = map_file
     try:
       if os.path.exists(map_file):
         map_file = os.path.abspath(map_file)
-        map = np.loadtxt(map_file)
-      else:
-        path = os.path.join(os.path.dirname(__file__), 'data', map_file)
-        map = np.loadtxt(path)
+      map = load_map(map_file)
     except IOError:
       raise IOError("Solid Angle Map File not found: '%s'. This must either be a full path, or relative to the minixs data directory." % map_file)
 
+    if maps is not None:
+      maps[name] = (map_file, map)
+
     self.solid_angle_map_file = map_file
     self.solid_angle_map = map
 
-  def process(self, emission_energies=None, skip_columns=[], killzone_mask=None):
+  def process(self, emission_energies=None, skip_columns=[], killzone_mask=None, killzone_mode=KILLZONE_SKIP_COLUMNS, xtal_masks=None, calibration=None):
     """
     Process Emission Spectrum
 
@@ -409,6 +754,11 @@ class EmissionSpectrum(object):
                           if None, a uniform 0.1 eV grid covering range of calibration energies is used
       skip_columns      - columns (for vertical disp. dir.) or rows (for horizontal) to skip entirely
       killzone_mask     - mask of regions to skip in processing
+      killzone_mode     - KILLZONE_SKIP_COLUMNS to skip any column (row) containing a killzoned pixel
+                          KILLZONE_SKIP_PIXELS to only drop killzoned pixels (see process_spectrum)
+      xtal_masks        - mask (or list of masks, one per xtal) of pixels illuminated by the xtals
+                          (see Spectrometer.xtal_masks)
+      calibration       - already loaded Calibration to use instead of loading self.calibration_file
 
     Prerequisites:
       self.calibration_file must be set to calibration filename
@@ -416,14 +766,16 @@ class EmissionSpectrum(object):
       self.filters must be a list of mx.filter.Filter descendents to apply to integrated exposures
                    (may be empty list)
       self.solid_angle_map may be a map of solid angles subtended by each pixel
+      self.corrections may contain dark, flat field and efficiency maps to apply
 
     Results:
       self.spectrum is set to processed spectrum
       self.emission, self.intensity, self.uncertainty, self.raw_counts and self.num_pixels are set to
         corresponding columns of spectrum
     """
-    calibration = calibrate.Calibration()
-    calibration.load(self.calibration_file)
+    if calibration is None:
+      calibration = calibrate.Calibration()
+      calibration.load(self.calibration_file)
 
     exposure = Exposure()
     exposure.load_multi(self.exposure_files)
@@ -444,11 +796,14 @@ class EmissionSpectrum(object):
                                 calibration.xtals,
                                 self.solid_angle_map,
                                 skip_columns=skip_columns,
-                                killzone_mask=killzone_mask)
+                                killzone_mask=killzone_mask,
+                                killzone_mode=killzone_mode,
+                                correction=self.corrections,
+                                xtal_masks=xtal_masks)
 
     self._set_spectrum(spectrum)
 
-  def process_binned(self, E1, E2, Estep, killzone_mask=None):
+  def process_binned(self, E1, E2, Estep, killzone_mask=None, calibration=None):
     """
     Process spectrum binning
 
@@ -457,20 +812,33 @@ class EmissionSpectrum(object):
       E2 - high edge of highest bin
       Estep = bin width
       killzone_mask - optional mask of regions to ignore entirely
+      calibration - already loaded Calibration to use instead of loading self.calibration_file
 
     See Calibration.process for prerequisites and results
     """
-    calib = calibrate.load(self.calibration_file)
+    if calibration is None:
+      calibration = calibrate.load(self.calibration_file)
+    calibration_matrix = calibration.calibration_matrix
 
     # zero out killzones of calibration matrix
     # (this causes those pixels to be ignored)
     if killzone_mask is not None:
-      calib.calibration_matrix[killzone_mask] = 0
+      calibration_matrix = calibration_matrix.copy()
+      calibration_matrix[killzone_mask] = 0
 
     exposure = Exposure()
     exposure.load_multi(self.exposure_files)
     exposure.apply_filters(self.incident_energy, self.filters)
-    spectrum = binned_emission_spectrum(calib.calibration_matrix,
+    if not self.corrections.is_empty():
+      exposure.pixels = self.corrections.apply(exposure.pixels)
+
+      # pixels with no response are ignored too
+      bad = ~np.isfinite(exposure.pixels)
+      if bad.any():
+        calibration_matrix = calibration_matrix.copy()
+        calibration_matrix[bad] = 0
+        exposure.pixels[bad] = 0
+    spectrum = binned_emission_spectrum(calibration_matrix,
                                         exposure,
                                         E1,
                                         E2,
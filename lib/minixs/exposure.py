@@ -1,7 +1,6 @@
 """
 Raw detector exposures
 """
-from PIL import Image
 import numpy as np
 from itertools import izip
 import os
@@ -38,6 +37,8 @@ class Exposure(object):
       pass
 
     else:
+      # PIL is slow to import, so only do so when needed
+      from PIL import Image
       self.image = Image.open(filename)
       self.raw = np.asarray(self.image)
 
@@ -66,6 +67,7 @@ class Exposure(object):
         # XXX this assumes pilatus 100K...
         p = np.fromstring(d, '>f').astype('int32').reshape((195,-1))
       else:
+        from PIL import Image
         im = Image.open(f)
         p = np.asarray(im)
 
@@ -123,35 +125,24 @@ class Exposure(object):
       self.pixels[y,x] = 0
 
 
-  def detect_bad_pixels(self, num_bins=20, bin_sep=3):
-    raise Exception("Not yet implemented")
-    # if we find bins separated from the rest by more than bin_sep zero bins, assume they contain bad pixels
+  def detect_bad_pixels(self, threshold=8.0, min_counts=10):
+    """
+    Find pixels that are much brighter than their neighbors
 
-    h = np.histogram(self.pixels.flat, num_bins)
-    counts = h[0]
-    bounds = h[1]
+    Parameters:
+      threshold - number of standard deviations above the neighboring
+                  pixels required to flag a pixel (see badpixels.spatial_outliers)
+      min_counts - pixels with fewer counts are never flagged
 
-    print counts
-    # start at high count end of histogram.
-    high_start = -1
-    zero_start = -1
-    for i in range(len(counts))[::-1]:
-      if counts[i] == 0 and high_start == -1:
-        high_start = i+1
-      elif counts[i] != 0 and high_start != -1:
-        zero_start = i+1
-        break
+    Returns:
+      list of (x,y) pixels
 
-    num_zeros = high_start - zero_start
-    print high_start, zero_start, num_zeros
-    if num_zeros > bin_sep:
-      max_good_counts = bounds[high_start]
-      y,x = np.where(self.pixels > max_good_counts)
-      bad_pixels = [(xi,yi) for xi,yi in zip(x,y)]
-    else:
-      bad_pixels = []
+    Use minixs.badpixels.detect_bad_pixels to check a series of exposures.
+    """
+    from badpixels import spatial_outliers
 
-    return bad_pixels
+    y, x = np.where(spatial_outliers(self.pixels.astype(float), threshold, min_counts))
+    return zip(x, y)
 
   def detect_bad_pixels2(self):
     p = self.pixels.copy()
@@ -167,7 +158,24 @@ class Exposure(object):
       bad_pixels += [(x,y) for y,x in izip(*i)]
       p[i] = 0
 
-    print a
-    print b
     return bad_pixels, p
 
+def load_stack(filenames):
+  """
+  Load several exposures into a single array
+
+  Parameters:
+    filenames - list of exposure filenames
+
+  Returns:
+    N x height x width array of pixel values (one frame per file)
+  """
+  stack = None
+  for i, filename in enumerate(filenames):
+    pixels = Exposure(filename).pixels
+    if stack is None:
+      stack = np.empty((len(filenames),) + pixels.shape, dtype=pixels.dtype)
+    elif pixels.shape != stack.shape[1:]:
+      raise ValueError("Exposure '%s' has a different shape than the others" % filename)
+    stack[i] = pixels
+  return stack
@@ -1,5 +1,4 @@
 import numpy as np
-from scipy.optimize import leastsq
 
 def gauss(x,x0,sigma):
   return np.exp(-(x-x0)**2 / (2*sigma**2))
@@ -21,4 +20,122 @@ def gauss_leastsq(data, guess):
     data: tuple containing (x,y) data point vectors
     guess: tuple containing starting (amplitude, mean, stddev) values
   """
+  # scipy is slow to import, so only do so when needed
+  from scipy.optimize import leastsq
   return leastsq(gauss_error, guess, data)
+
+def gauss_moments(x, y):
+  """
+  Estimate gaussian parameters from the moments of data
+
+  Parameters
+  ----------
+    x: data point x values (length K)
+    y: data point y values (length K, or N x K for N data sets)
+
+  Returns
+  -------
+    (amplitude, mean, stddev) - arrays of length N if `y` is 2D
+
+  Negative values of `y` are ignored.
+  """
+  x = np.asarray(x, dtype=float)
+  y = np.clip(np.asarray(y, dtype=float), 0, None)
+
+  total = y.sum(-1)
+  total = np.where(total == 0, 1, total)
+  x0 = (y * x).sum(-1) / total
+  var = (y * (x - np.expand_dims(x0, -1))**2).sum(-1) / total
+
+  return y.max(-1), x0, np.sqrt(var)
+
+def gauss_logparabola(x, y, threshold=0.2):
+  """
+  Fit gaussians to many data sets at once in closed form
+
+  The logarithm of a gaussian is a parabola, so a weighted least squares
+  fit of a parabola to log(y) gives the gaussian parameters directly. Only
+  the contiguous points around the maximum of each data set that lie above
+  `threshold` times the maximum are used, weighted by y**2 (so that the
+  noisy tails count less).
+
+  Parameters
+  ----------
+    x: data point x values (length K)
+    y: data point y values (N x K, one data set per row)
+    threshold: fraction of maximum above which points are used
+
+  Returns
+  -------
+    (fits, valid)
+
+    fits: N x 3 array of (amplitude, mean, stddev)
+    valid: N boolean array, False where no gaussian could be fit (e.g. fewer
+           than 3 points, or a parabola that opens upward)
+  """
+  x = np.asarray(x, dtype=float)
+  y = np.atleast_2d(np.asarray(y, dtype=float))
+  n, k = y.shape
+
+  peak = y.argmax(1)
+  ymax = y[np.arange(n), peak]
+
+  # contiguous run of points above threshold around the peak
+  idx = np.arange(k)
+  below = y <= threshold * ymax[:,np.newaxis]
+  left = np.where(below & (idx < peak[:,np.newaxis]), idx, -1).max(1)
+  right = np.where(below & (idx > peak[:,np.newaxis]), idx, k).min(1)
+  use = (idx > left[:,np.newaxis]) & (idx < right[:,np.newaxis]) & (y > 0)
+
+  # center on the peak for better conditioning
+  dx = x - x[peak][:,np.newaxis]
+  w = np.where(use, y**2, 0)
+  logy = np.log(np.where(use, y, 1))
+
+  X = np.dstack([np.ones((n, k)), dx, dx**2])
+  A = np.einsum('nk,nki,nkj->nij', w, X, X)
+  b = np.einsum('nk,nki,nk->ni', w, X, logy)
+
+  fits = np.zeros((n, 3))
+  valid = use.sum(1) >= 3
+  if valid.any():
+    c = np.linalg.solve(A[valid], b[valid][:,:,np.newaxis])[:,:,0]
+    ok = c[:,2] < 0
+    c0, c1, c2 = c[ok].T
+    i = np.flatnonzero(valid)[ok]
+    fits[i,0] = np.exp(c0 - c1**2 / (4 * c2))
+    fits[i,1] = x[peak[i]] - c1 / (2 * c2)
+    fits[i,2] = np.sqrt(-1 / (2 * c2))
+    valid[valid] = ok
+
+  return fits, valid
+
+def _gauss_leastsq_args(args):
+  x, y, guess = args
+  return gauss_leastsq((x, y), guess)
+
+def gauss_leastsq_many(x, ys, guesses, processes=1):
+  """
+  Fit gaussians to many data sets
+
+  Parameters
+  ----------
+    x: data point x values
+    ys: list of data point y values (one per data set)
+    guesses: starting (amplitude, mean, stddev) for each data set
+    processes: number of worker processes to fit with
+
+  Returns
+  -------
+    list of (fit, ier) as returned by gauss_leastsq
+  """
+  args = [(x, y, tuple(g)) for y, g in zip(ys, guesses)]
+  if processes > 1 and len(args) > 1:
+    from multiprocessing import Pool
+    pool = Pool(processes)
+    try:
+      return pool.map(_gauss_leastsq_args, args)
+    finally:
+      pool.close()
+      pool.join()
+  return [_gauss_leastsq_args(a) for a in args]
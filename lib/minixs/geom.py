@@ -1,3 +1,13 @@
+"""
+Geometry of points, lines, planes and rectangles in 3D
+
+Most functions accept either single points (3 element arrays) or N x 3
+arrays of points. The batch functions (`intersect_lines_with_plane`,
+`intersect_rays_with_rect`, etc.) take N x 3 arrays of line origins and
+directions, and return masks flagging lines that are parallel to a plane or
+miss a rectangle.
+"""
+
 import numpy as np
 from numpy.linalg import norm
 
@@ -19,6 +29,9 @@ class Plane(object):
     self.p0 = np.array(p0)
     self.n = np.array(n)
 
+    # distance of plane from origin
+    self.d = np.dot(self.p0, self.n)
+
   @classmethod
   def FromPoints(cls, p1, p2, p3):
     n = np.cross(p2-p1, p3-p1)
@@ -60,21 +73,39 @@ class Rectangle(Plane):
     self.n = np.cross(self.x, self.y)
     self.area = np.linalg.norm(self.n)
     self.n /= self.area
+    self.d = np.dot(self.p0, self.n)
+
+    # matrices converting between global and local coordinates
+    #   local = (p - p0) . to_local
+    #   global = p0 + local . to_global
+    self.to_local = np.array([self.kx, self.ky]).T
+    self.to_global = np.array([self.x, self.y])
 
   def closest_point(self, p):
     dp = np.asarray(p) - self.p0
-    dp -= np.dot(dp, self.n) * self.n
+    dp -= np.dot(dp, self.n)[...,np.newaxis] * self.n
     return self.p0 + dp
 
   def global_to_local(self, p):
-    dp = np.asarray(p) - self.p0
-    return np.array([np.dot(dp, self.kx), np.dot(dp, self.ky)])
+    """
+    Convert point (or N x 3 array of points) to local coordinates
+    """
+    return np.dot(np.asarray(p) - self.p0, self.to_local)
 
   def local_to_global(self, p):
-    return self.p0 + p[0] * self.x + p[1] * self.y
+    """
+    Convert local coordinates (or N x 2 array of them) to global coordinates
+    """
+    return self.p0 + np.dot(p, self.to_global)
 
   def corners(self):
-    return [self.local_to_global(p) for p in [(0,0),(1,0),(1,1),(0,1)]]
+    return list(self.corner_array())
+
+  def corner_array(self):
+    """
+    4 x 3 array of corners, in order (0,0), (1,0), (1,1), (0,1)
+    """
+    return self.local_to_global(np.array([(0,0),(1,0),(1,1),(0,1)], dtype=float))
 
   def __repr__(self):
     return "Rectangle(%s, %s, %s)" % (self.p0.__repr__(), self.p1.__repr__(), self.p2.__repr__())
@@ -122,27 +153,302 @@ def intersect_line_with_plane(line, plane):
 
 
 def reflect_through_plane(point, plane):
-  tmp = point - plane.p0
-  return plane.p0 + tmp - 2 * np.dot(tmp, plane.n) * plane.n
+  """
+  Reflect point (or N x 3 array of points) through plane
+  """
+  tmp = np.asarray(point) - plane.p0
+  return plane.p0 + tmp - 2 * np.dot(tmp, plane.n)[...,np.newaxis] * plane.n
+
+def reflect_directions(directions, normals):
+  """
+  Reflect N x 3 array of directions off of surfaces with given normals
+
+  Parameters:
+    directions - N x 3 array of directions
+    normals - unit normal (or N x 3 array of unit normals)
+  """
+  directions = np.asarray(directions)
+  cos = (directions * normals).sum(-1)
+  return directions - 2 * cos[...,np.newaxis] * normals
+
+def normalize(v):
+  """
+  Scale each row of an N x 3 array to unit length
+
+  Returns:
+    (unit vectors, lengths)
+  """
+  v = np.asarray(v, dtype=float)
+  length = np.sqrt((v**2).sum(-1))
+  return v / length[...,np.newaxis], length
+
+def lines_from_points(p1, p2):
+  """
+  Lines through pairs of points
+
+  Parameters:
+    p1, p2 - N x 3 arrays of points (either may be a single point)
+
+  Returns:
+    (origins, directions) as N x 3 arrays, with unit directions pointing from
+    p1 towards p2
+  """
+  p1 = np.asarray(p1, dtype=float)
+  p2 = np.asarray(p2, dtype=float)
+  directions, length = normalize(p2 - p1)
+  origins = p1 + np.zeros_like(directions)
+  return origins, directions
+
+def line_plane_distance(origins, directions, plane):
+  """
+  Find distance along lines to their intersections with a plane
+
+  Parameters:
+    origins - N x 3 array of line origins
+    directions - N x 3 array of line directions (need not be normalized)
+    plane - Plane
+
+  Returns:
+    (t, mask)
+
+    t - N array of distances (in units of direction length), such that the
+        intersection is at origins + t * directions
+    mask - N array, False where line is parallel to (or in) plane
+  """
+  b = np.dot(directions, plane.n)
+  mask = b != 0
+  with np.errstate(divide='ignore', invalid='ignore'):
+    t = (plane.d - np.dot(origins, plane.n)) / b
+  t[~mask] = np.nan
+  return t, mask
+
+def intersect_lines_with_plane(origins, directions, plane):
+  """
+  Intersect N lines with a plane
+
+  Returns:
+    (points, mask)
+
+    points - N x 3 array of intersections (nan where there is none)
+    mask - N array, False where line is parallel to (or in) plane
+  """
+  t, mask = line_plane_distance(origins, directions, plane)
+  return origins + t[:,np.newaxis] * directions, mask
+
+def intersect_rays_with_rect(origins, directions, rect):
+  """
+  Intersect N rays with a rectangle
+
+  Only intersections in front of the ray origins count.
+
+  Returns:
+    (local, t, mask)
+
+    local - N x 2 array of intersections in local coordinates of rect
+    t - N array of distances along rays (see `line_plane_distance`)
+    mask - N array, True where ray hits rectangle
+  """
+  t, mask = line_plane_distance(origins, directions, rect)
+  points = origins + t[:,np.newaxis] * directions
+  local = rect.global_to_local(points)
+  with np.errstate(invalid='ignore'):
+    mask &= ((t > 0) &
+             (local[:,0] >= 0) & (local[:,0] <= 1) &
+             (local[:,1] >= 0) & (local[:,1] <= 1))
+  return local, t, mask
+
+def intersect_rays_with_rects(origins, directions, rects):
+  """
+  Find first rectangle hit by each of N rays
+
+  Parameters:
+    origins - N x 3 array of ray origins
+    directions - N x 3 array of ray directions
+    rects - list of Rectangles
+
+  Returns:
+    (index, t, mask)
+
+    index - N array of indices into `rects` of first rect hit
+    t - N array of distances to hit
+    mask - N array, True where ray hits any rect
+  """
+  n = len(origins)
+  tt = np.empty((n, len(rects)))
+  for i, rect in enumerate(rects):
+    local, t, hit = intersect_rays_with_rect(origins, directions, rect)
+    t[~hit] = np.inf
+    tt[:,i] = t
+
+  index = np.argmin(tt, 1)
+  t = tt[np.arange(n), index]
+  return index, t, np.isfinite(t)
+
+def polygon_area(polygon):
+  """
+  Signed area of a 2D polygon (positive for counterclockwise vertices)
+  """
+  p = np.asarray(polygon, dtype=float)
+  if len(p) < 3:
+    return 0.0
+  q = np.roll(p, -1, axis=0)
+  return 0.5 * (p[:,0] * q[:,1] - q[:,0] * p[:,1]).sum()
+
+def order_polygon(polygon):
+  """
+  Order the vertices of a convex polygon counterclockwise
+
+  Parameters:
+    polygon - K x 2 or K x 3 (planar) array of vertices in any order
+
+  Returns:
+    array of the same vertices, ordered by angle around their centroid (for
+    3D polygons, the orientation is arbitrary)
+  """
+  p = np.asarray(polygon, dtype=float)
+  if len(p) < 3:
+    return p
+
+  dp = p - p.mean(0)
+  if p.shape[1] == 3:
+    # coordinates within plane of best fit
+    u, s, v = np.linalg.svd(dp)
+    dp = np.dot(dp, v[:2].T)
+
+  return p[np.argsort(np.arctan2(dp[:,1], dp[:,0]))]
+
+def clip_polygon(polygon, normal, offset):
+  """
+  Clip a convex 2D polygon to the half plane dot(p, normal) <= offset
+
+  Parameters:
+    polygon - K x 2 array of vertices
+    normal - 2 element normal pointing out of half plane
+    offset - offset of boundary along normal
+
+  Returns:
+    array of vertices of clipped polygon (possibly empty)
+
+  All edges are clipped at once (Sutherland-Hodgman).
+  """
+  p = np.asarray(polygon, dtype=float)
+  if len(p) == 0:
+    return p.reshape((0,2))
+  q = np.roll(p, -1, axis=0)
+
+  dp = np.dot(p, normal) - offset
+  dq = np.dot(q, normal) - offset
+  inside = dp <= 0
+  crossing = inside != (dq <= 0)
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    s = dp / (dp - dq)
+    x = p + s[:,np.newaxis] * (q - p)
+
+  # each edge contributes its start point (if inside) followed by its
+  # crossing of the boundary (if any)
+  out = np.hstack([p, x]).reshape((-1,2))
+  keep = np.column_stack([inside, crossing]).ravel()
+  return out[keep]
+
+def intersect_polygons(polygon, clip):
+  """
+  Intersection of two convex 2D polygons
+
+  Parameters:
+    polygon - K x 2 array of vertices (in order around polygon)
+    clip - L x 2 array of vertices (in either orientation)
+
+  Returns:
+    array of vertices of intersection (empty if there is no overlap)
+  """
+  c = np.asarray(clip, dtype=float)
+  if polygon_area(c) < 0:
+    c = c[::-1]
+
+  p = np.asarray(polygon, dtype=float)
+  for a, b in zip(c, np.roll(c, -1, axis=0)):
+    # outward normal of counterclockwise edge
+    normal = np.array([b[1] - a[1], a[0] - b[0]])
+    p = clip_polygon(p, normal, np.dot(a, normal))
+    if len(p) == 0:
+      break
+  return p
+
+def rasterize_polygon(polygon, shape):
+  """
+  Find pixels whose centers lie inside a convex 2D polygon
+
+  Parameters:
+    polygon - K x 2 array of (x,y) vertices in pixel coordinates (integers
+              lie on pixel edges)
+    shape - (h, w) of pixel array
+
+  Returns:
+    boolean array of given shape
+  """
+  h, w = shape
+  mask = np.zeros(shape, dtype=bool)
+
+  p = np.asarray(polygon, dtype=float)
+  if len(p) < 3 or polygon_area(p) == 0:
+    return mask
+  if polygon_area(p) < 0:
+    p = p[::-1]
+
+  # only test pixels in bounding box
+  x1, y1 = np.clip(np.floor(p.min(0)).astype(int), 0, (w, h))
+  x2, y2 = np.clip(np.ceil(p.max(0)).astype(int), 0, (w, h))
+  if x2 <= x1 or y2 <= y1:
+    return mask
+
+  cx = np.arange(x1, x2) + 0.5
+  cy = np.arange(y1, y2) + 0.5
+
+  inside = np.ones((y2-y1, x2-x1), dtype=bool)
+  for a, b in zip(p, np.roll(p, -1, axis=0)):
+    # center must be on the left of (or on) each counterclockwise edge
+    cross = ((b[0] - a[0]) * (cy[:,np.newaxis] - a[1]) -
+             (b[1] - a[1]) * (cx[np.newaxis,:] - a[0]))
+    inside &= cross >= 0
+
+  mask[y1:y2,x1:x2] = inside
+  return mask
+
+def project_polygon_through_point_onto_rect(point, polygon, rect):
+  """
+  Project a polygon from a point onto a rectangle
+
+  Parameters:
+    point - center of projection
+    polygon - K x 3 array of vertices of a convex polygon
+    rect - Rectangle to project onto
+
+  Returns:
+    K x 2 array of vertices of projection (clipped to rect) in local
+    coordinates of rect, or None if the projection doesn't intersect rect
+  """
+  origins, directions = lines_from_points(point, np.asarray(polygon))
+  points, mask = intersect_lines_with_plane(origins, directions, rect)
+  if not mask.all():
+    return None
+
+  local = intersect_polygons(rect.global_to_local(points),
+                             [(0,0),(1,0),(1,1),(0,1)])
+  if abs(polygon_area(local)) < 1e-10:
+    return None
+  return local
 
 def project_point_through_rect_onto_rect(point, rect1, rect2):
+  """
+  Find region of rect2 illuminated by a point shining through rect1
 
-  lines = [Line.FromPoints(point, corner) for corner in rect1.corners()]
-  points = np.array([intersect_line_with_plane(l, rect2) for l in lines])
-  #if np.any(p is None for p in points): continue
-
-  # convert to xtal coordinates
-  lpoints = np.array([rect2.global_to_local(p) for p in points])
-  # clamp to xtal
-  # FIXME: this is only correct2 if the projection is rect2angular
-  #        and has sides parallel to xtal sides...
-  lpoints[lpoints<0] = 0
-  lpoints[lpoints>1] = 1
-
-  # check if there is any overlap with xtal, and skip if not
-  size = lpoints.max(0) - lpoints.min(0)
-  if np.any(size < 1e-5):
+  Returns:
+    list of vertices of illuminated region, or None if there is none
+  """
+  local = project_polygon_through_point_onto_rect(point, rect1.corner_array(), rect2)
+  if local is None:
     return None
 
   # convert back to global coordinates
-  return [rect2.local_to_global(p) for p in lpoints]
+  return list(rect2.local_to_global(local))
@@ -30,3 +30,6 @@ ID_LOAD_SCAN        = wx.NewId()
 STATUS_COORDS  = 0
 STATUS_MESSAGE = 1
 
+# minimum confidence for automatically setting the dispersive direction
+DISPERSIVE_DIR_CONFIDENCE = 0.6
+
@@ -9,7 +9,7 @@ import minixs.filetype  as filetype
 from   minixs.calibrate import Calibration
 from   minixs.exposure  import Exposure
 from   minixs.filter    import get_filter_by_name
-from   minixs.misc      import read_scan_info, find_xtal_boundaries
+from   minixs.misc      import read_scan_info, find_xtal_boundaries, check_xtal_regions, find_dispersive_direction
 
 from minixs.gui import util
 from minixs.gui.file_dialog import FileDialog
@@ -503,7 +503,7 @@ class CalibratorController(object):
     name = evt.GetString()
     try:
       i = self.spectrometer_names.index(name)
-      s = mx.spectrometer.Spectrometer(self.spectrometer_tags[i])
+      s = mx.spectrometer.get_spectrometer(self.spectrometer_tags[i])
     except ValueError:
       s = None
 
@@ -550,6 +550,16 @@ class CalibratorController(object):
 
     xtals = find_xtal_boundaries(exposures)
 
+    # a spectrometer's design determines its dispersive direction
+    if self.model.spectrometer is None:
+      energies = self.model.energies
+      if len(energies) != len(exposures):
+        energies = None
+      direction, confidence = find_dispersive_direction(exposures, energies)
+      if direction != -1 and confidence >= DISPERSIVE_DIR_CONFIDENCE:
+        self.model.dispersive_direction = direction
+        self.view.panel.filter_panel.dispersive_direction.SetSelection(direction)
+
     if xtals is None:
       message = 'Unable to determine boundaries. It may help to increase the low cutoff value.'
       errdlg = wx.MessageDialog(self.view, message, "Error", wx.OK | wx.ICON_ERROR)
@@ -562,6 +572,17 @@ class CalibratorController(object):
       self.Changed()
       self.CalibrationValid(False)
 
+      # definitions without analyzer crystal geometry (e.g. ce_johansson)
+      # can't calculate their projections, so there is nothing to check
+      spectrometer = self.model.spectrometer
+      if spectrometer is not None and getattr(spectrometer, 'xtal_rects', None):
+        errors = check_xtal_regions(xtals, spectrometer)
+        if errors:
+          message = 'The crystal regions found do not match the spectrometer geometry:\n\n' + '\n'.join(errors)
+          warndlg = wx.MessageDialog(self.view, message, "Warning", wx.OK | wx.ICON_WARNING)
+          warndlg.ShowModal()
+          warndlg.Destroy()
+
     self.view.SetStatusText("", STATUS_MESSAGE)
 
   def OnCalibrate(self, evt):
@@ -72,7 +72,7 @@ class KillzoneList(object):
     return killzone_mask(kz['rects'], kz['circles'], shape)
 
 def killzone_mask(rects=[], circles=[], shape=(195,487)):
-    m = np.zeros(shape)
+    m = np.zeros(shape, dtype=bool)
     rows,cols = shape
     y,x = np.mgrid[:rows, :cols]
 
@@ -80,7 +80,7 @@ def killzone_mask(rects=[], circles=[], shape=(195,487)):
       dr = np.hypot(x-x0, y-y0)
       m[dr <= r0] = 1
 
-    for x1,y1,x2,y2 in rects:
+    for (x1,y1),(x2,y2) in rects:
       m[y1:y2,x1:x2] = 1
 
     return m
@@ -0,0 +1,264 @@
+"""
+Merging of repeated scans
+
+Repeated scans rarely hit exactly the same incident energies. Each scan
+point is shared between the two nearest points of a common incident energy
+grid with linear interpolation weights, and its exposure and I0 are added
+to both with those weights. Scans with identical energy points are simply
+summed. Each grid energy is then processed only once.
+
+Classes:
+  MergedScans - exposures and I0s of several scans on a common energy grid
+
+Functions:
+  interpolation_weights - weights of scan points on an energy grid
+  merge_scans - merge scan files and their exposures
+
+Example:
+  >>> import minixs as mx
+  >>> merged = mx.merge.merge_scans(['fe.0001', 'fe.0002'], exposure_files)
+  >>> rixs = merged.process('fe.calib')
+  >>> rixs.save('fe.rixs')
+"""
+
+import os
+import numpy as np
+
+import calibrate
+from correction import CorrectionMaps
+from emission import process_spectrum
+from exposure import Exposure, load_stack
+from rixs import RIXS
+from scanfile import ScanFile
+
+DEFAULT_TOLERANCE = 0.25
+
+def interpolation_weights(energies, grid, tolerance=DEFAULT_TOLERANCE):
+  """
+  Split points between the nearest points of an energy grid
+
+  Parameters:
+    energies - energies of points
+    grid - sorted (ascending) energy grid
+    tolerance - points further than this outside of grid are dropped
+
+  Returns:
+    (index, weights, valid)
+
+    index - N x 2 array of indices of grid points below and above each point
+    weights - N x 2 array of corresponding weights (summing to 1)
+    valid - N boolean array, False for dropped points (which have 0 weight)
+  """
+  energies = np.asarray(energies, dtype=float)
+  grid = np.asarray(grid, dtype=float)
+
+  valid = (energies >= grid[0] - tolerance) & (energies <= grid[-1] + tolerance)
+
+  if len(grid) == 1:
+    index = np.zeros((len(energies), 2), dtype=int)
+    weights = np.zeros((len(energies), 2))
+    weights[:,0] = valid
+    return index, weights, valid
+
+  hi = np.clip(np.searchsorted(grid, energies), 1, len(grid) - 1)
+  lo = hi - 1
+
+  # points just outside of grid go entirely to the edge point
+  w = np.clip((energies - grid[lo]) / (grid[hi] - grid[lo]), 0, 1)
+
+  index = np.vstack([lo, hi]).T
+  weights = np.vstack([1 - w, w]).T * valid[:,np.newaxis]
+  return index, weights, valid
+
+class MergedScans(object):
+  """
+  Exposures and I0s of several scans on a common incident energy grid
+
+  Instance Variables:
+    grid - incident energies
+    I0s - merged I0 of each grid energy
+    contributions - list of (exposure filenames, weights) for each grid energy
+    scan_energies, scan_I0s, exposure_files - all points that were merged
+    dropped - exposures of points that were outside of the grid (and not merged)
+  """
+  def __init__(self, grid, tolerance=DEFAULT_TOLERANCE):
+    """
+    Parameters:
+      grid - incident energy grid
+      tolerance - scan points further than this outside of the grid are dropped
+    """
+    self.grid = np.unique(np.asarray(grid, dtype=float))
+    self.tolerance = tolerance
+    self.I0s = np.zeros(len(self.grid))
+    self.contributions = [([], []) for g in self.grid]
+
+    self.scan_energies = []
+    self.scan_I0s = []
+    self.exposure_files = []
+    self.dropped = []
+
+  def add_scan(self, energies, I0s, exposure_files):
+    """
+    Add the points of a single scan
+
+    Parameters:
+      energies - incident energy of each point
+      I0s - incident flux of each point
+      exposure_files - exposure of each point
+    """
+    if not (len(energies) == len(I0s) == len(exposure_files)):
+      raise ValueError("The number of exposures, energies and I0 values are not all the same.")
+
+    index, weights, valid = interpolation_weights(energies, self.grid, self.tolerance)
+
+    # I0 of each grid point is the weighted sum of I0s of the points contributing to it
+    self.I0s += np.bincount(index.ravel(), (weights * np.asarray(I0s, dtype=float)[:,np.newaxis]).ravel(), len(self.grid))
+
+    for e, I0, f, ind, w, v in zip(energies, I0s, exposure_files, index, weights, valid):
+      if not v:
+        self.dropped.append(f)
+        continue
+
+      for k, wk in zip(ind, w):
+        if wk > 0:
+          files, file_weights = self.contributions[k]
+          files.append(f)
+          file_weights.append(wk)
+
+      self.scan_energies.append(e)
+      self.scan_I0s.append(I0)
+      self.exposure_files.append(f)
+
+  def exposure(self, k):
+    """
+    Merged exposure for grid energy `k`
+
+    Returns:
+      Exposure with weighted sum of contributing exposures (None if there are none)
+    """
+    files, weights = self.contributions[k]
+    if not files:
+      return None
+
+    exposure = Exposure()
+    exposure.filenames = files
+    exposure.pixels = np.tensordot(np.asarray(weights), load_stack(files), 1)
+    exposure.loaded = True
+    return exposure
+
+  def process(self, calibration, emission_energies=None, filters=[],
+              solid_angle_map=None, corrections=None, progress_callback=None,
+              skip_columns=[]):
+    """
+    Process merged scans into a RIXS spectrum
+
+    Parameters:
+      calibration - Calibration or calibration filename
+      emission_energies - emission energy grid (default: 0.1 eV steps
+                          covering calibration energy range)
+      filters - list of mx.filter.Filter descendents to apply to merged exposures
+      solid_angle_map - solid angle map filename
+      corrections - CorrectionMaps to apply to exposures
+      progress_callback - called as progress_callback(k, energy) before each
+                          grid energy is processed
+      skip_columns - see emission.process_spectrum
+
+    Returns:
+      RIXS spectrum with one emission spectrum per grid energy that has data.
+      Its header lists all merged points.
+    """
+    if isinstance(calibration, basestring):
+      calibration = calibrate.load(calibration)
+      if calibration.load_errors:
+        raise Exception("Invalid calibration file:\n  " + "\n  ".join(calibration.load_errors))
+
+    if emission_energies is None:
+      Emin, Emax = calibration.energy_range()
+      emission_energies = np.arange(Emin, Emax, 0.1)
+
+    rixs = RIXS()
+    rixs.calibration_file = os.path.abspath(calibration.filename)
+    rixs.energies = list(self.scan_energies)
+    rixs.I0s = list(self.scan_I0s)
+    rixs.exposure_files = [os.path.abspath(f) for f in self.exposure_files]
+    rixs.filters = filters
+    rixs.corrections = corrections or CorrectionMaps()
+    if solid_angle_map:
+      rixs._load_solid_angle_map(solid_angle_map)
+
+    stride = len(emission_energies)
+    spectra = []
+    for k, energy in enumerate(self.grid):
+      if progress_callback:
+        progress_callback(k, energy)
+
+      exposure = self.exposure(k)
+      if exposure is None:
+        continue
+
+      exposure.apply_filters(energy, filters)
+
+      xes = process_spectrum(calibration.calibration_matrix,
+                             exposure,
+                             emission_energies,
+                             self.I0s[k],
+                             calibration.dispersive_direction,
+                             calibration.xtals,
+                             rixs.solid_angle_map,
+                             skip_columns=skip_columns,
+                             correction=rixs.corrections)
+
+      spectrum = np.zeros((stride, 6))
+      spectrum[:,0] = energy
+      spectrum[:,1:] = xes
+      spectra.append(spectrum)
+
+    if spectra:
+      rixs.spectrum = np.vstack(spectra)
+    else:
+      rixs.spectrum = np.zeros((0, 6))
+    return rixs
+
+def merge_scans(scans, exposure_files, energy_column=None, i0_column=None,
+                grid=None, tolerance=DEFAULT_TOLERANCE):
+  """
+  Merge repeated scans
+
+  Parameters:
+    scans - list of scan filenames (or ScanFiles)
+    exposure_files - exposures of all scans, listed scan by scan (or a list
+                     with one list of exposures per scan)
+    energy_column, i0_column - scan file columns (see ScanFile.find_energy_and_i0_columns)
+    grid - common incident energy grid (default: energies of first scan)
+    tolerance - scan points further than this outside of the grid are dropped
+
+  Returns:
+    MergedScans
+  """
+  scans = [s if isinstance(s, ScanFile) else ScanFile(s) for s in scans]
+
+  scan_data = []
+  for s in scans:
+    e, i = s.find_energy_and_i0_columns(energy_column, i0_column)
+    scan_data.append((s.data[:,e], s.data[:,i]))
+
+  # split flat list of exposures up by scan
+  if exposure_files and not isinstance(exposure_files[0], basestring):
+    scan_exposures = exposure_files
+  else:
+    num_points = [len(energies) for energies, I0s in scan_data]
+    if len(exposure_files) != sum(num_points):
+      raise ValueError("The number of exposures (%d) does not match the number of scan points (%d)." % (len(exposure_files), sum(num_points)))
+    bounds = np.cumsum([0] + num_points)
+    scan_exposures = [exposure_files[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+  if len(scan_exposures) != len(scans):
+    raise ValueError("A list of exposures must be given for each scan.")
+
+  if grid is None:
+    grid = scan_data[0][0]
+
+  merged = MergedScans(grid, tolerance)
+  for (energies, I0s), exposures in zip(scan_data, scan_exposures):
+    merged.add_scan(energies, I0s, exposures)
+  return merged
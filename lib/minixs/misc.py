@@ -2,10 +2,18 @@
 Miscellanous functions
 """
 
+import os
 import numpy as np
+import minixs as mx
 from itertools import izip
+from collections import OrderedDict
 from scanfile import ScanFile
 
+# ScanFiles read by read_scan_info, keyed by absolute path
+# (least recently used first, at most SCAN_CACHE_SIZE of them)
+SCAN_CACHE_SIZE = 16
+_scan_cache = OrderedDict()
+
 def gen_rects(horizontal_bounds=None, vertical_bounds=None):
   """Convert lists of horizontal and vertical boundary locations into rectangles"""
   return [
@@ -26,62 +34,303 @@ def read_scan_info(scanfile, columns):
   The returned list is transposed so that the following works:
 
   c0, c6 = read_scan_info("scanfile.0001", [0,6])
+
+  The most recently read scan files are cached, so calling this again for
+  a scan that is still running only parses the newly appended rows. Files
+  that have been rewritten are read again from the beginning (see
+  ScanFile.update).
   """
 
-  s = ScanFile(scanfile)
+  # scans that are still being written are only read as far as the last call
+  path = os.path.abspath(scanfile)
+  s = _scan_cache.pop(path, None)
+  if s is None:
+    s = ScanFile(path)
+  else:
+    s.update()
+
+  _scan_cache[path] = s
+  while len(_scan_cache) > SCAN_CACHE_SIZE:
+    _scan_cache.popitem(last=False)
+
   return s.data[:,columns].transpose()
 
+def _peak_offset(cm, c0, cp):
+  """
+  Sub-pixel offset of a peak from the values before, at and after its maximum
+
+  A gaussian is fit to the three points (or, where they aren't all
+  positive, a parabola). The offset is between -0.5 and 0.5.
+  """
+  # the log of a gaussian peak is a parabola
+  if cm > 0 and c0 > 0 and cp > 0:
+    cm, c0, cp = np.log([cm, c0, cp])
+
+  denom = cm - 2 * c0 + cp
+  if denom >= 0:
+    return 0.0
+  return float(np.clip(0.5 * (cm - cp) / denom, -0.5, 0.5))
+
+def _fft_size(n):
+  """
+  Smallest size of at least n with no prime factors other than 2, 3 and 5
+  (for which FFTs are fast)
+  """
+  best = 2 ** int(np.ceil(np.log2(n)))
+  p5 = 1
+  while p5 < best:
+    p35 = p5
+    while p35 < best:
+      size = p35
+      while size < n:
+        size *= 2
+      best = min(best, size)
+      p35 *= 3
+    p5 *= 5
+  return best
+
+def frame_shifts(stack, max_shift=None):
+  """
+  Find shifts between consecutive 2D frames by FFT cross-correlation
+
+  Parameters
+  ----------
+    stack: N x height x width array of frames
+    max_shift: largest shift (in pixels) along either axis to consider (default: any)
+
+  Returns
+  -------
+    N-1 x 2 array of the (sub-pixel) (row, column) shift of each frame
+    relative to the previous one. Positive shifts are toward higher indices.
+
+  The frames are zero padded so that they don't wrap around (to sizes
+  whose FFTs are fast), and each one is only transformed once. Correlating whole frames, rather than their
+  projections, keeps separate features (e.g. the elastic lines of
+  different xtals) from being mixed together.
+  """
+  stack = np.asarray(stack, dtype=float)
+  n, h, w = stack.shape
+  if n < 2:
+    return np.zeros((0, 2))
+
+  shape = (_fft_size(2 * h - 1), _fft_size(2 * w - 1))
+  lags = []
+  for size in shape:
+    l = np.arange(size)
+    l[l > size // 2] -= size
+    lags.append(l)
+  ly, lx = lags
+
+  shifts = np.zeros((n - 1, 2))
+  F = np.fft.rfft2(stack[0] - stack[0].mean(), shape)
+  for i in range(1, n):
+    F_next = np.fft.rfft2(stack[i] - stack[i].mean(), shape)
+    corr = np.fft.irfft2(F.conj() * F_next, shape)
+    F = F_next
+
+    if max_shift is not None:
+      corr[np.abs(ly) > max_shift] = corr.min()
+      corr[:, np.abs(lx) > max_shift] = corr.min()
+
+    ky, kx = np.unravel_index(corr.argmax(), shape)
+    c0 = corr[ky, kx]
+    shifts[i-1,0] = ly[ky] + _peak_offset(corr[ky-1, kx], c0, corr[(ky+1) % shape[0], kx])
+    shifts[i-1,1] = lx[kx] + _peak_offset(corr[ky, kx-1], c0, corr[ky, (kx+1) % shape[1]])
+
+  return shifts
+
+def find_dispersive_direction(exposures, energies=None, high=10000, max_shift=None):
+  """
+  Determine the dispersive direction from a series of calibration exposures
+
+  Parameters
+  ----------
+    exposures: list of Exposures (or pixel arrays, or an N x height x width stack)
+    energies: energies of exposures (default: exposures are in order of increasing energy)
+    high: pixels above this are ignored
+    max_shift: largest shift between consecutive exposures to consider
+
+  Returns
+  -------
+    (direction, confidence)
+
+    direction: one of mx.DOWN, mx.LEFT, mx.UP or mx.RIGHT (-1 if the
+               exposures don't move at all)
+    confidence: between 0 and 1, the product of
+                  the fraction of the net displacement (summed over
+                  consecutive pairs of exposures) that is along the
+                  dispersive axis, rather than across it
+                and the fraction of motion along the dispersive axis that
+                  is in the same direction
+
+  The shift between each pair of consecutive exposures is found by 2D
+  cross-correlation (see frame_shifts). Each exposure is first clipped at
+  its 99.9th percentile, so that a few very bright pixels (e.g. cosmic
+  rays) don't dominate the correlation.
+  """
+  stack = np.array([getattr(e, 'pixels', e) for e in exposures], dtype=float)
+  stack[stack > high] = 0
+  if len(stack) < 2:
+    return -1, 0.0
+
+  ceiling = np.percentile(stack, 99.9, axis=(1,2))
+  np.clip(stack, 0, ceiling[:,np.newaxis,np.newaxis], stack)
+
+  if energies is not None:
+    stack = stack[np.argsort(energies, kind='mergesort')]
+
+  shifts = frame_shifts(stack, max_shift)
+
+  total = np.abs(shifts.sum(0))
+  if total.sum() == 0:
+    return -1, 0.0
+
+  axis = np.argmax(total)
+  net = shifts[:,axis].sum()
+  confidence = total[axis] / total.sum() * abs(net) / np.abs(shifts[:,axis]).sum()
+  if axis == 0:
+    direction = mx.DOWN if net > 0 else mx.UP
+  else:
+    direction = mx.RIGHT if net > 0 else mx.LEFT
+
+  return direction, confidence
+
 def determine_dispersive_direction(e1, e2, threshold=.75, sep=20):
   """Given two exposures with increasing energy, determine
-  the dispersive direction on the camera"""
+  the dispersive direction on the camera
 
-  p1 = e1.pixels.copy()
-  p2 = e2.pixels.copy()
+  Returns the direction found by find_dispersive_direction (considering
+  shifts up to `sep` pixels), or -1 if its confidence is below `threshold`.
+  """
+  direction, confidence = find_dispersive_direction([e1, e2], max_shift=sep)
+  if confidence < threshold:
+    return -1
+  return direction
 
-  p1[np.where(p1 > 10000)] = 0
-  p2[np.where(p2 > 10000)] = 0
+def _sorted_regions(boxes):
+  """
+  Helper function for find_xtal_regions
 
-  tests = [
-      (0, (1,sep)), # DOWN
-      (1, (-sep,-1)), # LEFT
-      (0, (-sep,-1)),   # UP
-      (1, (1,sep))    # RIGHT
-      ]
+  Sorts bounding boxes ((y slice, x slice) pairs) into rows (boxes whose
+  vertical extents overlap) from top to bottom, and each row from left to
+  right. Returns the sorted indices.
+  """
+  order = sorted(range(len(boxes)), key=lambda i: boxes[i][0].start)
 
-  diffs = [
-      np.min([ np.sum(np.abs(p2 - np.roll(p1,i,axis)))
-            for i in np.arange(i1,i2) ])
-      for axis, (i1,i2) in tests ]
+  rows = []
+  row_end = -1
+  for i in order:
+    if boxes[i][0].start >= row_end:
+      rows.append([])
+    rows[-1].append(i)
+    row_end = max(row_end, boxes[i][0].stop)
 
-  if np.min(diffs) / np.average(diffs) < threshold:
-    return np.argmin(diffs)
+  return [i for row in rows for i in sorted(row, key=lambda i: boxes[i][1].start)]
 
-  return -1
+def find_xtal_regions(filtered_exposures, shrink=1, close=5, min_size=0.1):
+  """
+  From a full set of filtered calibration exposures, determine crystal regions
 
-def _find_boundaries(p, axis):
+  Parameters
+  ----------
+    filtered_exposures: list of Exposures (or pixel arrays, or an N x height x width stack)
+    shrink: the number of pixels to shrink each determined region (default 1)
+    close: gaps of up to about twice this many pixels between the elastic
+           lines of consecutive exposures are filled in (default 5)
+    min_size: regions with fewer pixels than this fraction of the largest
+              region are dropped (default 0.1)
+
+  Returns
+  -------
+    (xtals, masks)
+
+    xtals: list of [[x1,y1],[x2,y2]] bounding rectangles, sorted into rows
+           from top to bottom and each row from left to right
+    masks: K x height x width boolean array of the pixels in each region
+
+  The exposures are summed, and the pixels lit in any of them are labelled
+  as connected regions, so crystals are found in both dimensions (e.g. for
+  spectrometers with several rows of crystals).
   """
-  Helper function for find_xtal_boundaries
+  # scipy is slow to import, so only do so when needed
+  from scipy import ndimage
+
+  stack = [getattr(e, 'pixels', e) for e in filtered_exposures]
+  p = np.sum(stack, 0)
+
+  # pad, so that regions touching the edge aren't eroded by the closing
+  lit = np.pad(p > 0, close, 'constant')
+  if close > 0:
+    lit = ndimage.binary_closing(lit, iterations=close)
+  lit = ndimage.binary_fill_holes(lit)
+  lit = lit[close:lit.shape[0]-close, close:lit.shape[1]-close]
+
+  labels, num = ndimage.label(lit)
+  if num == 0:
+    return [], np.zeros((0,) + p.shape, dtype=bool)
+
+  sizes = np.bincount(labels.ravel())[1:]
+  keep = np.flatnonzero(sizes >= min_size * sizes.max())
+  boxes = ndimage.find_objects(labels)
+  keep = keep[_sorted_regions([boxes[i] for i in keep])]
+
+  xtals = []
+  for i in keep:
+    ys, xs = boxes[i]
+    xtals.append([[int(xs.start + shrink), int(ys.start + shrink)],
+                  [int(xs.stop - shrink), int(ys.stop - shrink)]])
+
+  masks = labels[np.newaxis,:,:] == (keep + 1)[:,np.newaxis,np.newaxis]
+  return xtals, masks
+
+def check_xtal_regions(xtals, spectrometer, tolerance=5):
   """
-  flat = p.sum(1-axis)
+  Compare crystal regions with those expected from a spectrometer's geometry
 
-  # find boundaries
-  mask = 1 * (flat > p.shape[1-axis])
-  diffs = np.diff(mask)
-  b1 = list(np.where(diffs==1)[0])
-  b2 = list(np.where(diffs==-1)[0])
+  Parameters
+  ----------
+    xtals: list of [[x1,y1],[x2,y2]] rectangles (e.g. from find_xtal_regions)
+    spectrometer: Spectrometer whose `calculate_projection_bounds()` gives
+                  the expected regions
+    tolerance: largest allowed difference (in pixels) of any edge
 
-  # if nothing was found, xtals cover entire face
-  if len(b1) == 0:
-    b1 = [0]
-  if len(b2) == 0:
-    b2 = [p.shape[axis]]
-  
-  if b1[0] > b2[0]:
-    b1.insert(0,0)
-  if b2[-1] < b1[-1]:
-    b2.append(p.shape[axis])
+  Returns
+  -------
+    list of messages describing disagreements (empty if there are none)
 
-  return b1,b2
+  Each expected region is matched with the region that overlaps it most.
+  """
+  bounds = np.array(spectrometer.calculate_projection_bounds(), dtype=float).reshape((-1,4))
+  found = np.array(xtals, dtype=float).reshape((-1,4))
+
+  # overlap area of each expected (rows) and found (columns) region
+  w = (np.minimum(bounds[:,np.newaxis,2], found[np.newaxis,:,2]) -
+       np.maximum(bounds[:,np.newaxis,0], found[np.newaxis,:,0]))
+  h = (np.minimum(bounds[:,np.newaxis,3], found[np.newaxis,:,3]) -
+       np.maximum(bounds[:,np.newaxis,1], found[np.newaxis,:,1]))
+  overlap = np.clip(w, 0, None) * np.clip(h, 0, None)
+
+  errors = []
+  if len(found) != len(bounds):
+    errors.append("Found %d crystal regions, but the spectrometer has %d." % (len(found), len(bounds)))
+
+  matched = set()
+  for i, b in enumerate(bounds):
+    if len(found) == 0 or overlap[i].max() == 0:
+      errors.append("No region found for crystal %d." % (i+1))
+      continue
+
+    j = np.argmax(overlap[i])
+    matched.add(j)
+    diff = np.abs(found[j] - b).max()
+    if diff > tolerance:
+      errors.append("Region %d differs from the expected region of crystal %d by up to %.0f pixels." % (j+1, i+1, diff))
+
+  for j in range(len(found)):
+    if j not in matched:
+      errors.append("Region %d does not correspond to any crystal." % (j+1))
+
+  return errors
 
 def find_xtal_boundaries(filtered_exposures, shrink=1):
   """
@@ -93,26 +342,13 @@ def find_xtal_boundaries(filtered_exposures, shrink=1):
     shrink: the number of pixels to shrink determined boundary (default 1)
 
   The `shrink` parameter can be used to avoid edge effects or slight aparallelism.
-  """
-  # combine exposures into one
-  p = filtered_exposures[0].pixels.copy()
-  for e in filtered_exposures[1:]:
-    np.add(p,e.pixels,p)
-
-  x1s,x2s = _find_boundaries(p, 1)
-  #y1s,y2s = _find_boundaries(p, 0)
-  y1s = [2]
-  y2s = [193]
 
-
-  if len(x1s) != len(x2s) or len(y1s) != len(y2s):
+  Returns a list of [[x1,y1],[x2,y2]] rectangles (see find_xtal_regions),
+  or None if no crystals were found.
+  """
+  xtals, masks = find_xtal_regions(filtered_exposures, shrink)
+  if not xtals:
     return None
-
-  xtals = []
-  for x1,x2 in izip(x1s, x2s):
-    for y1,y2 in izip(y1s, y2s):
-      xtals.append([[x1+shrink,y1+shrink],[x2-shrink,y2-shrink]])
-
   return xtals
 
 def find_edges(pixels, direction=0, sign=-1, thresh=5):
@@ -123,55 +359,153 @@ def find_edges(pixels, direction=0, sign=-1, thresh=5):
 
 def find_xtal_regions2(filtered_exposures, direction, thresh):
   r = [find_edges(e.pixels, direction, -1, thresh) for e in filtered_exposures]
-  print r
   l = [find_edges(e.pixels, direction, +1, thresh) for e in filtered_exposures]
 
   return l,r
 
+def energy_width_map(calibration_matrix, xtals, direction):
+  """
+  Calculate the emission energy width (in eV) covered by each pixel
+
+  Parameters
+  ----------
+    calibration_matrix: array of emission energy at each pixel
+    xtals: list of crystal rects [[x1,y1],[x2,y2]]
+    direction: dispersive direction (mx.DOWN, UP, LEFT or RIGHT)
+
+  Returns
+  -------
+    array of absolute energy differences between the neighbors of each pixel
+    along the dispersive direction (0 outside of the xtals)
+
+  Central differences (as in np.gradient) are used for all xtals at once,
+  except at the edges of each xtal region, where one-sided differences are
+  used, so that no pixel is compared with one in another region.
+  """
+  cal = np.asarray(calibration_matrix, dtype=float)
+  labels = -np.ones(cal.shape, dtype=int)
+  for i, ((x1,y1),(x2,y2)) in enumerate(xtals):
+    labels[y1:y2,x1:x2] = i
+
+  # work along rows
+  vertical = direction in (mx.UP, mx.DOWN)
+  if vertical:
+    cal, labels = cal.T, labels.T
+
+  dE = np.gradient(cal, axis=1)
+  diff = np.diff(cal, axis=1)
+
+  # whether the previous and next pixel are in the same xtal region
+  same = (labels[:,1:] == labels[:,:-1]) & (labels[:,1:] >= 0)
+  before = np.zeros(cal.shape, dtype=bool)
+  before[:,1:] = same
+  after = np.zeros(cal.shape, dtype=bool)
+  after[:,:-1] = same
+
+  first = after & ~before
+  dE[first] = diff[first[:,:-1]]
+  last = before & ~after
+  dE[last] = diff[last[:,1:]]
+  dE[~before & ~after] = 0
+
+  dE = np.abs(dE)
+  if vertical:
+    dE = dE.T
+  return dE
+
 def collection_angle_correction(ci, d, return_theta=False):
   """
   Calculate angular spread in dispersive direction (in radians) for each pixel
 
   This should by used to correct for the fact that different pixels bin different energy widths (or alternatively cover different solid angles).
 
-  This code has not been fully verified, so do not use at this time.
+  Differentiating Bragg's law, E = hc / (2 d sin(theta_B)), gives
+  dtheta_B = tan(theta_B) dE / E, with dE from `energy_width_map`.
  
   Parameters
   ----------
-    ci: Calibration object containing calibration matrix and xtals
-    d:  lattice spacing
+    ci: Calibration object containing calibration matrix, dispersive direction and xtals
+    d:  lattice spacing (in angstroms) of the reflecting planes
     return_theta: if True, return a matrix of angle values for each pixel
-  """
-  cac =  np.zeros(ci.calibration_matrix.shape)
-  if return_theta:
-    fulltheta =  np.zeros(ci.calibration_matrix.shape)
+                  (the angle from the xtal normal, 90 deg - theta_B)
 
-  E0 = np.pi * 1973.26 / d
+  Pixels outside of the xtals, or with energies too low to be reflected,
+  are 0.
+  """
+  E = np.asarray(ci.calibration_matrix, dtype=float)
+  dE = energy_width_map(E, ci.xtals, ci.dispersive_direction)
 
-  for xtal in ci.xtals:
-    (x1,y1),(x2,y2) = xtal
-    E = ci.calibration_matrix[y1:y2,x1:x2]
+  E0 = mx.spectrometer.HC / (2. * d)
+  valid = ci.xtal_mask() & (E > E0)
 
-    dE = (np.roll(E,-1,0) - np.roll(E,1,0)) / 2.
-    # fix up end points by extrapolation
-    dE[0] = 2*dE[1] - dE[2]
-    dE[-1] = 2*dE[-2] - dE[-3]
+  theta = np.zeros(E.shape)
+  theta[valid] = np.arccos(E0 / E[valid])
 
-    theta = np.arccos(E0 / E)
-    dtheta = dE / E / np.tan(theta)
- 
-    if return_theta:
-      fulltheta[y1:y2, x1:x2] = theta
-    cac[y1:y2, x1:x2] = dtheta
+  cac = np.zeros(E.shape)
+  cac[valid] = dE[valid] / E[valid] / np.tan(theta[valid])
 
   if return_theta:
-    return fulltheta, cac
+    return theta, cac
   else:
     return cac
 
 def writable(fname):
   return hasattr(fname, 'write')
 
+# compression formats, by file extension and by the first bytes of a file
+COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.xz': 'xz'}
+COMPRESSION_MAGIC = {'gzip': '\x1f\x8b', 'xz': '\xfd7zXZ\x00'}
+
+def _lzma():
+  try:
+    import lzma
+  except ImportError:
+    try:
+      from backports import lzma
+    except ImportError:
+      raise IOError("xz compression requires the lzma module (backports.lzma for python 2)")
+  return lzma
+
+def open_compressed(fname_or_fh, flag="r", compression=None):
+  """
+  Open a file (or wrap a file handle) for IO, with optional compression
+
+  Parameters:
+    fname_or_fh - filename or file handle
+    flag - 'r' or 'w' (files are always opened in binary mode)
+    compression - None, 'gzip' or 'xz'
+
+  When reading a file, its compression is determined from its first bytes.
+  When writing, it is determined from the extension ('.gz' or '.xz'),
+  unless given explicitly. File handles are only wrapped if `compression` is
+  given.
+  """
+  mode = flag[0] + 'b'
+  is_fh = writable(fname_or_fh) or hasattr(fname_or_fh, 'read')
+
+  if compression is None and not is_fh:
+    if mode == 'rb':
+      with open(fname_or_fh, 'rb') as f:
+        start = f.read(6)
+      for name, magic in COMPRESSION_MAGIC.items():
+        if start.startswith(magic):
+          compression = name
+    else:
+      ext = os.path.splitext(fname_or_fh)[1].lower()
+      compression = COMPRESSION_EXTENSIONS.get(ext)
+
+  if compression is None:
+    return fname_or_fh if is_fh else open(fname_or_fh, mode)
+  elif compression == 'gzip':
+    import gzip
+    if is_fh:
+      return gzip.GzipFile(fileobj=fname_or_fh, mode=mode)
+    return gzip.open(fname_or_fh, mode)
+  elif compression == 'xz':
+    return _lzma().LZMAFile(fname_or_fh, mode)
+  else:
+    raise ValueError("Unknown compression: '%s'" % compression)
+
 from contextlib import contextmanager
 @contextmanager
 def to_filehandle(fname_or_fh, flag="r"):
@@ -0,0 +1,276 @@
+"""
+Monte Carlo ray tracing of spectrometer response
+
+Rays are emitted from an extended sample spot towards the entrance apertures,
+Bragg reflected off the analyzer crystals, passed through the exit aperture
+and histogrammed onto the camera pixels. This is used to generate realistic
+simulated exposures (e.g. for calibration) and to estimate the energy
+resolution of a spectrometer design.
+
+Functions:
+  trace - trace rays through a spectrometer and histogram them on the camera
+  simulate_exposure - simulated exposure for a given incident energy
+  simulate_calibration - simulated elastic exposures for a list of energies
+
+Example:
+  >>> import minixs as mx
+  >>> s = mx.spectrometer.Spectrometer('fe_kbeta_vonhamos')
+  >>> intensity, energy, sigma = mx.raytrace.trace(s, 10**6, spot_size=(0.1,0,0.5))
+  >>> exposures = mx.raytrace.simulate_calibration(s, [7040, 7050, 7060], 1e9)
+"""
+
+import numpy as np
+from numpy.linalg import norm
+from multiprocessing import Pool
+
+import geom
+from exposure import Exposure
+from spectrometer import HC, lattice_constants
+
+# conversion from FWHM to standard deviation of a gaussian
+FWHM_TO_SIGMA = 1 / (2 * np.sqrt(2 * np.log(2)))
+
+def _points_to_rect(points):
+  return geom.Rectangle(points[0], points[1], points[3])
+
+def _geometry(spectrometer):
+  """
+  Extract the spectrometer geometry (for passing to worker processes)
+  """
+  s = spectrometer
+  return dict(
+      sample=np.asarray(s.sample, dtype=float),
+      d=lattice_constants[s.xtal_type] / norm(s.xtal_cut),
+      xtals=list(s.xtal_rects),
+      apertures=[_points_to_rect(a) for a in s.entrance_aperture],
+      # design files don't always list exit aperture corners in order
+      exit=_points_to_rect(geom.order_polygon(s.exit_aperture)),
+      camera=s.camera_rect,
+      camera_shape=tuple(s.camera_shape),
+      energy_range=getattr(s, 'energy_range', None),
+      )
+
+def _trace_batch(args):
+  """
+  Trace one batch of rays
+
+  Returns:
+    (weights, weighted energies, weighted squared energies) histogrammed on camera
+  """
+  g, num_rays, total_rays, energy, bandwidth, spot_size, intrinsic_width, seed = args
+
+  rng = np.random.RandomState(seed)
+  h, w = g['camera_shape']
+  npix = h * w
+
+  # sample source points in spot
+  origins = g['sample'] + (rng.rand(num_rays, 3) - 0.5) * np.asarray(spot_size, dtype=float)
+
+  # pick a uniformly distributed target point on a random entrance aperture
+  apertures = g['apertures']
+  num_ap = len(apertures)
+  ap_p0 = np.array([ap.p0 for ap in apertures])
+  ap_basis = np.array([ap.to_global for ap in apertures])
+  ap_n = np.array([ap.n for ap in apertures])
+  ap_area = np.array([ap.area for ap in apertures])
+
+  k = rng.randint(0, num_ap, num_rays)
+  local = rng.rand(num_rays, 2)
+  targets = ap_p0[k] + (local[:,:,np.newaxis] * ap_basis[k]).sum(1)
+
+  directions, r = geom.normalize(targets - origins)
+
+  # weight is the fraction of an isotropic source's emission that each ray represents
+  cos_ap = np.abs((directions * ap_n[k]).sum(1))
+  weights = num_ap * ap_area[k] * cos_ap / r**2 / (4 * np.pi) / total_rays
+
+  # find first xtal hit by each ray
+  xtal, t, hit = geom.intersect_rays_with_rects(origins, directions, g['xtals'])
+
+  t = t[hit]
+  origins = origins[hit]
+  directions = directions[hit]
+  weights = weights[hit]
+  xtal = xtal[hit]
+
+  # Bragg condition
+  normals = np.array([rect.n for rect in g['xtals']])[xtal]
+  cos_n = (directions * normals).sum(1)
+  bragg_energy = HC / (2 * g['d']) / np.abs(cos_n)
+  sigma = intrinsic_width * FWHM_TO_SIGMA
+
+  if energy is None:
+    e1, e2 = g['energy_range']
+  else:
+    e1, e2 = energy - bandwidth / 2., energy + bandwidth / 2.
+
+  if e2 > e1:
+    # sample photon energies from the reflectivity curve, and weight by the
+    # probability of a uniformly distributed photon being reflected
+    energies = bragg_energy + sigma * rng.randn(len(bragg_energy))
+    weights = weights * np.sqrt(2 * np.pi) * sigma / (e2 - e1)
+    weights[(energies < e1) | (energies > e2)] = 0
+  else:
+    energies = np.zeros(len(bragg_energy)) + e1
+    weights = weights * np.exp(-(energies - bragg_energy)**2 / (2 * sigma**2))
+
+  # reflect
+  origins = origins + t[:,np.newaxis] * directions
+  directions = geom.reflect_directions(directions, normals)
+
+  # pass through exit aperture and onto camera
+  _, t_exit, in_exit = geom.intersect_rays_with_rect(origins, directions, g['exit'])
+  cam, t_cam, on_cam = geom.intersect_rays_with_rect(origins, directions, g['camera'])
+  ok = in_exit & on_cam & (t_exit < t_cam) & (weights > 0)
+
+  cx = cam[ok,0]
+  cy = cam[ok,1]
+  px = np.minimum((cx * w).astype(int), w-1)
+  py = np.minimum((cy * h).astype(int), h-1)
+  index = py * w + px
+
+  weights = weights[ok]
+  energies = energies[ok]
+
+  return (np.bincount(index, weights, npix),
+          np.bincount(index, weights * energies, npix),
+          np.bincount(index, weights * energies**2, npix))
+
+def trace(spectrometer, num_rays, energy=None, bandwidth=0, spot_size=(0,0,0),
+          intrinsic_width=0.5, batch_size=100000, processes=1, seed=None):
+  """
+  Trace rays through a spectrometer onto the camera
+
+  Parameters
+  ----------
+    spectrometer: Spectrometer to simulate
+    num_rays: total number of rays to trace
+    energy: center of emitted energy distribution (if None, the spectrometer's
+            energy range is covered uniformly)
+    bandwidth: full width of the (uniform) emitted energy distribution
+    spot_size: (x,y,z) full widths of the (uniform) sample spot
+    intrinsic_width: FWHM in eV of the (gaussian) crystal reflectivity curve
+                     (must be > 0)
+    batch_size: number of rays traced at once (bounds memory usage)
+    processes: number of worker processes to trace batches in parallel
+    seed: random seed (for reproducible results)
+
+  Returns
+  -------
+    (intensity, mean_energy, sigma_energy)
+
+    intensity: fraction of emitted photons reaching each camera pixel
+    mean_energy: average energy of photons reaching each pixel (a simulated
+                 calibration matrix)
+    sigma_energy: standard deviation of energies reaching each pixel (the
+                  energy resolution of each pixel)
+
+  Rays are aimed at uniformly sampled points on the entrance apertures and
+  weighted by the solid angle they represent, so no rays are wasted on
+  directions that cannot enter the spectrometer. Photon energies are drawn
+  from the reflectivity curve of the crystal at each ray's Bragg angle, so no
+  rays are wasted on photons that would not be reflected either.
+  """
+  g = _geometry(spectrometer)
+
+  if energy is None and not g['energy_range']:
+    raise Exception("An energy must be given for spectrometers without an energy range")
+
+  if seed is None:
+    seed = np.random.randint(2**30)
+
+  num_batches = int(np.ceil(num_rays / float(batch_size)))
+  batches = [
+      (g, min(batch_size, num_rays - i * batch_size), num_rays, energy,
+       bandwidth, spot_size, intrinsic_width, seed + i)
+      for i in range(num_batches)
+      ]
+
+  if processes > 1:
+    pool = Pool(processes)
+    try:
+      results = pool.imap_unordered(_trace_batch, batches)
+      totals = _sum_results(results, g['camera_shape'])
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    totals = _sum_results((_trace_batch(b) for b in batches), g['camera_shape'])
+
+  intensity, esum, esqsum = totals
+
+  norm_ = intensity.copy()
+  norm_[norm_ == 0] = 1
+  mean_energy = esum / norm_
+  variance = esqsum / norm_ - mean_energy**2
+  variance[variance < 0] = 0
+
+  return intensity, mean_energy, np.sqrt(variance)
+
+def _sum_results(results, shape):
+  total = None
+  for res in results:
+    if total is None:
+      total = [r.copy() for r in res]
+    else:
+      for t, r in zip(total, res):
+        t += r
+  return [t.reshape(shape) for t in total]
+
+def simulate_exposure(spectrometer, energy, flux, num_rays=10**6, bandwidth=1.0,
+                      poisson=True, seed=None, **kwargs):
+  """
+  Simulate an exposure of elastically scattered radiation
+
+  Parameters
+  ----------
+    spectrometer: Spectrometer to simulate
+    energy: incident energy
+    flux: number of photons emitted by the sample during the exposure
+    num_rays: number of rays to trace
+    bandwidth: full width of the incident energy distribution
+    poisson: if True, add counting noise
+    seed: random seed
+
+    Any other keyword arguments are passed on to `trace`.
+
+  Returns
+  -------
+    Exposure with simulated pixel counts
+  """
+  intensity, _, _ = trace(spectrometer, num_rays, energy, bandwidth, seed=seed, **kwargs)
+
+  expected = intensity * flux
+  if poisson:
+    pixels = np.random.RandomState(seed).poisson(expected)
+  else:
+    pixels = np.round(expected)
+
+  exposure = Exposure()
+  exposure.pixels = pixels.astype('int32')
+  exposure.loaded = True
+  return exposure
+
+def simulate_calibration(spectrometer, energies, flux, **kwargs):
+  """
+  Simulate a set of elastic calibration exposures
+
+  Parameters
+  ----------
+    spectrometer: Spectrometer to simulate
+    energies: list of incident energies
+    flux: number of photons emitted by the sample during each exposure
+
+    Other keyword arguments are passed on to `simulate_exposure`.
+
+  Returns
+  -------
+    list of Exposures (one per energy), suitable for calibrate.calibrate()
+  """
+  seed = kwargs.pop('seed', None)
+  exposures = []
+  for i, energy in enumerate(energies):
+    if seed is not None:
+      kwargs['seed'] = seed + i * 100003
+    exposures.append(simulate_exposure(spectrometer, energy, flux, **kwargs))
+  return exposures
@@ -1,11 +1,86 @@
+import os
+import copy
 import minixs as mx
 from emission import process_spectrum
+from correction import CorrectionMaps, load_map
 import numpy as np
 from itertools import izip
 from parser import Parser, FLOAT, STRING, LIST
 
 class InvalidParameters(Exception): pass
 
+def linear_weights(x, xp):
+  """
+  Indices and weights for linearly interpolating at many points at once
+
+  Parameters:
+    x - points to interpolate at
+    xp - increasing coordinates of data points
+
+  Returns:
+    (lo, hi, w)
+
+    Interpolated values are (1 - w) * fp[lo] + w * fp[hi]. Points outside of
+    `xp` get the value of the nearest end point (as with np.interp).
+  """
+  x = np.asarray(x, dtype=float)
+  xp = np.asarray(xp, dtype=float)
+
+  if len(xp) == 1:
+    zero = np.zeros(len(x), dtype=int)
+    return zero, zero, np.zeros(len(x))
+
+  hi = np.clip(np.searchsorted(xp, x), 1, len(xp) - 1)
+  lo = hi - 1
+  w = np.clip((x - xp[lo]) / (xp[hi] - xp[lo]), 0, 1)
+  return lo, hi, w
+
+def _interp_axis(x, xp, fp, axis, method):
+  """
+  Interpolate N-dimensional array `fp` along one axis
+  """
+  if method == 'linear':
+    lo, hi, w = linear_weights(x, xp)
+    shape = [1] * fp.ndim
+    shape[axis] = len(w)
+    w = w.reshape(shape)
+    return (1 - w) * np.take(fp, lo, axis) + w * np.take(fp, hi, axis)
+  elif method == 'cubic':
+    # scipy is slow to import, so only do so when needed
+    from scipy.interpolate import interp1d
+    # like linear interpolation, use end points outside of data range
+    x = np.clip(x, xp[0], xp[-1])
+    return interp1d(xp, fp, kind='cubic', axis=axis, assume_sorted=True)(x)
+  else:
+    raise ValueError("Unknown interpolation method: '%s'" % method)
+
+def save_matrix(filename, incident, emission, intensity):
+  """
+  Save RIXS intensities in 3 column (incident energy, emission energy, intensity) form
+
+  Parameters:
+    filename - either filename or file handle to save to
+    incident - incident energies
+    emission - emission energies
+    intensity - len(emission) x len(incident) array of intensities (as
+                returned by RIXS.matrix_form)
+
+  Each incident energy is written as a block of lines, with blocks
+  separated by an empty line (as gnuplot's splot expects).
+  """
+  intensity = np.asarray(intensity)
+  line_fmt = "%12.2f %12.2f %.6e\n"
+
+  with mx.misc.to_filehandle(filename, "w") as (f, filename):
+    block = np.empty((len(emission), 3))
+    block[:,1] = emission
+    for i, energy in enumerate(incident):
+      if i > 0:
+        f.write("\n")
+      block[:,0] = energy
+      block[:,2] = intensity[:,i]
+      f.write((line_fmt * len(block)) % tuple(block.ravel().tolist()))
+
 class RIXS(object):
   """
   A RIXS Spectrum is a 2D spectrum of intensity vs incident and emitted photon energies.
@@ -22,27 +97,38 @@ class RIXS(object):
     self.I0s = []
     self.exposure_files = []
     self.filters = []
+    self.solid_angle_map_file = None
+    self.solid_angle_map = None
+    self.corrections = CorrectionMaps()
     self.spectrum = np.array([]) 
     self.filename = None
+    self.load_errors = []
     if filename:
       self.load(filename)
 
-  def save(self, filename=None, headers_only=False):
+  def save(self, filename=None, headers_only=False, compression=None):
     """
     Save RIXS file
 
     Parameters:
       filename - either filename or file handle to save to
+      headers_only - if True, only the header is saved
+      compression - None, 'gzip' or 'xz' (see misc.open_compressed). Files
+                    ending in '.gz' or '.xz' are compressed by default.
     """
-    with mx.misc.to_filehandle(filename, "w") as (f, filename):
-      if filename is None:
-        filename = self.filename
-      else:
-        self.filename = filename
+    if filename is None:
+      filename = self.filename
+    elif not mx.misc.writable(filename):
+      self.filename = filename
 
+    f = mx.misc.open_compressed(filename, "w", compression)
+    try:
       f.write("# miniXS RIXS Spectrum\n#\n")
       f.write("# Dataset: %s\n" % self.dataset_name)
       f.write("# Calibration File: %s\n" % self.calibration_file)
+      if self.solid_angle_map_file:
+        f.write("# Solid Angle Map: %s\n" % self.solid_angle_map_file)
+      self.corrections.write_header(f)
       f.write("# Incident Energies / I0s / Exposures:\n")
       for energy, I0, ef in izip(self.energies, self.I0s, self.exposure_files):
         f.write("#   %12.2f %12.2f %s\n" % (energy, I0, ef))
@@ -60,56 +146,64 @@ class RIXS(object):
       f.write("# E_incident   E_emission    Intensity  Uncertainty  Raw_Counts   Num_Pixels\n")
       if len(self.spectrum.shape) == 2 and self.spectrum.shape[1] == 6:
         fmt=('%12.2f', '%12.2f','%.6e','%.6e','% 11d',' % 11d')
-        fmt = ' '.join(fmt)
-        last_energy = None
-        for row in self.spectrum:
-          energy = row[0]
-
-          # place empty line between inc. energies
-          if last_energy is not None and energy != last_energy:
+        fmt = ' '.join(fmt) + '\n'
+
+        # write each run of rows with the same incident energy at once,
+        # placing an empty line between them
+        bounds = np.flatnonzero(np.diff(self.spectrum[:,0]) != 0) + 1
+        bounds = [0] + bounds.tolist() + [len(self.spectrum)]
+        for i, (start, end) in enumerate(izip(bounds[:-1], bounds[1:])):
+          if i > 0:
             f.write("\n")
-          last_energy = energy
-
-          f.write(fmt % tuple(row))
-          f.write("\n")
+          block = self.spectrum[start:end]
+          f.write((fmt * len(block)) % tuple(block.ravel().tolist()))
 
       elif len(self.spectrum) > 0:
         raise Exception("Invalid shape for RIXS spectrum array")
+    finally:
+      if f is not filename:
+        f.close()
+
+  @classmethod
+  def parser_info(cls):
+    """
+    Parser key types for RIXS headers
+    """
+    info = {
+      'Spectrometer': STRING,
+      'Dataset': STRING,
+      'Calibration File': STRING,
+      'Solid Angle Map': STRING,
+      'Incident Energies / I0s / Exposures': (LIST, (FLOAT, FLOAT, STRING)),
+      'Filters': (LIST, STRING),
+      }
+    info.update(CorrectionMaps.parser_info())
+    return info
 
   def load(self, filename=None, header_only=False):
+    self.load_errors = []
+
     if filename is None:
       filename = self.filename
     else:
       self.filename = filename
 
-    with open(filename, 'r') as f:
-      pos = f.tell()
-      line = f.readline()
+    header = []
+    parser = Parser(self.parser_info())
 
-      header = []
-
-      parser = Parser({
-        'Spectrometer': STRING,
-        'Dataset': STRING,
-        'Calibration File': STRING,
-        'Incident Energies / I0s / Exposures': (LIST, (FLOAT, FLOAT, STRING)),
-        'Filters': (LIST, STRING),
-        })
-
-      while line:
-        if line[0] == "#":
-          header.append(line[2:])
-        elif header_only:
-          return
-        else:
-          f.seek(pos)
-          self.spectrum = np.loadtxt(f)
-          if len(self.spectrum.shape) == 1:
-            self.spectrum.shape = (1,self.spectrum.shape[0])
-
-        pos = f.tell()
+    # gzip or xz compressed files are decompressed transparently
+    f = mx.misc.open_compressed(filename, 'r')
+    try:
+      line = f.readline()
+      while line.startswith('#'):
+        header.append(line[2:])
         line = f.readline()
 
+      if not header_only:
+        self.spectrum = np.array((line + f.read()).split(), dtype=float).reshape((-1, 6))
+    finally:
+      f.close()
+
     parsed = parser.parse(header)
     if parser.errors:
       self.load_errors += parser.errors
@@ -121,7 +215,15 @@ class RIXS(object):
     self.I0s = [ei[1] for ei in exposure_info]
     self.exposure_files = [ei[2] for ei in exposure_info]
 
-    self.calibration_file = parsed.get('Calibration', None)
+    self.calibration_file = parsed.get('Calibration File', None)
+
+    solid_angle_map = parsed.get('Solid Angle Map')
+    if solid_angle_map:
+      try:
+        self._load_solid_angle_map(solid_angle_map)
+      except IOError as e:
+        self.load_errors.append(str(e))
+    self.load_errors += self.corrections.read_header(parsed)
 
     self.filters = []
     for filter_line in parsed.get('Filters', []):
@@ -134,6 +236,15 @@ class RIXS(object):
         fltr.set_str(val.strip())
         self.filters.append(fltr)
 
+  def _load_solid_angle_map(self, map_file):
+    """
+    Load solid angle map (text or binary .npy format, see correction.load_map)
+    """
+    if os.path.exists(map_file):
+      map_file = os.path.abspath(map_file)
+    self.solid_angle_map = load_map(map_file)
+    self.solid_angle_map_file = map_file
+
   def _validate_before_processing(self):
     self.errors = []
 
@@ -160,6 +271,8 @@ class RIXS(object):
       self.exposure_files is list of exposure filenames
       self.energies is list of incident energies corresponding to exposure_files
       self.I0s is list of incident fluxes corresponding to exposure_files
+      self.solid_angle_map may be a map of solid angles subtended by each pixel
+      self.corrections may contain dark, flat field and efficiency maps to apply
 
     Parameters:
       emission_energies - list of points for emission energy grid
@@ -203,7 +316,9 @@ class RIXS(object):
                              self.I0s[i],
                              calibration.dispersive_direction,
                              calibration.xtals,
-                             skip_columns=skip_columns)
+                             self.solid_angle_map,
+                             skip_columns=skip_columns,
+                             correction=self.corrections)
 
       spectrum[i*stride:(i+1)*stride,0] = energy
       spectrum[i*stride:(i+1)*stride,1:] = xes
@@ -227,6 +342,55 @@ class RIXS(object):
     i = len(inc_energies)
     return (inc_energies, emit_energies, self.spectrum[:,2].reshape((i,len(self.spectrum)/i)).T)
 
+  def regrid(self, incident_grid=None, emission_grid=None, method='linear'):
+    """
+    Interpolate RIXS spectrum onto new incident and emission energy grids
+
+    Parameters:
+      incident_grid - new incident energies (default: keep current ones)
+      emission_grid - new emission energies (default: keep current ones)
+      method - 'linear' or 'cubic'
+
+    Returns:
+      new RIXS with the same header information
+
+    The interpolation is separable: all emission energies are first
+    interpolated along the incident axis at once, and then all incident
+    energies along the emission axis. Intensities, raw counts and numbers of
+    pixels are interpolated directly, and uncertainties through their
+    variances. Points outside of the original grids get the value of the
+    nearest edge.
+    """
+    num_incident = len(np.unique(self.spectrum[:,0]))
+    cube = self.spectrum.reshape((num_incident, -1, 6))
+    cube = cube[np.argsort(cube[:,0,0], kind='mergesort')]
+
+    incident = cube[:,0,0]
+    emission = cube[0,:,1]
+
+    values = cube[:,:,2:].copy()
+    values[:,:,1] **= 2
+
+    if incident_grid is not None:
+      incident = np.asarray(incident_grid, dtype=float)
+      values = _interp_axis(incident, cube[:,0,0], values, 0, method)
+    if emission_grid is not None:
+      emission = np.asarray(emission_grid, dtype=float)
+      values = _interp_axis(emission, cube[0,:,1], values, 1, method)
+
+    # cubic interpolation can overshoot below 0
+    values[:,:,1] = np.sqrt(np.clip(values[:,:,1], 0, None))
+
+    spectrum = np.empty((len(incident), len(emission), 6))
+    spectrum[:,:,0] = incident[:,np.newaxis]
+    spectrum[:,:,1] = emission
+    spectrum[:,:,2:] = values
+
+    rixs = copy.copy(self)
+    rixs.filename = None
+    rixs.spectrum = spectrum.reshape((-1, 6))
+    return rixs
+
   def xes_cut(self, energy):
     """
     Get constant incident energy slice of RIXS spectrum
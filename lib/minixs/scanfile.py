@@ -1,7 +1,76 @@
+import os
+import time
 import numpy as np
 
 SCAN_COLUMN_WIDTH = 21
 
+def parse_rows(block, num_columns, width=SCAN_COLUMN_WIDTH):
+  """
+  Parse a block of complete data lines into an array
+
+  Parameters:
+    block - string containing whole lines of whitespace separated values
+    num_columns - number of values per line
+    width - width of fixed width columns (each followed by a single space)
+
+  Returns:
+    N x num_columns array
+
+  Blocks written by ScanFile.save (or PNC's LabVIEW) consist of fixed width
+  columns, which are converted directly without splitting lines. Any other
+  layout falls back to splitting on whitespace. Comment lines (starting
+  with '#', e.g. annotations of a paused scan) are skipped.
+  """
+  if '#' in block:
+    block = ''.join(line for line in block.splitlines(True)
+                    if not line.lstrip().startswith('#'))
+
+  if not block:
+    return np.zeros((0, num_columns))
+
+  line_length = block.find('\n') + 1
+  field = width + 1
+
+  if line_length > num_columns * field and len(block) % line_length == 0:
+    chars = np.frombuffer(block, dtype='S1').reshape((-1, line_length))
+    if (chars[:,-1] == '\n').all() and (chars[:,field-1:num_columns*field:field] == ' ').all():
+      fields = chars[:,:num_columns*field].copy().view('S%d' % field)
+      try:
+        return fields.astype(float)
+      except ValueError:
+        # not really fixed width (e.g. blank fields)
+        pass
+
+  values = np.array(block.split(), dtype=float)
+  if len(values) % num_columns != 0:
+    raise ValueError("Scan data does not have %d columns on every line" % num_columns)
+  return values.reshape((-1, num_columns))
+
+def format_rows(data, fmt='%%%d.8f' % SCAN_COLUMN_WIDTH, block_size=4096):
+  """
+  Format rows of data as lines of a scan file
+
+  Parameters:
+    data - N x M array
+    fmt - format of each value (each is followed by a space)
+    block_size - number of rows formatted at once
+
+  Yields:
+    strings containing up to `block_size` lines each, ending in '\r\n'
+
+  Each block is formatted with a single string operation, which is much
+  faster than formatting values (or rows, as np.savetxt does) one by one.
+  """
+  if len(data) == 0:
+    return
+
+  num_columns = data.shape[1]
+  line_fmt = (fmt + ' ') * num_columns + '\r\n'
+
+  for i in xrange(0, len(data), block_size):
+    block = data[i:i+block_size]
+    yield (line_fmt * len(block)) % tuple(block.ravel().tolist())
+
 class ScanFile(object):
   """
   A PNC (Advanced Photon Source Sector 20) scan file.
@@ -22,36 +91,200 @@ class ScanFile(object):
     >>> len(s.headers)
     59
 
+  Scans that are still running can be followed as they grow. Only rows
+  appended since the last read are parsed:
+
+    >>> s = mx.scanfile.ScanFile(filename)
+    >>> new_rows = s.update()
+    >>> for row in s.follow(timeout=60):
+    ...   print row[0], row[5]
   """
   def __init__(self, filename=None):
+    self.filename = None
+    self.headers = []
+    self.columns = []
+    self.data = np.zeros((0,0))
+    self.offset = 0
+    self.size = None
+    self.tail = ''
+    self.inode = None
+    self.mtime = None
+    self.open_line = 0
+
     if filename:
       self.load(filename)
 
   def load(self, filename, headers_only=False):
     self.filename = filename
+    self.headers = []
+    self.columns = []
+    self.data = np.zeros((0,0))
 
-    #read in headers
-    with open(filename) as f:
-      self.headers = []
-      for line in f:
-        if line[0] != '#':
-          # rewind to beginning of this line
-          f.seek(-len(line), 1)
-          break
+    # byte offset of first line that hasn't been read yet
+    self.offset = 0
+    # file size, inode and mtime at the last update, and the bytes just before offset
+    # (used to detect files that have been rewritten)
+    self.size = None
+    self.tail = ''
+    self.inode = None
+    self.mtime = None
+    # length of a last line that was parsed without its newline
+    self.open_line = 0
 
-        # strip off '#' and newline
-        self.headers.append(line)
+    if headers_only:
+      with open(filename, 'rb') as f:
+        for line in f:
+          if line[0] != '#':
+            break
+          self.headers.append(line)
+          self.offset += len(line)
+      self._parse_column_names()
+    else:
+      self.update(partial=True)
+
+  def _parse_column_names(self):
+    if not self.headers:
+      self.columns = []
+      return
 
     column_names = self.headers[-1]
     self.columns = [column_names[i:i+SCAN_COLUMN_WIDTH].strip() for i in xrange(1,len(column_names)-2, SCAN_COLUMN_WIDTH)]
 
-    # load in data
-    if not headers_only:
-      self.data = np.loadtxt(filename)
+  def update(self, partial=False):
+    """
+    Read rows appended to the file since it was last read
+
+    Parameters:
+      partial - also parse a last line that doesn't end in a newline
+
+    While a file is growing, a partially written last line is left for the
+    next update. It is parsed if `partial` is True (as when loading), or if
+    the file hasn't changed size since the previous update. If the file
+    has been replaced (e.g. a new scan was started with the same name, or
+    the file was rewritten), it is reloaded from the beginning.
 
-      # reshape single column
-      if len(self.data.shape) == 1:
-        self.data.shape = (self.data.shape[0], 1)
+    Returns:
+      array of new rows (N x number of columns)
+    """
+    with open(self.filename, 'rb') as f:
+      st = os.fstat(f.fileno())
+      # the first header contains the scan's start time, and the bytes
+      # already read must not have changed
+      replaced = (st.st_size < self.offset or
+                  (self.inode is not None and st.st_ino != self.inode) or
+                  (st.st_size == self.size and st.st_mtime != self.mtime) or
+                  (self.headers and f.readline() != self.headers[0]))
+      if not replaced and self.tail:
+        f.seek(self.offset - len(self.tail))
+        replaced = f.read(len(self.tail)) != self.tail
+      if not replaced and self.open_line and st.st_size != self.size:
+        # the last line was read before it was finished, so read it again
+        self.data = self.data[:-1]
+        self.offset -= self.open_line
+        self.tail = self.tail[:-self.open_line] if len(self.tail) > self.open_line else ''
+        self.open_line = 0
+      if not replaced:
+        f.seek(self.offset)
+        block = f.read()
+
+    if replaced:
+      self.load(self.filename)
+      return self.data
+
+    unchanged = st.st_size == self.size
+    self.size = st.st_size
+    self.inode = st.st_ino
+    self.mtime = st.st_mtime
+
+    # while the file may still be growing, only use complete lines
+    end = block.rfind('\n') + 1
+    block, last = block[:end], block[end:]
+    if not (partial or unchanged):
+      last = ''
+
+    # headers may still be arriving if no data has been written yet
+    if len(self.data) == 0:
+      pos = 0
+      while block.startswith('#', pos):
+        eol = block.index('\n', pos) + 1
+        self.headers.append(block[pos:eol])
+        pos = eol
+      if pos == len(block) and last.startswith('#'):
+        self.headers.append(last)
+        pos += len(last)
+        block += last
+        last = ''
+      if pos:
+        self._parse_column_names()
+        self._advance(block[:pos])
+        block = block[pos:]
+
+    if not block.strip() and not last.strip():
+      self._advance(block)
+      return np.zeros((0, self.data.shape[1]))
+
+    if len(self.data) == 0:
+      fields = [line.split() for line in (block + last).splitlines()]
+      num_columns = next((len(f) for f in fields if f and not f[0].startswith('#')), 0)
+    else:
+      num_columns = self.data.shape[1]
+
+    rows = parse_rows(block, num_columns)
+    self._advance(block)
+
+    # a last line without a newline is only used if it is a complete row
+    if last.strip():
+      try:
+        row = parse_rows(last, num_columns)
+      except ValueError:
+        row = None
+      if row is not None and len(row) > 0:
+        rows = np.vstack([rows, row])
+        self._advance(last)
+        self.open_line = len(last)
+
+    if len(self.data) == 0:
+      self.data = rows
+    else:
+      self.data = np.vstack([self.data, rows])
+
+    return rows
+
+  def _advance(self, block):
+    """
+    Move offset past a block that has been read
+    """
+    self.offset += len(block)
+    self.tail = (self.tail + block)[-64:]
+
+  def follow(self, start=0, interval=0.5, timeout=None):
+    """
+    Generate rows as they are appended to the scan file
+
+    Parameters:
+      start - index of first row to generate (rows already read are
+              generated immediately)
+      interval - time in seconds between checks for new rows
+      timeout - stop after this many seconds without a new row
+                (None to follow forever)
+
+    Yields:
+      1D array of values for each row
+    """
+    i = start
+    last_row = time.time()
+
+    while True:
+      while i < len(self.data):
+        yield self.data[i]
+        i += 1
+        last_row = time.time()
+
+      if timeout is not None and time.time() - last_row > timeout:
+        return
+
+      time.sleep(interval)
+      self.update()
 
   def save(self, filename=None, fmt=None):
     if not filename:
@@ -62,22 +295,43 @@ class ScanFile(object):
     if fmt is None:
       fmt = '%%%d.8f' % SCAN_COLUMN_WIDTH
 
-    with open(filename, 'w') as f:
+    # binary mode, so that lines end in '\r\n' on all platforms
+    with open(filename, 'wb') as f:
       for line in self.headers:
         f.write(line)
 
-      # numpy cannot save with dos newlines...
-      #savetxt(f, self.data, fmt=fmt, delimiter=' ')
-
-      # so, save by hand
-      for row in self.data:
-        for val in row:
-          f.write(fmt % val)
-          f.write(' ')
-        f.write('\r\n')
+      for block in format_rows(self.data, fmt):
+        f.write(block)
 
   def find_column(self, key):
     for i,col in enumerate(self.columns):
       if key in col.lower():
         return i
     return None
+
+  def find_energy_and_i0_columns(self, energy_column=None, i0_column=None):
+    """
+    Determine which columns contain the mono energy and I0
+
+    Parameters:
+      energy_column - index of energy column (if None, the first column whose
+                      name contains 'mono' or 'energy' is used)
+      i0_column - index of I0 column (if None, the first column whose name
+                  contains 'i0' is used)
+
+    Returns:
+      (energy_column, i0_column)
+    """
+    if energy_column is None:
+      energy_column = self.find_column('mono')
+      if energy_column is None:
+        energy_column = self.find_column('energy')
+      if energy_column is None:
+        raise Exception("Unable to determine which column of scan file '%s' contains monochrometer energy." % self.filename)
+
+    if i0_column is None:
+      i0_column = self.find_column('i0')
+      if i0_column is None:
+        raise Exception("Unable to determine which column of scan file '%s' contains I0." % self.filename)
+
+    return energy_column, i0_column
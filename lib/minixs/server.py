@@ -0,0 +1,447 @@
+"""
+Persistent processing server
+
+A long running server keeps calibrations, spectrometers, correction maps
+and killzones loaded, and processes emission spectra on request. This
+avoids paying for imports and file parsing on every exposure.
+
+Requests and responses are JSON objects, one per line, sent over a local
+UNIX socket (or a TCP socket given as "host:port").
+
+Requests:
+  {"command": "process", ...}  - process a spectrum (see `process_request`)
+  {"command": "ping"}          - check that server is alive
+  {"command": "stats"}         - report cache sizes and requests handled
+  {"command": "clear"}         - forget all cached files
+  {"command": "shutdown"}      - stop server
+
+Responses:
+  {"status": "ok", ...} or {"status": "error", "message": "..."}
+
+Classes:
+  ProcessingCache - cache of loaded calibrations and killzones
+  ProcessingServer - socket server mixin handling requests with a pool of workers
+  Client - connection to a running server
+
+Functions:
+  create_server - create a server listening on a UNIX or TCP socket
+  serve - run a server until it is shut down
+  process_request - process a spectrum described by a request
+
+Example:
+  $ minixs serve &
+  >>> import minixs as mx
+  >>> c = mx.server.Client()
+  >>> spectrum = c.process(calibration='/data/fe.calib', exposures=['/data/fe_001.tif'], i0=1e5)
+"""
+
+import os
+import sys
+import json
+import socket
+import getpass
+import tempfile
+import threading
+import traceback
+import SocketServer
+from StringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+import minixs as mx
+import calibrate
+import correction
+import emission
+import filter
+from killzone import KillzoneList
+
+DEFAULT_ADDRESS = os.environ.get('MINIXS_SOCKET',
+    os.path.join(tempfile.gettempdir(), 'minixs-%s.sock' % getpass.getuser()))
+
+DEFAULT_WORKERS = 4
+
+# default request parameters (these mirror the options of bin/process_xes)
+PROCESS_DEFAULTS = {
+    'calibration': None,
+    'exposures': [],
+    'output': None,
+    'energy': 0,
+    'i0': 1,
+    'dataset': '',
+    'bad_pixels': [],
+    'high_filter': 10000,
+    'stepsize': .1,
+    'solid_angle_map': None,
+    'flat_map': None,
+    'efficiency_map': None,
+    'dark_map': None,
+    'binned': False,
+    'killzones': None,
+    'killzone_pixels': False,
+    'footprints': False,
+    }
+
+def parse_address(address):
+  """
+  Convert address string to socket family and address
+
+  Addresses of the form "host:port" are TCP sockets. All others are paths
+  to UNIX sockets.
+  """
+  if ':' in address and os.sep not in address:
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+  return socket.AF_UNIX, address
+
+class ProcessingCache(object):
+  """
+  Loaded calibrations and killzone lists, keyed by path
+
+  Files are reloaded whenever they are modified. Spectrometers and
+  correction maps are cached by their own modules.
+  """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.calibrations = {}
+    self.killzones = {}
+
+  def _get(self, cache, path, load):
+    path = os.path.abspath(path)
+    mtime = os.path.getmtime(path)
+
+    with self.lock:
+      cached = cache.get(path)
+    if cached is not None and cached[0] == mtime:
+      return cached[1]
+
+    value = load(path)
+    with self.lock:
+      cache[path] = (mtime, value)
+    return value
+
+  def calibration(self, path):
+    """
+    Get loaded Calibration
+    """
+    def load(path):
+      cal = calibrate.Calibration()
+      cal.load(path)
+      if cal.load_errors:
+        raise Exception("Unable to load calibration '%s':\n%s" % (path, '\n'.join(cal.load_errors)))
+      return cal
+    return self._get(self.calibrations, path, load)
+
+  def killzone_list(self, path):
+    """
+    Get loaded KillzoneList
+    """
+    def load(path):
+      kz = KillzoneList()
+      kz.load(path)
+      return kz
+    return self._get(self.killzones, path, load)
+
+  def clear(self):
+    with self.lock:
+      self.calibrations.clear()
+      self.killzones.clear()
+    correction.clear_cache()
+    mx.spectrometer.clear_registry()
+
+  def stats(self):
+    with self.lock:
+      return {
+          'calibrations': len(self.calibrations),
+          'killzones': len(self.killzones),
+          }
+
+def _filters(request, calib):
+  """
+  Create filters for a request (as done by bin/process_xes)
+  """
+  filters = []
+  if request['bad_pixels']:
+    fltr = filter.BadPixelFilter()
+    fltr.set_val((fltr.MODE_ZERO_OUT, [[int(x), int(y)] for x,y in request['bad_pixels']]))
+    filters.append(fltr)
+
+  if request['high_filter'] is not None:
+    fltr = filter.HighFilter()
+    fltr.set_val(request['high_filter'])
+    filters.append(fltr)
+  return filters
+
+def process_request(request, cache):
+  """
+  Process an emission spectrum
+
+  Parameters:
+    request - dict with any of the following keys:
+        calibration - calibration filename (required)
+        exposures - list of exposure filenames (required)
+        output - filename to save spectrum to (if not given, the spectrum
+                 is returned instead)
+        energy - incident energy
+        i0 - incident flux
+        dataset - dataset name
+        bad_pixels - list of (x,y) pixels to zero out
+        high_filter - remove pixels with more counts than this (or None)
+        stepsize - emission energy step size
+        solid_angle_map, flat_map, efficiency_map, dark_map - map filenames
+        binned - bin pixels instead of interpolating
+        killzones - killzone definition filename
+        killzone_pixels - only exclude killzoned pixels instead of columns
+        footprints - only use pixels within the crystal footprints
+    cache - ProcessingCache
+
+  All filenames must be absolute (or relative to the server's directory).
+
+  Returns:
+    dict with either 'output' (filename written) or 'spectrum' (list of rows)
+    and 'xes' (contents of .xes file)
+  """
+  unknown = set(request.keys()) - set(PROCESS_DEFAULTS.keys()) - set(['command'])
+  if unknown:
+    raise Exception("Unknown request parameters: %s" % ', '.join(sorted(unknown)))
+
+  r = dict(PROCESS_DEFAULTS)
+  r.update(request)
+
+  if not r['calibration']:
+    raise Exception("A calibration file must be given")
+  if not r['exposures']:
+    raise Exception("At least one exposure file must be given")
+
+  calib = cache.calibration(r['calibration'])
+
+  xes = emission.EmissionSpectrum()
+  xes.dataset_name = r['dataset']
+  xes.calibration_file = os.path.realpath(r['calibration'])
+  xes.incident_energy = r['energy']
+  xes.exposure_files = [os.path.realpath(f) for f in r['exposures']]
+  if r['solid_angle_map']:
+    xes._load_solid_angle_map(r['solid_angle_map'])
+  xes.corrections.flat_map_file = correction.normalize_map_path(r['flat_map']) or None
+  xes.corrections.efficiency_map_file = correction.normalize_map_path(r['efficiency_map']) or None
+  xes.corrections.dark_map_file = correction.normalize_map_path(r['dark_map']) or None
+  xes.I0 = r['i0']
+  xes.filters = _filters(r, calib)
+
+  killzone_mask = None
+  if r['killzones']:
+    killzone_list = cache.killzone_list(r['killzones'])
+    for f in xes.exposure_files:
+      file_mask = killzone_list.mask(f)
+      if file_mask is not None:
+        if killzone_mask is None:
+          killzone_mask = file_mask
+        else:
+          killzone_mask |= file_mask
+
+  E1, E2 = calib.energy_range()
+  if r['binned']:
+    xes.process_binned(E1, E2, r['stepsize'], killzone_mask, calibration=calib)
+  else:
+    if r['killzone_pixels']:
+      killzone_mode = emission.KILLZONE_SKIP_PIXELS
+    else:
+      killzone_mode = emission.KILLZONE_SKIP_COLUMNS
+
+    xtal_masks = None
+    if r['footprints']:
+      if calib.spectrometer is None:
+        raise Exception("The calibration has no spectrometer, so crystal footprints are unknown")
+      xtal_masks = calib.spectrometer.xtal_masks().any(0)
+
+    grid = np.arange(round(E1), round(E2), r['stepsize'])
+    xes.process(grid, killzone_mask=killzone_mask, killzone_mode=killzone_mode,
+                xtal_masks=xtal_masks, calibration=calib)
+
+  if r['output']:
+    xes.save(r['output'])
+    return {'output': r['output']}
+  else:
+    text = StringIO()
+    xes.save(text)
+    return {'spectrum': xes.spectrum.tolist(), 'xes': text.getvalue()}
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+  """
+  Handle requests from a single connection (one JSON object per line)
+  """
+  def handle(self):
+    for line in iter(self.rfile.readline, ''):
+      if not line.strip():
+        continue
+
+      response = self.server.respond(line)
+      self.wfile.write(json.dumps(response) + '\n')
+      self.wfile.flush()
+
+class ProcessingServer:
+  """
+  Mixin for socket servers handling each connection on a pool of worker threads
+
+  Use `create_server` to construct a server for an address.
+  """
+  allow_reuse_address = True
+
+  def setup_pool(self, workers, cache=None, verbose=False):
+    self.pool = ThreadPool(workers)
+    self.cache = cache or ProcessingCache()
+    self.verbose = verbose
+    self.num_requests = 0
+    self.count_lock = threading.Lock()
+
+  def process_request(self, request, client_address):
+    self.pool.apply_async(self._process_request_worker, (request, client_address))
+
+  def _process_request_worker(self, request, client_address):
+    try:
+      self.finish_request(request, client_address)
+    except Exception:
+      self.handle_error(request, client_address)
+    finally:
+      self.shutdown_request(request)
+
+  def respond(self, line):
+    """
+    Handle a single request
+
+    Returns:
+      response dict
+    """
+    with self.count_lock:
+      self.num_requests += 1
+
+    try:
+      request = json.loads(line)
+      command = request.get('command', 'process')
+
+      if command == 'process':
+        response = process_request(request, self.cache)
+      elif command == 'ping':
+        response = {'pid': os.getpid()}
+      elif command == 'stats':
+        response = self.cache.stats()
+        response['requests'] = self.num_requests
+      elif command == 'clear':
+        self.cache.clear()
+        response = {}
+      elif command == 'shutdown':
+        # shutdown() blocks until serve_forever() returns, so call it from another thread
+        threading.Thread(target=self.shutdown).start()
+        response = {}
+      else:
+        raise Exception("Unknown command: %s" % command)
+
+      response['status'] = 'ok'
+    except Exception as e:
+      if self.verbose:
+        traceback.print_exc()
+      response = {'status': 'error', 'message': str(e)}
+
+    return response
+
+  def server_close(self):
+    self.pool.close()
+    self.pool.join()
+
+class UnixProcessingServer(ProcessingServer, SocketServer.UnixStreamServer):
+  def server_close(self):
+    SocketServer.UnixStreamServer.server_close(self)
+    ProcessingServer.server_close(self)
+    if os.path.exists(self.server_address):
+      os.remove(self.server_address)
+
+class TCPProcessingServer(ProcessingServer, SocketServer.TCPServer):
+  def server_close(self):
+    SocketServer.TCPServer.server_close(self)
+    ProcessingServer.server_close(self)
+
+def create_server(address=DEFAULT_ADDRESS, workers=DEFAULT_WORKERS, verbose=False):
+  """
+  Create a processing server listening on an address
+
+  Parameters:
+    address - path of UNIX socket, or "host:port" for a TCP socket
+    workers - number of requests to handle concurrently
+    verbose - print tracebacks of failed requests
+  """
+  family, addr = parse_address(address)
+  if family == socket.AF_UNIX:
+    server_class = UnixProcessingServer
+    if os.path.exists(addr):
+      # remove stale socket left by a server that didn't shut down cleanly
+      try:
+        Client(address).request({'command': 'ping'})
+      except socket.error:
+        os.remove(addr)
+      else:
+        raise Exception("A server is already running at '%s'" % addr)
+  else:
+    server_class = TCPProcessingServer
+
+  server = server_class(addr, RequestHandler)
+  server.setup_pool(workers, verbose=verbose)
+  return server
+
+def serve(address=DEFAULT_ADDRESS, workers=DEFAULT_WORKERS, verbose=False):
+  """
+  Run a processing server until it receives a shutdown request
+
+  Parameters:
+    address - path of UNIX socket, or "host:port" for a TCP socket
+    workers - number of requests to handle concurrently
+    verbose - print tracebacks of failed requests
+  """
+  server = create_server(address, workers, verbose)
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
+
+class Client(object):
+  """
+  Connection to a processing server
+  """
+  def __init__(self, address=DEFAULT_ADDRESS, timeout=None):
+    family, addr = parse_address(address)
+    self.sock = socket.socket(family, socket.SOCK_STREAM)
+    self.sock.settimeout(timeout)
+    self.sock.connect(addr)
+    self.rfile = self.sock.makefile('r')
+
+  def close(self):
+    self.rfile.close()
+    self.sock.close()
+
+  def request(self, request):
+    """
+    Send a request and wait for its response
+
+    Raises an Exception if the server reports an error.
+    """
+    self.sock.sendall(json.dumps(request) + '\n')
+    line = self.rfile.readline()
+    if not line:
+      raise Exception("Connection closed by server")
+
+    response = json.loads(line)
+    if response.get('status') != 'ok':
+      raise Exception(response.get('message', 'Unknown error'))
+    return response
+
+  def process(self, **kwargs):
+    """
+    Process a spectrum (see `process_request` for parameters)
+
+    Returns:
+      N x 5 spectrum array, or output filename if `output` is given
+    """
+    kwargs['command'] = 'process'
+    response = self.request(kwargs)
+    if 'output' in response:
+      return response['output']
+    return np.array(response['spectrum']).reshape((-1,5))
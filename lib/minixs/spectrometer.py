@@ -1,5 +1,6 @@
 import os
 from glob import glob
+from copy import deepcopy
 from parser import Parser, STRING, INT, FLOAT, LIST
 import numpy as np
 from numpy.linalg import norm
@@ -18,6 +19,20 @@ lattice_constants = {
     'GaP': 5.4512,
     }
 
+# attributes defining the geometry of a spectrometer
+# (memoized results are discarded whenever any of these change)
+GEOMETRY_ATTRIBUTES = [
+    'camera_shape',
+    'sample',
+    'beam',
+    'camera',
+    'xtals',
+    'exit_aperture',
+    'entrance_aperture',
+    'xtal_type',
+    'xtal_cut',
+    ]
+
 def clamp(v, min, max):
   if v < min:
     return min
@@ -26,19 +41,108 @@ def clamp(v, min, max):
   else:
     return v
 
+# other attributes that may not be changed on frozen spectrometers
+FROZEN_ATTRIBUTES = [
+    'tag',
+    'filename',
+    'name',
+    'element',
+    'line',
+    'energy_range',
+    'E0',
+    'num_xtals',
+    'dispersive_direction',
+    'xtal_rects',
+    'camera_rect',
+    ]
+
+def _make_read_only(val):
+  """
+  Make all arrays in a (nested list of) arrays or geom objects read only
+  """
+  if isinstance(val, np.ndarray):
+    val.flags.writeable = False
+  elif isinstance(val, (list, tuple)):
+    for v in val:
+      _make_read_only(v)
+  elif isinstance(val, geom.Plane):
+    for v in val.__dict__.values():
+      _make_read_only(v)
+
+def _writeable_copy(val):
+  """
+  Copy a (nested list of) arrays or geom objects, with writeable arrays
+  """
+  if isinstance(val, np.ndarray):
+    return np.array(val)
+  elif isinstance(val, list):
+    return [_writeable_copy(v) for v in val]
+  elif isinstance(val, tuple):
+    return tuple(_writeable_copy(v) for v in val)
+  elif isinstance(val, geom.Plane):
+    for k, v in val.__dict__.items():
+      val.__dict__[k] = _writeable_copy(v)
+  return val
+
 def tag_to_path(tag):
   return os.path.join(SPECTROMETER_DATADIR, tag)
 
+# path => (mtime, Spectrometer)
+_registry = {}
+
+def get_spectrometer(name):
+  """
+  Get a shared, read only Spectrometer
+
+  Parameters:
+    name - spectrometer tag or filename
+
+  Each definition file is only parsed once (and again if it is modified).
+  Since the same object is returned to every caller, results derived from
+  its geometry (image points, projection bounds, mockup calibration
+  matrices, etc) are also only calculated once.
+
+  The returned Spectrometer may not be modified. Use its copy() method to
+  obtain a modifiable version.
+  """
+  if name == os.path.basename(name) and os.path.exists(tag_to_path(name)):
+    path, tag = tag_to_path(name), name
+  elif os.path.exists(name):
+    path, tag = os.path.abspath(name), None
+    # bundled spectrometers are always identified by tag
+    if os.path.dirname(path) == os.path.abspath(SPECTROMETER_DATADIR):
+      tag = os.path.basename(path)
+  else:
+    raise Exception("Unknown Spectrometer tag: %s" % name)
+
+  mtime = os.path.getmtime(path)
+  cached = _registry.get(path)
+  if cached is not None and cached[0] == mtime:
+    return cached[1]
+
+  s = Spectrometer()
+  s.load(path)
+  s.tag = tag
+  s.freeze()
+
+  _registry[path] = (mtime, s)
+  return s
+
+def clear_registry():
+  """
+  Forget all shared spectrometers
+  """
+  _registry.clear()
+
 def list_spectrometers(include_names=False):
   files = glob(tag_to_path('*'))
   files.sort()
   if include_names:
-    s = Spectrometer()
     tags = []
     names = []
     for f in files:
       try:
-        s.load(f)
+        s = get_spectrometer(f)
       except:
         print ("Invalid spectrometer file: %s" % f)
         continue
@@ -63,11 +167,23 @@ class Spectrometer(object):
 
   Additionally, includes methods to perform raytracing and generate
   mockup calibration.
+
+  Derived quantities (camera pixel locations, image points, projection
+  bounds, mockup calibration matrices and solid angle maps) are memoized,
+  and recalculated only after the geometry changes.
+
+  Shared instances (see `get_spectrometer`) are frozen: their geometry may
+  not be changed.
   """
   def __init__(self, tag=None):
+    self._frozen = False
+
     self.tag = None
     self.filename = None
 
+    self._memo = {}
+    self._memo_key = None
+
     self.camera_shape = (195, 487)
     if tag:
       if os.path.exists(tag):
@@ -75,6 +191,33 @@ class Spectrometer(object):
       else:
         self.load_by_tag(tag)
 
+  def __setattr__(self, name, value):
+    if getattr(self, '_frozen', False) and (name in GEOMETRY_ATTRIBUTES or name in FROZEN_ATTRIBUTES):
+      raise AttributeError("Shared spectrometer can't be modified (use copy() to get a modifiable one)")
+    object.__setattr__(self, name, value)
+
+  def freeze(self):
+    """
+    Prevent any further changes to geometry
+
+    All geometry arrays are made read only, and assigning to any geometry
+    attribute raises an AttributeError.
+    """
+    for attr in GEOMETRY_ATTRIBUTES + ['xtal_rects', 'camera_rect']:
+      _make_read_only(getattr(self, attr, None))
+    self._frozen = True
+
+  def copy(self):
+    """
+    Make a modifiable copy
+    """
+    s = deepcopy(self)
+    object.__setattr__(s, '_frozen', False)
+    for attr in GEOMETRY_ATTRIBUTES + ['xtal_rects', 'camera_rect']:
+      if hasattr(s, attr):
+        setattr(s, attr, _writeable_copy(getattr(s, attr)))
+    return s
+
   def load_by_tag(self, tag):
     path = tag_to_path(tag)
     if os.path.exists(path):
@@ -208,36 +351,67 @@ class Spectrometer(object):
         self.load_errors.append('Beam direction not specified')
 
   def camera_pixel_to_point(self, pixel):
-    # returns the coordinates of the top left corner of the request pixel
-    px,py = pixel
-    h,w = self.camera_shape
-
-    cam_x = self.camera[1] - self.camera[0]
-    cam_y = self.camera[3] - self.camera[0]
+    """
+    Convert pixel coordinates (or N x 2 array of them) to points on the camera
 
-    return self.camera[0] + px / float(w) * cam_x + py / float(h) * cam_y
+    Integer coordinates correspond to the top left corner of a pixel.
+    """
+    h,w = self.camera_shape
+    local = np.asarray(pixel, dtype=float) / (w, h)
+    return self.camera_rect.local_to_global(local)
 
   def point_to_camera_pixel(self, point, tolerance=.001):
+    pixels, mask = self.points_to_camera_pixels([point], tolerance)
+    if not mask[0]:
+      return None # not in plane
+    return tuple(pixels[0])
 
-    d = point - self.camera_rect.p0
+  def points_to_camera_pixels(self, points, tolerance=.001):
+    """
+    Convert N x 3 array of points on the camera plane to pixel coordinates
 
-    # check that point is within tolerance of plane
-    if abs(np.dot(d,self.camera_rect.n)) > tolerance:
-      return None # not in plane
+    Returns:
+      (pixels, mask)
 
-    cx = self.camera[1] - self.camera[0]
-    cy = self.camera[3] - self.camera[0]
+      pixels - N x 2 array of (x,y) pixel coordinates
+      mask - N array, False for points further than `tolerance` from the plane
+    """
+    points = np.asarray(points, dtype=float)
+    h,w = self.camera_shape
 
-    lx = norm(cx)
-    cx /= lx
+    mask = np.abs(np.dot(points - self.camera_rect.p0, self.camera_rect.n)) <= tolerance
+    pixels = self.camera_rect.global_to_local(points) * (w, h)
+    return pixels, mask
 
-    ly = norm(cy)
-    cy /= ly
+  def _geometry_key(self):
+    """
+    Fingerprint of the current geometry
+    """
+    key = []
+    for attr in GEOMETRY_ATTRIBUTES:
+      val = getattr(self, attr, None)
+      if val is None or isinstance(val, basestring):
+        key.append(val)
+      else:
+        key.append(np.asarray(val, dtype=float).tostring())
+    return tuple(key)
 
-    px = np.dot(d, cx) / lx * self.camera_shape[1]
-    py = np.dot(d, cy) / ly * self.camera_shape[0]
+  def _memoize(self, key, func):
+    """
+    Return func(), calculating it only if not already done for the current geometry
+
+    Parameters:
+      key - tuple identifying the result (e.g. method name and arguments)
+      func - function to calculate result
+    """
+    geometry = self._geometry_key()
+    if geometry != self._memo_key:
+      self._memo = {}
+      self._memo_key = geometry
 
-    return (px,py)
+    if key not in self._memo:
+      self._memo[key] = func()
+    return self._memo[key]
 
   def camera_pixel_locations(self, dx=0.5, dy=0.5):
     """
@@ -246,53 +420,194 @@ class Spectrometer(object):
     Parameters:
       dx - horizontal location within pixel (0 = left, .5 = center, 1=right)
       dy - vertical location within pixel (0 = top, .5 = center, 1=bottom)
+
+    Returns:
+      read only (h, w, 3) array
     """
+    return self._memoize(('camera_pixel_locations', dx, dy),
+                         lambda: self._camera_pixel_locations(dx, dy))
+
+  def _camera_pixel_locations(self, dx, dy):
     h,w = self.camera_shape
-    coords = np.zeros((w*h,2))
-    index = np.arange(w*h)
-    coords[:,0] = index % w
-    coords[:,1] = index / w
+    u = (np.arange(w) + dx) / float(w)
+    v = (np.arange(h) + dy) / float(h)
+
+    cam_x = self.camera[1] - self.camera[0]
+    cam_y = self.camera[3] - self.camera[0]
 
-    points = self.camera[0] + \
-             (np.outer((coords[:,0]+dx)/float(w), self.camera[1] - self.camera[0]) +
-              np.outer((coords[:,1]+dy)/float(h), self.camera[3] - self.camera[0]))
-    return points.reshape((h,w,3))
+    points = (self.camera[0] +
+              u[np.newaxis,:,np.newaxis] * cam_x +
+              v[:,np.newaxis,np.newaxis] * cam_y)
+    points.flags.writeable = False
+    return points
 
   def image_points(self):
     """
     Calculate reflections of sample location about analyzer crystal faces
     """
-    return [geom.reflect_through_plane(self.sample, xp) for xp in self.xtal_rects]
+    images = self._memoize(('image_points',),
+        lambda: [geom.reflect_through_plane(self.sample, xp) for xp in self.xtal_rects])
+    return list(images)
+
+  def _region_labels(self, regions):
+    """
+    Label camera pixels by the xtal whose region they fall in
+
+    Parameters:
+      regions - list of (xtal index, [x1,y1,x2,y2]) pairs. Later regions take
+                precedence where they overlap.
+
+    Returns:
+      array of camera shape containing xtal index (or -1 outside of all regions)
+    """
+    labels = -np.ones(self.camera_shape, dtype=int)
+    for i, (x1,y1,x2,y2) in regions:
+      labels[y1:y2,x1:x2] = i
+    return labels
+
+  def _xtal_energies(self, labels, dx=0.5, dy=0.5):
+    """
+    Calculate energy reflected onto each pixel by its xtal
+
+    Parameters:
+      labels - xtal index for each pixel (see `_region_labels`)
+
+    Returns:
+      array of energies (0 for unlabeled pixels)
+    """
+    d0 = lattice_constants[self.xtal_type]
+    # XXX this assumes the crystal is cubic (all that we currently use are)
+    #     it would be good to generalize this though
+    d = d0 / norm(self.xtal_cut)
+
+    images = np.array(self.image_points())
+    normals = np.array([xtal_plane.n for xtal_plane in self.xtal_rects])
+    pixels = self.camera_pixel_locations(dx,dy)
+
+    # evaluate all xtals at once
+    mask = labels >= 0
+    l = labels[mask]
+    dn = pixels[mask] - images[l]
+    length = np.sqrt((dn**2).sum(1))
+    cos_theta = np.abs((dn*normals[l]).sum(1)) / length
+
+    energy = np.zeros(self.camera_shape)
+    energy[mask] = HC / (2 * d) / cos_theta
+    return energy
 
   def project_point_through_rect_onto_camera(self, point, rect):
     """
     Find pixels covered by projection of a point through a rectangle
     """
     h, w = self.camera_shape
-    x1 = w
-    x2 = 0
-    y1 = h
-    y2 = 0
 
-    for corner in rect:
-      l = geom.Line.FromPoints(point, corner)
-      p = geom.intersect_line_with_plane(l, self.camera_rect)
+    origins, directions = geom.lines_from_points(point, np.asarray(rect))
+    points, mask = geom.intersect_lines_with_plane(origins, directions, self.camera_rect)
+
+    pixels, mask = self.points_to_camera_pixels(points)
+    x = np.clip(np.trunc(pixels[:,0] + 1e-5), 0, w-1).astype(int)
+    y = np.clip(np.trunc(pixels[:,1] + 1e-5), 0, h-1).astype(int)
 
-      x,y = self.point_to_camera_pixel(p)
-      x = clamp(int(x+1e-5),0,w-1)
-      y = clamp(int(y+1e-5),0,h-1)
+    return [x.min(), y.min(), x.max(), y.max()]
 
-      if x < x1:
-        x1 = x
-      if y < y1:
-        y1 = y
+  def project_point_through_polygon_onto_camera(self, point, polygon):
+    """
+    Project a polygon from a point onto the camera
 
-      if x > x2:
-        x2 = x
-      if y > y2:
-        y2 = y
+    Returns:
+      K x 2 array of vertices in (x,y) pixel coordinates (ordered around the
+      polygon), or None if some vertex does not project onto the camera plane
+    """
+    origins, directions = geom.lines_from_points(point, np.asarray(polygon))
+    points, mask = geom.intersect_lines_with_plane(origins, directions, self.camera_rect)
+    if not mask.all():
+      return None
+    return geom.order_polygon(self.points_to_camera_pixels(points)[0])
 
-    return [x1, y1, x2, y2]
+  def calculate_projection_polygons(self):
+    """
+    Determine exact exposed regions on camera from each xtal
+
+    This finds the same projections as `calculate_projection_bounds2`, but
+    instead of bounding rectangles, returns the convex polygons actually
+    illuminated (the intersection of the projections of the exit aperture
+    and of the region of the xtal illuminated through each entrance aperture).
+
+    Returns:
+      list (one per xtal) of lists (one per illuminating entrance aperture)
+      of K x 2 arrays of polygon vertices in (x,y) pixel coordinates
+    """
+    polygons = self._memoize(('calculate_projection_polygons',), self._calculate_projection_polygons)
+    return [list(p) for p in polygons]
+
+  def _calculate_projection_polygons(self):
+    h, w = self.camera_shape
+    camera = [(0,0), (w,0), (w,h), (0,h)]
+    images = self.image_points()
+    apertures = [geom.Rectangle(ap[0], ap[1], ap[3]).corner_array() for ap in self.entrance_aperture]
+
+    polygons = []
+    for xtal_rect, image in izip(self.xtal_rects, images):
+      xtal_polygons = []
+      polygons.append(xtal_polygons)
+
+      exit_projection = self.project_point_through_polygon_onto_camera(image, self.exit_aperture)
+      if exit_projection is None:
+        continue
+
+      for aperture in apertures:
+        local = geom.project_polygon_through_point_onto_rect(self.sample, aperture, xtal_rect)
+        if local is None:
+          continue
+        active_region = xtal_rect.local_to_global(local)
+
+        active_projection = self.project_point_through_polygon_onto_camera(image, active_region)
+        if active_projection is None:
+          continue
+
+        polygon = geom.intersect_polygons(active_projection, exit_projection)
+        polygon = geom.intersect_polygons(polygon, camera)
+        if abs(geom.polygon_area(polygon)) > 0:
+          xtal_polygons.append(polygon)
+
+    return polygons
+
+  def xtal_masks(self):
+    """
+    Determine which camera pixels are illuminated by each xtal
+
+    A pixel is illuminated if its center lies within one of the xtal's
+    projection polygons (see `calculate_projection_polygons`).
+
+    Returns:
+      read only (num_xtals, h, w) boolean array
+    """
+    return self._memoize(('xtal_masks',), self._xtal_masks)
+
+  def _xtal_masks(self):
+    polygons = self.calculate_projection_polygons()
+    masks = np.zeros((len(polygons),) + tuple(self.camera_shape), dtype=bool)
+    for mask, xtal_polygons in izip(masks, polygons):
+      for polygon in xtal_polygons:
+        mask |= geom.rasterize_polygon(polygon, self.camera_shape)
+    masks.flags.writeable = False
+    return masks
+
+  def _mask_labels(self, masks):
+    """
+    Label camera pixels by the xtal whose mask they fall in
+
+    Parameters:
+      masks - sequence of boolean arrays of camera shape (one per xtal).
+              Later masks take precedence where they overlap.
+
+    Returns:
+      array of camera shape containing xtal index (or -1 outside of all masks)
+    """
+    labels = -np.ones(self.camera_shape, dtype=int)
+    for i, mask in enumerate(masks):
+      labels[np.asarray(mask, dtype=bool)] = i
+    return labels
 
   def calculate_projection_bounds(self):
     """
@@ -303,13 +618,13 @@ class Spectrometer(object):
     and onto camera.
 
     For now, this finds top left and bottom right corners (in camera coords)
-    and assumes region to be rectangular.
-
-    TODO: should be easy to extend this to calculate full trapezoidal region
-          or, could add option to give largest rect inside, or smallest rect
-          outside...
+    and assumes region to be rectangular. See `calculate_projection_polygons`
+    for the exact regions.
     """
+    bounds = self._memoize(('calculate_projection_bounds',), self._calculate_projection_bounds)
+    return [list(b) for b in bounds]
 
+  def _calculate_projection_bounds(self):
     bounds = []
     images = self.image_points()
 
@@ -318,13 +633,8 @@ class Spectrometer(object):
       exit_projection = self.project_point_through_rect_onto_camera(image, self.exit_aperture)
 
       # find region of crystals exposed by source
-      active_region = [
-          geom.intersect_line_with_plane(
-            geom.Line.FromPoints(self.sample, corner),
-            xtal_plane
-            )
-          for corner in entrance_aperture
-          ]
+      origins, directions = geom.lines_from_points(self.sample, np.asarray(entrance_aperture))
+      active_region, mask = geom.intersect_lines_with_plane(origins, directions, xtal_plane)
 
       # project images through active region on to camera
       active_projection = self.project_point_through_rect_onto_camera(image, active_region)
@@ -345,60 +655,42 @@ class Spectrometer(object):
     Create a theoretical calibration matrix for the designed spectrometer
     geometry.
     """
-    h,w = self.camera_shape
-    calib = np.zeros((h,w))
+    bounds = self.calculate_projection_bounds()
 
-    d0 = lattice_constants[self.xtal_type]
-    # XXX this assumes the crystal is cubic (all that we currently use are)
-    #     it would be good to generalize this though
-    d = d0 / norm(self.xtal_cut)
+    calib = self._memoize(('mockup_calibration_matrix', dx, dy),
+        lambda: self._xtal_energies(self._region_labels(enumerate(bounds)), dx, dy))
 
-    images = self.image_points()
-    bounds = []
-
-    pixels = self.camera_pixel_locations(dx,dy)
-
-    # find image points and xtal projection boundaries
-    for xtal_plane, image, entrance_aperture in izip(self.xtal_rects, images, self.entrance_aperture):
-      exit_projection = self.project_point_through_rect_onto_camera(image, self.exit_aperture)
+    return calib.copy()
 
-      active_region = [
-          geom.intersect_line_with_plane(
-            geom.Line.FromPoints(self.sample, corner),
-            xtal_plane
-            )
-          for corner in entrance_aperture
-          ]
-
-      active_projection = self.project_point_through_rect_onto_camera(image, active_region)
-
-      x1 = max(exit_projection[0], active_projection[0])
-      y1 = max(exit_projection[1], active_projection[1])
-      x2 = min(exit_projection[2], active_projection[2])
-      y2 = min(exit_projection[3], active_projection[3])
-
-      bounds.append([x1,y1,x2,y2])
-      rw = x2-x1
-      rh = y2-y1
-
-      dn = pixels[y1:y2, x1:x2].reshape((rw*rh,3)) - image
-      length = np.sqrt((dn**2).sum(1))
-      cos_theta = np.abs((dn*xtal_plane.n).sum(1)) / length
-      energy = HC / (2 * d) / cos_theta
-      energy = energy.reshape((rh,rw))
-
-      calib[y1:y2,x1:x2] = energy
+  # shared spectrometers may be used from several threads at once, so
+  # results are never stored on the instance (other than by _memoize)
+  @property
+  def images(self):
+    """
+    Image points of the source in each xtal (see `image_points`)
+    """
+    return self.image_points()
 
-    self.images = images
-    self.projection_bounds = bounds
-    return calib
+  @property
+  def projection_bounds(self):
+    """
+    Exposed region on camera from each xtal (see `calculate_projection_bounds`)
+    """
+    return self.calculate_projection_bounds()
 
-  def solid_angle_map(self, bounds=None):
+  def solid_angle_map(self, bounds=None, masks=None, return_distance=False):
     """
     Calculate the solid angle subtended by each pixel in sr
 
     Parameters:
       bounds - list of (x1,y1,x2,y2) bounding rectangles
+      masks - sequence (one per xtal) of boolean arrays of pixels illuminated
+              by each xtal (e.g. from `xtal_masks`)
+      return_distance - if True, also return the distance from each pixel to
+                        the image point of its xtal
+
+    Returns:
+      solid angle map, or (solid angle map, distance map) if return_distance is True
 
     Each rectangle in the list of bounds should correspond to the
     projection from a single analyzer crystal through the exit aperture.
@@ -406,20 +698,27 @@ class Spectrometer(object):
     The center of the bounds rect is used to determine which xtal it
     corresponds to. So, this could be incorrect if a small sliver at the
     edge of a crystal projection is provided.
+
+    If masks are given, bounds are ignored and only pixels within a mask
+    are assigned a solid angle.
     """
+    if masks is not None:
+      domega, distance = self._solid_angle_from_labels(self._mask_labels(masks))
+    else:
+      if bounds is not None:
+        bounds = [tuple(b) for b in bounds]
 
-    xtals_reversed = False
+      domega, distance = self._memoize(('solid_angle_map', bounds and tuple(bounds)),
+                                       lambda: self._solid_angle_map(bounds))
 
-    h,w = self.camera_shape
-    domega = np.zeros((h,w))
-    distance = np.zeros((h,w))
+    if return_distance:
+      return domega.copy(), distance.copy()
+    return domega.copy()
 
-    # calculate pixel size
-    pw = norm(self.camera[1] - self.camera[0]) / w
-    ph = norm(self.camera[3] - self.camera[0]) / h
-    #print pw, ph
+  def _solid_angle_map(self, bounds):
+    xtals_reversed = False
 
-    images = self.image_points()
+    h,w = self.camera_shape
 
     design_bounds = self.calculate_projection_bounds()
     if bounds is None:
@@ -432,43 +731,58 @@ class Spectrometer(object):
     if design_bounds[0][0] > design_bounds[-1][0]:
       xtals_reversed = True
 
-    pixels = self.camera_pixel_locations()
     num_xtals = len(self.xtal_rects)
 
+    # determine which crystal each rect corresponds to
+    regions = []
     for x1,y1,x2,y2 in bounds:
       xc = (x1+x2)/2.0
-      yc = (y1+y2)/2.0
-
-      # determine which crystal this corresponds to
-      i = int(xc) * num_xtals / w
+      i = int(xc) * num_xtals // w
       if xtals_reversed:
         i = num_xtals - i - 1
+      regions.append((i, (x1,y1,x2,y2)))
 
-      #print xc,yc, i, self.xtals[i][0]
-      # projection shape size
-      sh = y2 - y1
-      sw = x2 - x1
+    return self._solid_angle_from_labels(self._region_labels(regions))
 
-      dn = pixels[y1:y2,x1:x2].reshape((sw*sh,3)) - images[i]
-      length = np.sqrt((dn**2).sum(1))
-      cos_theta = np.abs((dn*self.camera_rect.n).sum(1)) / length
-      distance[y1:y2,x1:x2] = length.reshape((sh,sw))
-      domega[y1:y2,x1:x2] = (pw*ph*cos_theta / length**2).reshape((sh,sw))
+  def _solid_angle_from_labels(self, labels):
+    """
+    Calculate solid angle and distance to the image point of each labeled pixel
+
+    Returns:
+      (domega, distance)
+    """
+    h,w = self.camera_shape
 
-    self.distance = distance
-    return domega
+    # calculate pixel size
+    pw = norm(self.camera[1] - self.camera[0]) / w
+    ph = norm(self.camera[3] - self.camera[0]) / h
+
+    images = np.array(self.image_points())
+    pixels = self.camera_pixel_locations()
+
+    # evaluate all xtals at once
+    mask = labels >= 0
+    dn = pixels[mask] - images[labels[mask]]
+    length = np.sqrt((dn**2).sum(1))
+    cos_theta = np.abs((dn*self.camera_rect.n).sum(1)) / length
+
+    domega = np.zeros((h,w))
+    distance = np.zeros((h,w))
+    distance[mask] = length
+    domega[mask] = pw*ph*cos_theta / length**2
+
+    return domega, distance
 
   def calculate_active_regions(self):
     """
     Find projection of sample through entrance apertures onto xtals.
 
-    FIXME: This currently assumes rectangular projections onto crytals.
-
     Returns:
       List of active regions for each crystal.
       Each entry in list is also a list (since multiple apertures may
         illuminate same xtal).
-      Finally, each subentry is a list of 4 points.
+      Finally, each subentry is a list of the vertices of the (convex)
+        illuminated region.
     """
     if len(self.entrance_aperture) != len(self.xtals):
       raise Exception("Number of entrance apertures and crystals must be same")
@@ -495,11 +809,8 @@ class Spectrometer(object):
     and onto camera.
 
     For now, this finds top left and bottom right corners (in camera coords)
-    and assumes region to be rectangular.
-
-    TODO: should be easy to extend this to calculate full trapezoidal region
-          or, could add option to give largest rect inside, or smallest rect
-          outside...
+    and assumes region to be rectangular. See `calculate_projection_polygons`
+    for the exact regions.
     """
 
     bounds = []
@@ -537,38 +848,17 @@ class Spectrometer(object):
     Create a theoretical calibration matrix for the designed spectrometer
     geometry.
     """
-    h,w = self.camera_shape
-    calib = np.zeros((h,w))
-
-    d0 = lattice_constants[self.xtal_type]
-    # XXX this assumes the crystal is cubic (all that we currently use are)
-    #     it would be good to generalize this though
-    d = d0 / norm(self.xtal_cut)
-
-    images = self.image_points()
-
-    bounds_by_xtal = self.calculate_projection_bounds2()
-
-    pixels = self.camera_pixel_locations(dx,dy)
-
-    # find image points and xtal projection boundaries
-    for xtal_plane, image, bounds in izip(self.xtal_rects, images, bounds_by_xtal):
-      for b in bounds:
-        if b is None: continue
-        x1,y1,x2,y2 = b
-        rw = x2-x1
-        rh = y2-y1
-
-        #print rw, rh
-        dn = pixels[y1:y2, x1:x2].reshape((rw*rh,3)) - image
-        length = np.sqrt((dn**2).sum(1))
-        cos_theta = np.abs((dn*xtal_plane.n).sum(1)) / length
-        energy = HC / (2 * d) / cos_theta
-        energy = energy.reshape((rh,rw))
-
-        calib[y1:y2,x1:x2] = energy
+    def calc():
+      bounds_by_xtal = self.calculate_projection_bounds2()
+      regions = [
+          (i, b)
+          for i, bounds in enumerate(bounds_by_xtal)
+          for b in bounds
+          if b is not None
+          ]
+      return self._xtal_energies(self._region_labels(regions), dx, dy)
 
-    return calib
+    return self._memoize(('mockup_calibration_matrix2', dx, dy), calc).copy()
 
   def scattering_angles(self, degrees=False):
     """
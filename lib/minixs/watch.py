@@ -0,0 +1,431 @@
+"""
+Live processing of exposures as they are written during a scan
+
+A directory is polled for new exposure files. Each frame is matched to its
+row in a scan file (by order of acquisition) to get its incident energy and
+I0, processed with a calibration that is only loaded once, and added to an
+in-progress RIXS or XES spectrum. The result is saved after each update, so
+it can be plotted while the scan is still running.
+
+Classes:
+  DirectoryWatcher - report files in a directory once they are fully written
+  ScanFollower - read rows of a scan file as they are appended
+  LiveXES - running sum of exposures processed into an emission spectrum
+  LiveRIXS - RIXS spectrum extended by one incident energy per exposure
+
+Functions:
+  watch - follow a directory (and scan file), processing frames as they arrive
+
+Example:
+  >>> import minixs as mx
+  >>> rixs = mx.watch.LiveRIXS('fe.calib', filters=[...])
+  >>> mx.watch.watch('/data/fe_rixs', rixs, scan_file='/data/fe_rixs.0001', output='fe.rixs')
+"""
+
+import os
+import time
+import fnmatch
+import numpy as np
+
+import calibrate
+from emission import EmissionSpectrum, process_spectrum, KILLZONE_SKIP_COLUMNS
+from correction import CorrectionMaps
+from exposure import Exposure
+from rixs import RIXS
+from scanfile import ScanFile
+
+class DirectoryWatcher(object):
+  """
+  Find new files in a directory
+
+  A file is only reported once its size has stopped changing between two
+  polls, so files that are still being written are skipped until complete.
+  """
+  def __init__(self, directory, pattern='*.tif', skip_existing=False):
+    """
+    Parameters:
+      directory - directory to watch
+      pattern - glob pattern of files to report
+      skip_existing - if True, files already present are never reported
+    """
+    self.directory = directory
+    self.pattern = pattern
+    self.sizes = {}
+    self.seen = set()
+
+    if skip_existing:
+      self.seen.update(self._list())
+
+  def _list(self):
+    return [os.path.join(self.directory, f)
+            for f in fnmatch.filter(os.listdir(self.directory), self.pattern)]
+
+  def poll(self):
+    """
+    Check for new files
+
+    Returns:
+      sorted list of new files whose size has not changed since last poll
+    """
+    ready = []
+    for path in self._list():
+      if path in self.seen:
+        continue
+
+      try:
+        size = os.path.getsize(path)
+      except OSError:
+        # removed since listing
+        continue
+
+      if size > 0 and self.sizes.get(path) == size:
+        ready.append(path)
+        self.seen.add(path)
+        del self.sizes[path]
+      else:
+        self.sizes[path] = size
+
+    return sorted(ready)
+
+class ScanFollower(object):
+  """
+  Read incident energies and I0s from a scan file that is still being written
+  """
+  def __init__(self, filename, energy_column=None, i0_column=None):
+    """
+    Parameters:
+      filename - scan file
+      energy_column - index of incident energy column (if None, the first
+                      column whose name contains 'mono' or 'energy' is used)
+      i0_column - index of I0 column (if None, the first column whose name
+                  contains 'i0' is used)
+    """
+    self.filename = filename
+    self.energy_column = energy_column
+    self.i0_column = i0_column
+    self.energies = np.array([])
+    self.I0s = np.array([])
+    self.scan = None
+
+  def update(self):
+    """
+    Read any rows appended to the scan file
+
+    Returns:
+      number of rows available
+    """
+    if self.scan is None:
+      if not os.path.exists(self.filename):
+        return 0
+      self.scan = ScanFile(self.filename)
+    else:
+      self.scan.update()
+
+    if len(self.scan.data) > len(self.energies):
+      self.energy_column, self.i0_column = self.scan.find_energy_and_i0_columns(self.energy_column, self.i0_column)
+      self.energies = self.scan.data[:, self.energy_column]
+      self.I0s = self.scan.data[:, self.i0_column]
+    return len(self.energies)
+
+  def row(self, i):
+    """
+    Get (energy, I0) of row `i`, or None if it hasn't been written yet
+    """
+    if i >= len(self.energies):
+      self.update()
+    if i >= len(self.energies):
+      return None
+    return self.energies[i], self.I0s[i]
+
+class LiveSpectrum(object):
+  """
+  Base class for spectra built up from exposures as they arrive
+
+  Everything that doesn't depend on the exposures (calibration, emission
+  energy grid, maps) is set up once on creation.
+  """
+  def __init__(self, calibration, emission_energies=None, filters=[],
+               solid_angle_map=None, corrections=None, killzone_mask=None,
+               killzone_mode=KILLZONE_SKIP_COLUMNS, xtal_masks=None):
+    """
+    Parameters:
+      calibration - Calibration or calibration filename
+      emission_energies - emission energy grid (default: 0.1 eV steps
+                          covering calibration energy range)
+      filters - list of mx.filter.Filter descendents to apply to exposures
+      solid_angle_map - solid angle map filename
+      corrections - CorrectionMaps to apply to exposures
+      killzone_mask, killzone_mode, xtal_masks - see emission.process_spectrum
+    """
+    if isinstance(calibration, basestring):
+      calibration_file = os.path.abspath(calibration)
+      calibration = calibrate.load(calibration_file)
+      if calibration.load_errors:
+        raise Exception("Unable to load calibration '%s':\n%s" % (calibration_file, '\n'.join(calibration.load_errors)))
+    else:
+      calibration_file = calibration.filename
+
+    if emission_energies is None:
+      Emin, Emax = calibration.energy_range()
+      emission_energies = np.arange(Emin, Emax, .1)
+
+    self.calibration = calibration
+    self.calibration_file = calibration_file
+    self.emission_energies = emission_energies
+    self.filters = filters
+    self.corrections = corrections or CorrectionMaps()
+    self.killzone_mask = killzone_mask
+    self.killzone_mode = killzone_mode
+    self.xtal_masks = xtal_masks
+
+    self.spectrum = self._create_spectrum()
+    if solid_angle_map:
+      self.spectrum._load_solid_angle_map(solid_angle_map)
+
+    # load correction maps now instead of with first frame
+    self.corrections.coefficients()
+
+  def _create_spectrum(self):
+    raise NotImplementedError
+
+  def _process(self, exposure, I0):
+    return process_spectrum(self.calibration.calibration_matrix,
+                            exposure,
+                            self.emission_energies,
+                            I0,
+                            self.calibration.dispersive_direction,
+                            self.calibration.xtals,
+                            self.spectrum.solid_angle_map,
+                            killzone_mask=self.killzone_mask,
+                            killzone_mode=self.killzone_mode,
+                            correction=self.corrections,
+                            xtal_masks=self.xtal_masks)
+
+  def load_exposure(self, filename):
+    """
+    Load an exposure, returning None if it isn't complete yet
+    """
+    try:
+      exposure = Exposure(filename)
+    except (IOError, ValueError):
+      return None
+
+    if exposure.pixels.shape != self.calibration.calibration_matrix.shape:
+      return None
+    return exposure
+
+  def add(self, exposure, energy, I0):
+    """
+    Add an exposure to the spectrum
+
+    Parameters:
+      exposure - loaded Exposure
+      energy - incident energy
+      I0 - incident flux
+    """
+    raise NotImplementedError
+
+  def save(self, filename):
+    """
+    Save spectrum (atomically, so readers never see a partial file)
+    """
+    tmp = "%s.tmp%d" % (filename, os.getpid())
+    self.spectrum.save(tmp)
+    os.rename(tmp, filename)
+    self.spectrum.filename = filename
+
+class LiveXES(LiveSpectrum):
+  """
+  Emission spectrum of the sum of all exposures added so far
+
+  This gives the same result as processing all of the exposures at once
+  with EmissionSpectrum.process.
+  """
+  def _create_spectrum(self):
+    xes = EmissionSpectrum()
+    xes.calibration_file = self.calibration_file
+    xes.filters = self.filters
+    xes.corrections = self.corrections
+    xes.I0 = 0
+    self.pixels = None
+    return xes
+
+  def add(self, exposure, energy, I0):
+    xes = self.spectrum
+
+    if self.pixels is None:
+      self.pixels = exposure.pixels.astype(int)
+    else:
+      self.pixels += exposure.pixels
+
+    xes.exposure_files.append(os.path.abspath(exposure.filename))
+    xes.incident_energy = energy
+    xes.I0 += I0
+
+    # filters act on the summed exposure, so must be reapplied to the new sum
+    total = Exposure()
+    total.pixels = self.pixels.copy()
+    total.apply_filters(energy, self.filters)
+
+    xes._set_spectrum(self._process(total, xes.I0))
+
+class LiveRIXS(LiveSpectrum):
+  """
+  RIXS spectrum with one emission spectrum per exposure added so far
+
+  Rows are stored in a buffer whose capacity doubles as needed, so adding
+  an exposure doesn't copy all of the rows already added. The spectrum's
+  `spectrum` array is a view of the filled part of the buffer.
+  """
+  def _create_spectrum(self):
+    rixs = RIXS()
+    rixs.calibration_file = self.calibration_file
+    rixs.filters = self.filters
+    rixs.corrections = self.corrections
+    rixs.energies = []
+    rixs.I0s = []
+    self.rows = np.zeros((0, 6))
+    rixs.spectrum = self.rows
+    return rixs
+
+  def add(self, exposure, energy, I0):
+    rixs = self.spectrum
+
+    exposure.apply_filters(energy, self.filters)
+    xes = self._process(exposure, I0)
+
+    start = len(rixs.spectrum)
+    end = start + len(xes)
+    if end > len(self.rows):
+      rows = np.zeros((max(end, 2 * len(self.rows)), 6))
+      rows[:start] = self.rows[:start]
+      self.rows = rows
+
+    self.rows[start:end,0] = energy
+    self.rows[start:end,1:] = xes
+
+    rixs.energies.append(energy)
+    rixs.I0s.append(I0)
+    rixs.exposure_files.append(os.path.abspath(exposure.filename))
+    rixs.spectrum = self.rows[:end]
+
+def watch(directory, spectrum, scan_file=None, energy=0, I0=1, output=None,
+          pattern='*.tif', skip_existing=False, interval=0.1, timeout=None,
+          callback=None, energy_column=None, i0_column=None,
+          retry_timeout=10, skip_callback=None, save_interval=1.0):
+  """
+  Process exposures as they are written to a directory
+
+  Parameters:
+    directory - directory to watch for exposures
+    spectrum - LiveXES or LiveRIXS to add exposures to
+    scan_file - scan file containing incident energy and I0 of each frame
+                (the nth new exposure corresponds to the nth row, or with
+                skip_existing, to the nth row after those already written)
+    energy, I0 - incident energy and flux of every frame if no scan file is given
+    output - filename to save spectrum to (see save_interval)
+    pattern - glob pattern of exposure files
+    skip_existing - ignore exposures already in the directory
+    interval - time in seconds between polls
+    timeout - stop after this many seconds without a new frame (None to run forever)
+    callback - function called as callback(spectrum, filename, energy, I0) after each frame
+    energy_column, i0_column - scan file columns (see ScanFollower)
+    retry_timeout - skip an exposure that still can't be loaded (or has the
+                    wrong shape) this many seconds after it first failed
+    skip_callback - function called as skip_callback(filename) for each
+                    skipped exposure
+    save_interval - minimum time in seconds between saves of output
+
+  Returns:
+    number of frames processed
+
+  The whole output file is rewritten on each save, so saves are spaced by
+  at least save_interval, or by 4 times the duration of the last save if
+  that is longer. Saving therefore doesn't come to dominate the time per
+  frame as a long scan grows. Any frames not yet saved are saved when
+  watching stops.
+
+  Frames that arrive before their scan row is written are held until it is.
+  A skipped exposure still uses up its scan row, so later frames stay
+  matched to the right rows.
+  """
+  watcher = DirectoryWatcher(directory, pattern, skip_existing)
+  scan = None
+  if scan_file:
+    scan = ScanFollower(scan_file, energy_column, i0_column)
+
+  pending = []
+  count = 0
+  row_index = 0
+  last_frame = time.time()
+
+  # time at which each pending exposure first failed to load
+  failures = {}
+
+  # rows already in the scan file belong to the exposures being skipped
+  if scan and skip_existing:
+    row_index = scan.update()
+
+  # number of frames saved, and earliest time of the next save
+  state = {'saved': 0, 'next_save': 0}
+
+  def save():
+    start = time.time()
+    spectrum.save(output)
+    state['saved'] = count
+    now = time.time()
+    state['next_save'] = now + max(save_interval, 4 * (now - start))
+
+  try:
+    while True:
+      pending += watcher.poll()
+
+      while pending:
+        if scan:
+          row = scan.row(row_index)
+          if row is None:
+            break
+          frame_energy, frame_I0 = row
+        else:
+          frame_energy, frame_I0 = energy, I0
+
+        exposure = spectrum.load_exposure(pending[0])
+        if exposure is None:
+          # likely still being written, even though the size was stable,
+          # unless it has been failing for too long
+          now = time.time()
+          first_failure = failures.setdefault(pending[0], now)
+          if now - first_failure < retry_timeout:
+            break
+
+          filename = pending.pop(0)
+          del failures[filename]
+          row_index += 1
+          last_frame = now
+          if skip_callback:
+            skip_callback(filename)
+          continue
+
+        filename = pending.pop(0)
+        failures.pop(filename, None)
+        spectrum.add(exposure, frame_energy, frame_I0)
+        count += 1
+        row_index += 1
+        last_frame = time.time()
+
+        if output and last_frame >= state['next_save']:
+          save()
+        if callback:
+          callback(spectrum, filename, frame_energy, frame_I0)
+
+      # save frames that were held back once there is time to
+      if output and count > state['saved'] and time.time() >= state['next_save']:
+        save()
+
+      if timeout is not None and time.time() - last_frame > timeout:
+        return count
+
+      time.sleep(interval)
+  finally:
+    if output and count > state['saved']:
+      save()